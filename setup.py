@@ -7,14 +7,27 @@ setup(
     version = "0.0.1",
     packages = find_packages('src'),
     package_dir = { '': 'src'},
+    package_data = { 'subredditscraper': ['fixtures/*.json', 'fixtures/*.txt']},
     install_requires = ['setuptools',
         'scrapy >= 1.0.1, < 1.1.0',
         'sqlite3',
         'mock',
     ],
+    extras_require = {
+        'arrow': ['pyarrow'],
+        'ijson': ['ijson'],
+        'zstd': ['zstandard'],
+    },
     entry_points = {
         'console_scripts': [
-            'subreddit-scraper = subredditscraper.cli:main'
+            'subreddit-scraper = subredditscraper.cli:main',
+            'subreddit-scraper-benchmark = subredditscraper.benchmarks:main',
+            'subreddit-scraper-synthetic = subredditscraper.synthetic:main',
+            'subreddit-scraper-export = subredditscraper.exporters:main',
+            'subreddit-scraper-ndjson = subredditscraper.ndjson:main',
+            'subreddit-scraper-query = subredditscraper.query:main',
+            'subreddit-scraper-search = subredditscraper.search:main',
+            'subreddit-scraper-thread = subredditscraper.threads:main',
         ]
     }
 )
@@ -0,0 +1,1054 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pkg_resources
+import platform
+import resource
+import shutil
+import sqlite3
+import tempfile
+import time
+import timeit
+
+from scrapy.http import Request, TextResponse
+from subredditscraper.compression import CODECS, get_codec
+from subredditscraper.database import connect, connect_reader
+from subredditscraper.decoders import DECODERS, get_decoder
+from subredditscraper.exceptions import UnknownCodecException, UnknownDecoderException, UnknownFormatException
+from subredditscraper.exporters import FORMATS, check_format, export_table
+from subredditscraper.ids import encode_id
+from subredditscraper.items import Comment, CommentRow, Link, LinkRow, id_serializer
+from subredditscraper.pipelines import SQLiteItemPipeline
+from subredditscraper.schema import COMMENTS, LINKS
+from subredditscraper.search import COMMENTS_SEARCH, LINKS_SEARCH, search
+from subredditscraper.spiders import SubredditSpider
+from subredditscraper.synthetic import WORDS, SyntheticReddit
+
+logger = logging.getLogger('subredditscraper.benchmarks')
+
+
+"""
+The recorded responses measured, with the prefixes of their children. They're shipped with the package, along with
+the other recordings the tests replay, so that the benchmarks run wherever it's installed.
+"""
+FIXTURES = (
+    ('list-posts.json', 'data.children'),
+    ('list-posts-before.json', 'data.children'),
+    ('list-comments.json', 'item.data.children'),
+    ('list-comments-before.json', 'item.data.children'),
+)
+
+
+"""
+The item class and schema of each kind of Reddit thing stored.
+"""
+KINDS = {
+    't1': (Comment, COMMENTS),
+    't3': (Link, LINKS),
+}
+
+
+"""
+The batch sizes the pipeline is measured writing with by default.
+"""
+BATCH_SIZES = (1, 50, 500, 5000)
+
+
+def fixture_path(name):
+    """
+    Returns the path of a recorded response shipped with the package.
+    """
+    return pkg_resources.resource_filename('subredditscraper', 'fixtures/%s' % (name,))
+
+
+def scale_document(body, prefix, size):
+    """
+    Scales a recorded response up to roughly a given size by repeating the children at its prefix, so that decoding
+    it takes long enough to measure.
+
+    Arguments:
+    body: The JSON document.
+    prefix: The prefix of the children.
+    size: The size in bytes to scale the document to.
+
+    Returns:
+    The scaled JSON document, at least as large as the original.
+    """
+    document = json.loads(body)
+    factor = max(1, size // len(body))
+
+    def scale(value, path):
+        if not path:
+            value[:] = value * factor
+        elif path[0] == 'item' and isinstance(value, list):
+            for item in value:
+                scale(item, path[1:])
+        elif isinstance(value, dict) and path[0] in value:
+            scale(value[path[0]], path[1:])
+
+    scale(document, prefix.split('.'))
+
+    return json.dumps(document)
+
+
+def load_children(kinds=('t1', 't3')):
+    """
+    Returns the children of the given kinds of every recorded response.
+    """
+    result = []
+
+    for name, prefix in FIXTURES:
+        with open(fixture_path(name), 'rb') as f:
+            result.extend(i for i in get_decoder('json').iter_items(f.read(), prefix) if i['kind'] in kinds)
+
+    return result
+
+
+def synthetic_children(count, kind):
+    """
+    Generates listing children by cycling through those of the recorded responses, giving each an id of its own so
+    that every one of them is a new row to the database.
+
+    Arguments:
+    count: The number of children to generate.
+    kind: The kind of the children, `t1` or `t3`.
+
+    Returns:
+    A list of children.
+    """
+    templates = load_children((kind,))
+    result = []
+
+    for i in range(count):
+        template = templates[i % len(templates)]
+
+        data = dict(template['data'], id=encode_id(i + 1))
+        data['name'] = '%s_%s' % (kind, data['id'])
+
+        result.append({'kind': kind, 'data': data})
+
+    return result
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which a fraction of the values fall, by the nearest rank.
+    """
+    values = sorted(values)
+
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)] if values else None
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes.
+    """
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(benchmark, case, latencies, seconds, baseline):
+    """
+    Summarizes a measurement.
+
+    Arguments:
+    benchmark: The name of the benchmark.
+    case: The name of what was measured within the benchmark.
+    latencies: The seconds taken by each item.
+    seconds: The seconds taken by all of the items, from which their throughput is computed.
+    baseline: The peak resident set size in bytes before the measurement.
+
+    Returns:
+    A result dictionary of the number of items, items per second, the median and 99th percentile latency per item in
+    microseconds and the growth of the peak resident set size in MB.
+    """
+    return {
+        'benchmark': benchmark,
+        'case': case,
+        'items': len(latencies),
+        'seconds': seconds,
+        'items_per_second': len(latencies) / seconds if seconds else None,
+        'p50_us': percentile(latencies, 0.5) * 1e6 if latencies else None,
+        'p99_us': percentile(latencies, 0.99) * 1e6 if latencies else None,
+        'peak_rss_mb': (peak_rss() - baseline) / 1048576.0,
+    }
+
+
+def measure_each(benchmark, case, function, values, repeatable=True):
+    """
+    Calls a function on each of a list of values, timing each call. Run in a process of its own, as the peak
+    resident set size of a process never shrinks.
+
+    Arguments:
+    benchmark: The name of the benchmark.
+    case: The name of what's measured within the benchmark.
+    function: The function to measure.
+    values: The values to call it with.
+    repeatable: Whether the function may be called on the same values again. If so, the throughput is measured by a
+                second run without timing each call, as the timer takes a sizeable part of a call of a microsecond or
+                two; if not, both come from the same run.
+
+    Returns:
+    A result dictionary, as returned by `summarize`.
+    """
+    timer = timeit.default_timer
+    baseline = peak_rss()
+    latencies = []
+
+    start = timer()
+
+    for value in values:
+        before = timer()
+        function(value)
+        latencies.append(timer() - before)
+
+    seconds = timer() - start
+
+    if repeatable:
+        start = timer()
+
+        for value in values:
+            function(value)
+
+        seconds = timer() - start
+
+    return summarize(benchmark, case, latencies, seconds, baseline)
+
+
+def measure_ids(method, count):
+    """
+    Measures parsing ids out of the fullnames of the recorded comments, their links and their parents.
+
+    Arguments:
+    method: `get_raw_id`, the spider's parser, or `id_serializer`, the item serializer.
+    count: The number of ids to parse.
+    """
+    ids = []
+
+    for child in load_children(('t1',)):
+        ids.extend((child['data']['name'], child['data']['link_id'], child['data']['parent_id']))
+
+    ids = (ids * (count // len(ids) + 1))[:count]
+    function = SubredditSpider([]).get_raw_id if method == 'get_raw_id' else id_serializer
+
+    return measure_each('ids', method, function, ids)
+
+
+def measure_items(method, kind, count):
+    """
+    Measures building items from listing children, serializing built items into rows, or converting listing children
+    straight into rows, as the spider does.
+
+    Arguments:
+    method: `build`, `serialize` or `convert`.
+    kind: The kind of the children, `t1` or `t3`.
+    count: The number of items.
+    """
+    spider = SubredditSpider([])
+    cls, schema = KINDS[kind]
+    data = [i['data'] for i in synthetic_children(count, kind)]
+    case = '%s %s' % (method, cls.__name__)
+
+    if method == 'build':
+        return measure_each('items', case, lambda i: spider.build_item(cls, i), data)
+
+    if method == 'convert':
+        return measure_each('items', case, schema.convert, data)
+
+    return measure_each('items', case, schema.serialize, [spider.build_item(cls, i) for i in data])
+
+
+def measure_decoder(path, prefix, decoder, repeat=3):
+    """
+    Decodes the children of a document, timing each child, and measures the time taken to decode all of them.
+
+    Arguments:
+    path: The path of the document.
+    prefix: The prefix of the children.
+    decoder: The name of the decoder.
+    repeat: The number of times to decode the whole document, of which the fastest is reported.
+
+    Returns:
+    A result dictionary, as returned by `summarize`.
+    """
+    with open(path, 'rb') as f:
+        body = f.read()
+
+    decoder = get_decoder(decoder)
+    timer = timeit.default_timer
+    baseline = peak_rss()
+    latencies = []
+
+    # hold one child at a time, as the spider does
+    before = timer()
+
+    for child in decoder.iter_items(body, prefix):
+        latencies.append(timer() - before)
+        before = timer()
+
+    seconds = None
+
+    for i in range(repeat):
+        start = timer()
+
+        for child in decoder.iter_items(body, prefix):
+            pass
+
+        seconds = min(seconds, timer() - start) if seconds is not None else timer() - start
+
+    return summarize('decoders', None, latencies, seconds, baseline)
+
+
+def measure_store(batch_size, count):
+    """
+    Measures writing new links and comments with the pipeline, half of each, in batches of a given size. The last
+    batch, written as the spider closes, is timed along with the rest.
+
+    Arguments:
+    batch_size: The number of rows written per transaction.
+    count: The number of items to write.
+    """
+    items = [LinkRow(row=LINKS.convert(i['data'])) for i in synthetic_children(count // 2, 't3')] + \
+        [CommentRow(row=COMMENTS.convert(i['data'])) for i in synthetic_children(count - count // 2, 't1')]
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        pipeline = SQLiteItemPipeline(os.path.join(directory, 'benchmark.db'), batch_size=batch_size,
+            flush_interval=3600)
+        pipeline.open_spider(None)
+
+        result = measure_each('store', 'batch size %d' % (batch_size,), lambda i: pipeline.process_item(i, None),
+            items, repeatable=False)
+
+        start = timeit.default_timer()
+        pipeline.close_spider(None)
+
+        result['seconds'] += timeit.default_timer() - start
+        result['items_per_second'] = result['items'] / result['seconds']
+
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def synthetic_responses(count, per_page=100):
+    """
+    Generates listing pages and comment pages of synthetic children, as Reddit would send them, half of them links
+    and half comments.
+
+    Arguments:
+    count: The number of links and comments.
+    per_page: The number of children per page.
+
+    Returns:
+    A list of responses, each with the meta the spider expects of it and the name of the spider's method parsing it
+    as `parse`.
+    """
+    links = synthetic_children(count // 2, 't3')
+    comments = synthetic_children(count - count // 2, 't1')
+    result = []
+
+    for i in range(0, len(links), per_page):
+        url = 'https://www.reddit.com/r/benchmark/new.json?sort=new&count=%d' % (i,)
+        body = json.dumps({'kind': 'Listing', 'data': {'after': None, 'children': links[i:i + per_page]}})
+
+        result.append(TextResponse(url, body=body, encoding='utf-8', request=Request(url,
+            meta={'subreddit_name': 'benchmark', 'parse': 'parse_posts'})))
+
+    for i in range(0, len(comments), per_page):
+        link = links[i // per_page % len(links)]
+        url = 'https://www.reddit.com/r/benchmark/comments/%s/new.json?sort=new' % (link['data']['id'],)
+        body = json.dumps([
+            {'kind': 'Listing', 'data': {'children': [link]}},
+            {'kind': 'Listing', 'data': {'children': comments[i:i + per_page]}},
+        ])
+
+        result.append(TextResponse(url, body=body, encoding='utf-8', request=Request(url,
+            meta={'subreddit_name': 'benchmark', 'parse': 'parse_comments'})))
+
+    return result
+
+
+def measure_end_to_end(count, batch_size=500, decoder='stream'):
+    """
+    Measures parsing synthetic responses with the spider and writing the items it yields with the pipeline. Each
+    item is timed from the end of the last one, so parsing a response counts against its first item.
+
+    Arguments:
+    count: The number of links and comments.
+    batch_size: The number of rows the pipeline writes per transaction.
+    decoder: The name of the decoder the spider parses responses with.
+    """
+    responses = synthetic_responses(count)
+    spider = SubredditSpider(['benchmark'])
+    spider.decoder = get_decoder(decoder)
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        pipeline = SQLiteItemPipeline(os.path.join(directory, 'benchmark.db'), batch_size=batch_size,
+            flush_interval=3600)
+        pipeline.open_spider(spider)
+
+        timer = timeit.default_timer
+        baseline = peak_rss()
+        latencies = []
+
+        start = before = timer()
+
+        for response in responses:
+            for result in getattr(spider, response.meta['parse'])(response):
+                if isinstance(result, (LinkRow, CommentRow)):
+                    pipeline.process_item(result, spider)
+                    latencies.append(timer() - before)
+                    before = timer()
+
+        pipeline.close_spider(spider)
+
+        return summarize('end-to-end', 'batch size %d, %s decoder' % (batch_size, decoder), latencies,
+            timer() - start, baseline)
+    finally:
+        shutil.rmtree(directory)
+
+
+def synthetic_items(count):
+    """
+    Generates links and comments of a synthetic subreddit, whose text varies as much from one comment to the next as
+    a crawl's does, rather than repeating the few of the recorded responses.
+
+    Arguments:
+    count: The number of links and comments.
+
+    Returns:
+    A list of items, each link followed by its comments.
+    """
+    return list(iter_synthetic_items(count))
+
+
+def iter_synthetic_items(count):
+    """
+    Generates the items of `synthetic_items` one at a time, for more of them than fit in memory.
+    """
+    reddit = SyntheticReddit(['benchmark'], posts=count, comments_per_post=50)
+    generated = 0
+
+    for index in range(count):
+        for item in [LinkRow(row=LINKS.convert(reddit.post(0, index)['data']))] + [CommentRow(row=COMMENTS.convert(
+                i['data'])) for i in reddit.comments(0, index)]:
+            yield item
+            generated += 1
+
+            if generated >= count:
+                return
+
+
+def measure_compression(codec, count):
+    """
+    Measures the size of a database of synthetic links and comments with their text columns compressed by a codec,
+    and the latency of reading a comment's text back through the view.
+
+    Arguments:
+    codec: The name of a codec, or `none`.
+    count: The number of items to write, and of comments to read.
+    """
+    items = synthetic_items(count)
+    directory = tempfile.mkdtemp()
+
+    try:
+        database_file = os.path.join(directory, 'benchmark.db')
+
+        pipeline = SQLiteItemPipeline(database_file, flush_interval=3600, compression=codec)
+        pipeline.open_spider(None)
+
+        for item in items:
+            pipeline.process_item(item, None)
+
+        pipeline.close_spider(None)
+
+        connection = connect_reader(database_file)
+        ids = [i[0] for i in connection.execute('select id from comments order by random();')]
+        ids = (ids * (count // max(1, len(ids)) + 1))[:count]
+
+        # from the table rather than the view, whose ids are base-36
+        result = measure_each('compression', codec, lambda i: connection.execute('select decompress(body), '
+            'decompress(body_html) from comments where id = ?;', (i,)).fetchone(), ids)
+
+        connection.close()
+
+        compressor = pipeline.compressor
+
+        result.update({
+            'codec': codec,
+            'database_mb': os.path.getsize(database_file) / 1048576.0,
+            'ratio': float(compressor.bytes_in) / compressor.bytes_out if compressor is not None else 1.0,
+        })
+
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def measure_search(count, queries=200):
+    """
+    Measures rebuilding the full-text indexes of a database of synthetic links and comments, and the latency of
+    searching them for the first page of results of a word, a phrase and a prefix.
+
+    Arguments:
+    count: The number of items to write.
+    queries: The number of searches of each kind.
+
+    Returns:
+    A list of result dictionaries, one for the rebuild and one per kind of search.
+    """
+    items = synthetic_items(count)
+    directory = tempfile.mkdtemp()
+
+    try:
+        database_file = os.path.join(directory, 'benchmark.db')
+
+        pipeline = SQLiteItemPipeline(database_file, flush_interval=3600)
+        pipeline.open_spider(None)
+
+        for item in items:
+            pipeline.process_item(item, None)
+
+        pipeline.close_spider(None)
+
+        connection = connect(database_file)
+        baseline = peak_rss()
+        start = timeit.default_timer()
+
+        with connection:
+            for index in (LINKS_SEARCH, COMMENTS_SEARCH):
+                connection.execute(index.rebuild_statement())
+
+        results = [summarize('search', 'rebuild', [], timeit.default_timer() - start, baseline)]
+        results[0].update({'items': count, 'items_per_second': count / results[0]['seconds']})
+
+        connection.close()
+
+        connection = connect_reader(database_file)
+        words = [i for i in WORDS if len(i) > 3]
+        # the same queries every run, so that runs compare
+        cases = (
+            ('word', lambda i: words[i % len(words)]),
+            ('phrase', lambda i: '"%s %s"' % (WORDS[i % len(WORDS)], WORDS[i * 7 % len(WORDS)])),
+            ('prefix', lambda i: '%s*' % (words[i % len(words)][:3],)),
+        )
+
+        for case, query in cases:
+            results.append(measure_each('search', case, lambda i: search(connection, i).fetchall(),
+                [query(i) for i in range(queries)]))
+
+        connection.close()
+
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def measure_load(bulk_load, count):
+    """
+    Measures loading a new database of synthetic links and comments with the pipeline, normally or in bulk. Only the
+    pipeline is timed, not the generation of the items, but including closing it, when a bulk load builds its
+    indexes.
+
+    Arguments:
+    bulk_load: Whether to load in bulk.
+    count: The number of items to write.
+    """
+    directory = tempfile.mkdtemp()
+    timer = timeit.default_timer
+
+    try:
+        database_file = os.path.join(directory, 'benchmark.db')
+        baseline = peak_rss()
+
+        pipeline = SQLiteItemPipeline(database_file, bulk_load=bulk_load)
+        pipeline.open_spider(None)
+
+        seconds = 0.0
+
+        for item in iter_synthetic_items(count):
+            start = timer()
+            pipeline.process_item(item, None)
+            seconds += timer() - start
+
+        start = timer()
+        pipeline.close_spider(None)
+        finish = timer() - start
+
+        result = summarize('load', 'bulk' if bulk_load else 'normal', [], seconds + finish, baseline)
+        result.update({
+            'items': count,
+            'items_per_second': count / (seconds + finish),
+            'finish_seconds': finish,
+            'database_mb': os.path.getsize(database_file) / 1048576.0,
+        })
+
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def measure_export(format, count):
+    """
+    Measures exporting a database of synthetic links and comments, their text compressed, into a format.
+
+    Arguments:
+    format: The name of an export format.
+    count: The number of items to write, and export.
+    """
+    directory = tempfile.mkdtemp()
+
+    try:
+        database_file = os.path.join(directory, 'benchmark.db')
+
+        pipeline = SQLiteItemPipeline(database_file, flush_interval=3600, compression='zlib')
+        pipeline.open_spider(None)
+
+        for item in iter_synthetic_items(count):
+            pipeline.process_item(item, None)
+
+        pipeline.close_spider(None)
+
+        connection = connect_reader(database_file)
+        baseline = peak_rss()
+        results = [export_table(connection, i, os.path.join(directory, 'export'), format) for i in (LINKS, COMMENTS)]
+        connection.close()
+
+        seconds = sum(i['seconds'] for i in results)
+        result = summarize('export', format, [], seconds, baseline)
+        result.update({
+            'items': sum(i['rows'] for i in results),
+            'items_per_second': sum(i['rows'] for i in results) / seconds,
+            'megabytes_per_second': sum(i['bytes'] for i in results) / 1048576.0 / seconds,
+        })
+
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_isolated(function, *args):
+    """
+    Runs a function in a new process and returns its result.
+    """
+    pool = multiprocessing.Pool(1)
+
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def benchmark_ids(count=100000):
+    """
+    Measures parsing ids with the spider's parser and with the item serializer.
+
+    Arguments:
+    count: The number of ids to parse.
+
+    Returns:
+    A list of result dictionaries, one per method.
+    """
+    return [run_isolated(measure_ids, method, count) for method in ('get_raw_id', 'id_serializer')]
+
+
+def benchmark_items(count=20000):
+    """
+    Measures building, serializing and converting links and comments.
+
+    Arguments:
+    count: The number of items of each kind.
+
+    Returns:
+    A list of result dictionaries, one per method and kind.
+    """
+    return [run_isolated(measure_items, method, kind, count) for kind in ('t3', 't1')
+        for method in ('build', 'serialize', 'convert')]
+
+
+def benchmark_decoders(size=8 * 1024 * 1024, decoders=None, repeat=3):
+    """
+    Measures the parse time and peak memory per MB of each decoder on each recorded response, scaled up to a given
+    size.
+
+    Arguments:
+    size: The size in bytes to scale each recorded response to.
+    decoders: The names of the decoders to measure, defaults to every decoder available.
+    repeat: The number of times each document is decoded, of which the fastest is reported.
+
+    Returns:
+    A list of result dictionaries, one per response and decoder.
+    """
+    results = []
+
+    for name, prefix in FIXTURES:
+        with open(fixture_path(name), 'rb') as f:
+            body = scale_document(f.read(), prefix, size)
+
+        handle, path = tempfile.mkstemp(suffix='.json')
+
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(body)
+
+            megabytes = len(body) / 1048576.0
+
+            for decoder in decoders or sorted(DECODERS.keys()):
+                try:
+                    get_decoder(decoder)
+                except UnknownDecoderException as e:
+                    logger.warning("Skipping the %s decoder: %s", decoder, e)
+                    continue
+
+                result = run_isolated(measure_decoder, path, prefix, decoder, repeat)
+
+                result.update({
+                    'case': '%s %s' % (name, decoder),
+                    'fixture': name,
+                    'decoder': decoder,
+                    'megabytes': megabytes,
+                    'seconds_per_mb': result['seconds'] / megabytes,
+                    'peak_rss_per_mb': result['peak_rss_mb'] / megabytes,
+                })
+
+                results.append(result)
+        finally:
+            os.remove(path)
+
+    return results
+
+
+def serialize_fields(item, columns):
+    """
+    Serializes an item field by field, looking up each field's serializer as it goes; the way items were written
+    before the schema compiled converters, kept as the baseline for them.
+
+    Arguments:
+    item: The Link or Comment item to serialize.
+    columns: The column names of the row, in order.
+
+    Returns:
+    A tuple of column values in the order of `columns`.
+    """
+    result = []
+
+    for column in columns:
+        value = item.get(column)
+        serializer = item.fields[column].get('serializer')
+
+        if value is not None and serializer is not None:
+            value = serializer(value)
+
+        result.append(value)
+
+    return tuple(result)
+
+
+def benchmark_converters(count=100000):
+    """
+    Measures the number of listing children converted into rows per second on each recorded response: building an
+    item and serializing it field by field, building an item and serializing it with the schema's compiled serializer,
+    and converting the raw child straight into a row with the schema's compiled converter, as the spider does.
+
+    Arguments:
+    count: The number of children to convert in each measurement, cycling through those of the response.
+
+    Returns:
+    A list of result dictionaries, one per response and method.
+    """
+    spider = SubredditSpider([])
+    results = []
+
+    for name, prefix in FIXTURES:
+        with open(fixture_path(name), 'rb') as f:
+            children = [i for i in get_decoder('json').iter_items(f.read(), prefix) if i['kind'] in KINDS]
+
+        children = (children * (count // len(children) + 1))[:count]
+
+        methods = (
+            ('fields', lambda cls, schema, data: serialize_fields(spider.build_item(cls, data), schema.columns)),
+            ('items', lambda cls, schema, data: schema.serialize(spider.build_item(cls, data))),
+            ('compiled', lambda cls, schema, data: schema.convert(data)),
+        )
+
+        for method, convert in methods:
+            start = time.time()
+
+            for child in children:
+                convert(*(KINDS[child['kind']] + (child['data'],)))
+
+            seconds = time.time() - start
+
+            results.append({
+                'benchmark': 'converters',
+                'case': '%s %s' % (name, method),
+                'fixture': name,
+                'method': method,
+                'items': count,
+                'seconds': seconds,
+                'items_per_second': count / seconds,
+            })
+
+    return results
+
+
+def benchmark_store(batch_sizes=BATCH_SIZES, count=20000):
+    """
+    Measures writing items with the pipeline at each of a number of batch sizes.
+
+    Arguments:
+    batch_sizes: The batch sizes to measure.
+    count: The number of items to write at each batch size.
+
+    Returns:
+    A list of result dictionaries, one per batch size.
+    """
+    return [run_isolated(measure_store, i, count) for i in batch_sizes]
+
+
+def benchmark_end_to_end(count=20000, batch_size=500):
+    """
+    Measures parsing synthetic responses and writing their items, with the default decoder.
+
+    Arguments:
+    count: The number of links and comments.
+    batch_size: The number of rows the pipeline writes per transaction.
+
+    Returns:
+    A list holding a single result dictionary.
+    """
+    return [run_isolated(measure_end_to_end, count, batch_size)]
+
+
+def benchmark_compression(count=20000, codecs=None):
+    """
+    Measures the size of the database against the latency of reading compressed text, storing it as it is and with
+    each codec.
+
+    Arguments:
+    count: The number of items to write, and of comments to read.
+    codecs: The names of the codecs to measure, defaults to every codec available and `none`.
+
+    Returns:
+    A list of result dictionaries, one per codec.
+    """
+    results = []
+
+    for codec in codecs or ['none'] + sorted(CODECS.keys()):
+        try:
+            if codec != 'none':
+                get_codec(codec)
+        except UnknownCodecException as e:
+            logger.warning("Skipping the %s codec: %s", codec, e)
+            continue
+
+        results.append(run_isolated(measure_compression, codec, count))
+
+    return results
+
+
+def benchmark_search(count=20000):
+    """
+    Measures rebuilding the full-text indexes of a synthetic archive and searching it.
+
+    Arguments:
+    count: The number of links and comments in the archive.
+
+    Returns:
+    A list of result dictionaries, one for the rebuild and one per kind of search.
+    """
+    return run_isolated(measure_search, count)
+
+
+def benchmark_load(count=20000):
+    """
+    Measures loading a new database normally and in bulk.
+
+    Arguments:
+    count: The number of links and comments to load.
+
+    Returns:
+    A list of result dictionaries, one per mode.
+    """
+    return [run_isolated(measure_load, i, count) for i in (False, True)]
+
+
+def benchmark_export(count=20000, formats=None):
+    """
+    Measures exporting a synthetic archive into each format.
+
+    Arguments:
+    count: The number of links and comments in the archive.
+    formats: The names of the formats to measure, defaults to every format available.
+
+    Returns:
+    A list of result dictionaries, one per format.
+    """
+    results = []
+
+    for format in formats or sorted(FORMATS.keys()):
+        try:
+            check_format(format)
+        except UnknownFormatException as e:
+            logger.warning("Skipping the %s format: %s", format, e)
+            continue
+
+        results.append(run_isolated(measure_export, format, count))
+
+    return results
+
+
+"""
+The benchmarks by name in the order they're run, each a function of the parsed command line arguments.
+"""
+BENCHMARKS = (
+    ('ids', lambda args: benchmark_ids(args.count)),
+    ('items', lambda args: benchmark_items(args.count)),
+    ('decoders', lambda args: benchmark_decoders(int(args.size * 1048576), args.decoder, args.repeat)),
+    ('converters', lambda args: benchmark_converters(args.count)),
+    ('store', lambda args: benchmark_store(args.batch_size or BATCH_SIZES, args.count)),
+    ('end-to-end', lambda args: benchmark_end_to_end(args.count)),
+    ('compression', lambda args: benchmark_compression(args.count, args.codec)),
+    ('search', lambda args: benchmark_search(args.count)),
+    ('load', lambda args: benchmark_load(args.count)),
+    ('export', lambda args: benchmark_export(args.count, args.format)),
+)
+
+
+def save_results(path, results):
+    """
+    Saves results as JSON, along with what they were measured on.
+
+    Arguments:
+    path: The path of the file to write.
+    results: A list of result dictionaries.
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'timestamp': time.time(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def compare_results(baseline, results):
+    """
+    Compares results with those of an earlier run.
+
+    Arguments:
+    baseline: The contents of a file written by `save_results`.
+    results: A list of result dictionaries.
+
+    Returns:
+    A list of tuples of the benchmark, the case, the earlier and the current items per second, and their ratio, for
+    every case measured by both runs.
+    """
+    earlier = dict(((i['benchmark'], i['case']), i) for i in baseline['results'])
+    comparison = []
+
+    for result in results:
+        key = (result['benchmark'], result['case'])
+
+        if earlier.get(key, {}).get('items_per_second') and result.get('items_per_second'):
+            comparison.append(key + (earlier[key]['items_per_second'], result['items_per_second'],
+                result['items_per_second'] / earlier[key]['items_per_second']))
+
+    return comparison
+
+
+def format_value(value, format):
+    """
+    Formats a value of a result, which some benchmarks don't measure.
+    """
+    return format % (value,) if value is not None else '-'
+
+
+def main():
+    names = [i[0] for i in BENCHMARKS]
+
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-benchmark',
+        description="Measures the throughput of each stage of a crawl on its own and of all of them together, on the "
+                    "recorded responses and on synthetic data.")
+    # not validated by choices, which python 2.7's argparse applies to an empty list as well
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+        help="The benchmarks to run, any of %s; defaults to all of them." % (', '.join(names),))
+    parser.add_argument('--count', type=int, default=20000,
+        help="The number of ids or items measured by each benchmark but the decoders.")
+    parser.add_argument('--batch-size', type=int, action='append',
+        help="A batch size to measure the store benchmark at, defaults to %s." % (
+            ', '.join(str(i) for i in BATCH_SIZES),))
+    parser.add_argument('--size', type=float, default=8.0,
+        help="The size in MB to scale each recorded response to.")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="The number of times to decode each response, of which the fastest is reported.")
+    parser.add_argument('--decoder', action='append', choices=sorted(DECODERS.keys()),
+        help="A decoder to measure, defaults to every decoder available.")
+    parser.add_argument('--codec', action='append', choices=['none'] + sorted(CODECS.keys()),
+        help="A compression codec to measure, defaults to every codec available and none.")
+    parser.add_argument('--format', action='append', choices=sorted(FORMATS.keys()),
+        help="An export format to measure, defaults to every format available.")
+    parser.add_argument('-o', '--output',
+        help="A file to save the results to as JSON.")
+    parser.add_argument('-c', '--compare',
+        help="A file of results saved by an earlier run to compare the throughput of this one with.")
+
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark %s, expected one of %s" % (name, ', '.join(names)))
+
+    logging.basicConfig(level=logging.WARNING, format="[%(levelname)s] %(message)s")
+
+    results = []
+
+    for name, benchmark in BENCHMARKS:
+        if not args.benchmarks or name in args.benchmarks:
+            results.extend(benchmark(args))
+
+    print '%-12s %-42s %9s %12s %10s %10s %9s' % ('benchmark', 'case', 'items', 'items/sec', 'p50 us', 'p99 us',
+        'peak MB')
+
+    for result in results:
+        print '%-12s %-42s %9d %12s %10s %10s %9s' % (result['benchmark'], result['case'], result['items'],
+            format_value(result.get('items_per_second'), '%.0f'), format_value(result.get('p50_us'), '%.1f'),
+            format_value(result.get('p99_us'), '%.1f'), format_value(result.get('peak_rss_mb'), '%.1f'))
+
+    sizes = [i for i in results if 'database_mb' in i]
+
+    if sizes:
+        print
+        print '%-12s %-42s %12s %9s %10s' % ('benchmark', 'case', 'database MB', 'ratio', 'p50 us')
+
+        for result in sizes:
+            print '%-12s %-42s %12.1f %9s %10s' % (result['benchmark'], result['case'], result['database_mb'],
+                format_value(result.get('ratio'), '%.2f'), format_value(result.get('p50_us'), '%.1f'))
+
+    if args.output:
+        save_results(args.output, results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            comparison = compare_results(json.load(f), results)
+
+        print
+        print '%-12s %-42s %12s %12s %8s' % ('benchmark', 'case', 'before', 'after', 'change')
+
+        for benchmark, case, before, after, ratio in comparison:
+            print '%-12s %-42s %12.0f %12.0f %+7.1f%%' % (benchmark, case, before, after, (ratio - 1) * 100)
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,39 @@ import os
 import scrapy
 import sys
 
-from scrapy.process import CrawlerProcess
+from scrapy.crawler import CrawlerProcess
+from subredditscraper.compression import CODECS
+from subredditscraper.database import PROFILES, READ_PROFILES
+from subredditscraper.decoders import DECODERS
+from subredditscraper import synthetic
 from subredditscraper.spiders import SubredditSpider
 
 logger = logging.getLogger('subredditscraper.cli')
 
+
+def read_subreddit_file(path):
+    """
+    Reads subreddit names from a file, one per line. Blank lines and lines starting with `#` are ignored, as is an
+    `/r/` prefix.
+
+    Arguments:
+    path: The path of the file to read.
+
+    Returns:
+    A list of subreddit names.
+    """
+    result = []
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+
+            if line and not line.startswith('#'):
+                result.append(line[3:] if line.startswith('/r/') else line)
+
+    return result
+
+
 def main():
     parser = argparse.ArgumentParser(prog='reddit-sub-scraper',
         description="A utility for downloading a subreddit's posts and comments.")
@@ -19,34 +47,131 @@ def main():
         help="Set verboseness. Pass once for info-level logs, twice for debug-level logs.")
     parser.add_argument('-d', '--database-file', default="subreddits.db",
         help="The database file to save posts to.")
-    parser.add_argument('subreddit', nargs=1,
+    parser.add_argument('--batch-size', type=int, default=500,
+        help="The number of rows to buffer before writing them to the database in a single transaction.")
+    parser.add_argument('--flush-interval', type=float, default=5.0,
+        help="The maximum number of seconds to buffer rows before writing them to the database.")
+    parser.add_argument('--writer-thread', action='store_true',
+        help="Write to the database from a dedicated thread so that slow commits don't stall the crawl.")
+    parser.add_argument('--queue-size', type=int, default=10000,
+        help="The maximum number of rows waiting for the writer thread.")
+    parser.add_argument('--profile', choices=sorted(PROFILES.keys()), default='wal',
+        help="The connection profile used to write to the database.")
+    parser.add_argument('--read-profile', choices=READ_PROFILES, default='reader',
+        help="The connection profile used to read from the database during a crawl; only those leaving the journal "
+             "mode alone.")
+    parser.add_argument('--bulk-load', action='store_true',
+        help="Load a new archive as fast as possible, building its indexes once the crawl finishes, in transactions "
+             "of at least 50000 rows and without syncing to disk. A crash may corrupt the database; start over if "
+             "it does.")
+    parser.add_argument('--compression', choices=['none'] + sorted(CODECS.keys()), default='none',
+        help="Compress the large text columns, such as comment bodies, with a dictionary trained on the archive. The "
+             "views decompress them; zstd requires the zstandard package.")
+    parser.add_argument('--decoder', choices=sorted(DECODERS.keys()), default='stream',
+        help="The JSON decoder used to parse responses; see subreddit-scraper-benchmark for how they compare.")
+    parser.add_argument('--no-rate-limit', action='store_false', dest='rate_limit',
+        help="Don't pace requests by Reddit's rate limit headers, only by a fixed two second delay.")
+    parser.add_argument('--replay', metavar='DIR',
+        help="Serve requests from the responses recorded in a directory, laid out as in the package's "
+             "fixtures directory, rather than from Reddit. Requests without a recording get a 404.")
+    parser.add_argument('--synthetic', action='store_true',
+        help="Serve requests from synthetic subreddits of the given names, generated as they're requested, rather "
+             "than from Reddit; see the synthetic subreddit arguments.")
+    parser.add_argument('--cache-dir', metavar='DIR',
+        help="Cache responses in a directory, so that crawling again soon after, say after a crash, doesn't download "
+             "everything again.")
+    parser.add_argument('--cache-size', type=float, default=256.0,
+        help="The maximum size of the response cache in MB, beyond which the least recently used responses are "
+             "evicted.")
+    parser.add_argument('-i', '--incremental', action='store_true',
+        help="Only crawl posts newer than the newest post already stored for the subreddit.")
+    parser.add_argument('-r', '--refresh', action='store_true',
+        help="Fetch the stored posts of each subreddit again by their ids to update their scores and comment counts, "
+             "rather than crawling its listing.")
+    parser.add_argument('--overlap', type=int, default=86400,
+        help="In incremental mode, the number of seconds before the newest stored post to keep crawling.")
+    parser.add_argument('-f', '--subreddit-file', action='append', default=[],
+        help="A file listing the names of subreddits to download, one per line.")
+    parser.add_argument('subreddit', nargs='*',
         help="The name of the subreddits you wish to download.")
 
+    synthetic.add_arguments(parser)
+
     args = parser.parse_args()
 
+    subreddit_names = list(args.subreddit)
+
+    for path in args.subreddit_file:
+        subreddit_names.extend(read_subreddit_file(path))
+
+    if not subreddit_names:
+        parser.error("at least one subreddit or subreddit file is required")
+
     # configure basic logging; for every time -v is passed, deduct 10 from WARNING,
     # allowing no further than 0.
-    logging.basicConfig(level=max(logging.WARNING - (len(args.verbosity) * 10), 0),
+    logging.basicConfig(level=max(logging.WARNING - (len(args.verbosity or []) * 10), 0),
         format="[%(levelname)s] %(message)s")
 
     logging.debug("Program Arguments: %s", args)
 
     # okay, now do the actual indexing
-    logger.info("Running crawler for the %s subreddit.", subreddit)
+    logger.info("Running crawler for the %s subreddits.", ', '.join(subreddit_names))
+
+    if args.replay and not os.path.isdir(args.replay):
+        parser.error("the replay directory %s doesn't exist" % (args.replay,))
+
+    if args.replay and args.synthetic:
+        parser.error("--replay and --synthetic can't be used together")
+
+    # neither replayed nor synthetic responses come from Reddit
+    offline = bool(args.replay or args.synthetic)
 
-    # instantiate the crawler process
-    process = scrapy.crawler.CrawlerProcess({
+    # instantiate the crawler process; one spider crawls every subreddit so that they share one rate budget
+    process = CrawlerProcess({
         'BOT_NAME': 'subreddit-scraper-0.0.1',
-        'DOWNLOAD_DELAY': 2, # seconds I hope
+        # seconds I hope; with rate limiting, only until Reddit tells us our allowance. replayed and synthetic
+        # responses never reach the downloader, so aren't delayed either way
+        'DOWNLOAD_DELAY': 2,
         'RANDOMIZE_DOWNLOAD_DELAY': False, # no thanks bro
         'CONCURRENT_REQUESTS_PER_DOMAIN': 1, # reddit hates,
         'DATABASE_FILE': args.database_file,
+        'DATABASE_BATCH_SIZE': args.batch_size,
+        'DATABASE_FLUSH_INTERVAL': args.flush_interval,
+        'DATABASE_WRITER_THREAD': args.writer_thread,
+        'DATABASE_QUEUE_SIZE': args.queue_size,
+        'DATABASE_PROFILE': args.profile,
+        'DATABASE_READ_PROFILE': args.read_profile,
+        'DATABASE_COMPRESSION': args.compression,
+        'DATABASE_BULK_LOAD': args.bulk_load,
+        'JSON_DECODER': args.decoder,
+        'RATELIMIT_ENABLED': args.rate_limit and not offline,
+        'REPLAY_DIR': args.replay,
+        'SYNTHETIC_ENABLED': args.synthetic,
+        'SYNTHETIC_SEED': args.seed,
+        'SYNTHETIC_POSTS': args.posts,
+        'SYNTHETIC_COMMENTS_PER_POST': args.comments_per_post,
+        'SYNTHETIC_DEPTH': args.depth,
+        'SYNTHETIC_BODY_LENGTH': args.body_length,
+        'SYNTHETIC_EDIT_RATE': args.edit_rate,
+        'HTTPCACHE_ENABLED': bool(args.cache_dir) and not offline,
+        'HTTPCACHE_DIR': os.path.abspath(args.cache_dir or 'httpcache'),
+        'HTTPCACHE_MAX_BYTES': int(args.cache_size * 1048576),
+        'HTTPCACHE_POLICY': 'subredditscraper.httpcache.EndpointPolicy',
+        'HTTPCACHE_STORAGE': 'subredditscraper.httpcache.CompressedCacheStorage',
+        'DOWNLOADER_MIDDLEWARES': {
+            'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+            'subredditscraper.middlewares.CacheMiddleware': 900,
+            'subredditscraper.middlewares.RateLimitMiddleware': 950,
+            'subredditscraper.middlewares.ReplayMiddleware': 960,
+            'subredditscraper.middlewares.SyntheticMiddleware': 970,
+        },
         'ITEM_PIPELINES': {
             'subredditscraper.pipelines.SQLiteItemPipeline': 100,
         }
     })
 
-    process.crawl(SubredditSpider, subreddit_name=args.subreddit)
+    process.crawl(SubredditSpider, subreddit_names=subreddit_names, incremental=args.incremental,
+        overlap=args.overlap, refresh=args.refresh)
     process.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,377 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import logging
+import sqlite3
+import struct
+import time
+import zlib
+
+from subredditscraper.exceptions import UnknownCodecException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('subredditscraper.compression')
+
+
+"""
+The header of a compressed value: the number of its codec in `CODEC_NUMBERS`, and the id of the dictionary it was
+compressed with in the `compression_dictionaries` table, 0 for none. Compressed values are stored as blobs and
+uncompressed ones as text, so the two can be told apart and mixed freely within a column.
+"""
+HEADER = struct.Struct('>BH')
+
+
+"""
+Values shorter than this many bytes are stored as they are, as compressing them saves next to nothing.
+"""
+MIN_LENGTH = 64
+
+
+"""
+The number of values sampled to train a dictionary on.
+"""
+TRAINING_SAMPLES = 2000
+
+
+"""
+The statement creating the table of trained dictionaries.
+"""
+DICTIONARY_TABLE = ('create table if not exists compression_dictionaries (id integer primary key, codec text not null, '
+    'dictionary blob not null, created_utc integer not null);')
+
+
+class ZlibCodec(object):
+    """
+    Compresses values into raw deflate streams. Python 2's zlib can't be given a preset dictionary, so instead a
+    compressor is primed by compressing the dictionary and syncing, and copied for every value, so that a value may
+    refer back to the dictionary; a decompressor is primed likewise with the compressed dictionary. Only the last
+    32 KB of a dictionary can be referred back to.
+    """
+
+    # the most of a dictionary a deflate stream can refer back to
+    dictionary_size = 32768
+
+    def __init__(self, dictionary=None, level=6):
+        """
+        Constructor for the ZlibCodec.
+
+        Arguments:
+        dictionary: The dictionary to compress with, as trained by `train`, if any.
+        level: The compression level, from 1 to 9.
+        """
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+
+        if dictionary:
+            primed = self.compressor.compress(dictionary) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.decompressor.decompress(primed)
+
+
+    @classmethod
+    def train(cls, samples):
+        """
+        Trains a dictionary on a list of sample values: the most recent of them, which deflate finds matches in
+        nearest, up to the size it can refer back to.
+        """
+        return ''.join(samples)[-cls.dictionary_size:]
+
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+
+        return compressor.compress(data) + compressor.flush()
+
+
+    def decompress(self, data):
+        decompressor = self.decompressor.copy()
+
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+class ZstdCodec(object):
+    """
+    Compresses values into zstd frames, without the checksum or dictionary id a frame usually carries. Requires the
+    zstandard package.
+    """
+
+    # the size of the dictionaries trained, zstd's default
+    dictionary_size = 112640
+
+    def __init__(self, dictionary=None, level=3):
+        """
+        Constructor for the ZstdCodec.
+
+        Arguments:
+        dictionary: The dictionary to compress with, as trained by `train`, if any.
+        level: The compression level, from 1 to 22.
+        """
+        if zstandard is None:
+            raise UnknownCodecException('The zstd codec requires the zstandard package to be installed.')
+
+        dictionary = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+
+        self.compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary, write_checksum=False,
+            write_content_size=True, write_dict_id=False)
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+
+    @classmethod
+    def train(cls, samples):
+        """
+        Trains a dictionary on a list of sample values.
+        """
+        if zstandard is None:
+            raise UnknownCodecException('The zstd codec requires the zstandard package to be installed.')
+
+        return zstandard.train_dictionary(cls.dictionary_size, samples).as_bytes()
+
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+"""
+The codecs available by name.
+"""
+CODECS = {
+    'zlib': ZlibCodec,
+    'zstd': ZstdCodec,
+}
+
+
+"""
+The numbers identifying the codecs in the header of compressed values. Never renumber them.
+"""
+CODEC_NUMBERS = {
+    'zlib': 1,
+    'zstd': 2,
+}
+
+
+def get_codec(name, dictionary=None):
+    """
+    Creates a codec by name.
+
+    Arguments:
+    name: The name of a codec in `CODECS`.
+    dictionary: The dictionary to compress with, if any.
+
+    Returns:
+    A codec with `compress(data)` and `decompress(data)` methods.
+    """
+    if name not in CODECS:
+        raise UnknownCodecException('%s is not a known compression codec, expected one of %s.' % (name,
+            ', '.join(sorted(CODECS.keys()))))
+
+    return CODECS[name](dictionary)
+
+
+def load_dictionary(connection, dictionary_id):
+    """
+    Returns the codec and the contents of a stored dictionary, or None if there is no such dictionary.
+    """
+    row = connection.execute('select codec, dictionary from compression_dictionaries where id = ?;',
+        (dictionary_id,)).fetchone()
+
+    return (row[0], str(row[1])) if row is not None else None
+
+
+class Compressor(object):
+    """
+    Compresses the text columns of rows with a codec and the newest dictionary trained for it on the archive. If the
+    archive has no dictionary yet, one is trained once `TRAINING_SAMPLES` values have been compressed without one, on
+    those values, and stored in the `compression_dictionaries` table.
+
+    Values are compressed deterministically, so that a row crawled again compresses into the same blobs and is
+    recognized as unchanged; only a new dictionary changes them.
+    """
+
+    def __init__(self, codec, training_samples=TRAINING_SAMPLES):
+        """
+        Constructor for the Compressor.
+
+        Arguments:
+        codec: The name of a codec in `CODECS`.
+        training_samples: The number of values to train a dictionary on, or 0 to never train one.
+        """
+        self.codec = get_codec(codec)
+        self.codec_name = codec
+        self.number = CODEC_NUMBERS[codec]
+        self.training_samples = training_samples
+
+        self.dictionary_id = 0
+        self.samples = []
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+
+    def load(self, connection):
+        """
+        Loads the newest dictionary stored for the codec, creating the table of dictionaries if necessary.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        with connection:
+            connection.execute(DICTIONARY_TABLE)
+
+        row = connection.execute('select id, dictionary from compression_dictionaries where codec = ? order by id desc '
+            'limit 1;', (self.codec_name,)).fetchone()
+
+        if row is not None:
+            self.dictionary_id = row[0]
+            self.codec = get_codec(self.codec_name, str(row[1]))
+            self.samples = []
+
+            logger.info("Compressing with %s dictionary %d of %d bytes.", self.codec_name, row[0], len(row[1]))
+
+
+    def train(self, connection):
+        """
+        Trains a dictionary on the values sampled so far and stores it, inside of the caller's transaction.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        started = time.time()
+
+        try:
+            dictionary = self.codec.train(self.samples)
+        except Exception:
+            logger.warning("Couldn't train a %s dictionary, compressing without one.", self.codec_name, exc_info=True)
+            self.training_samples = 0
+            return
+        finally:
+            self.samples = []
+
+        self.dictionary_id = connection.execute('insert into compression_dictionaries (codec, dictionary, created_utc) '
+            'values (?, ?, ?);', (self.codec_name, sqlite3.Binary(dictionary), int(time.time()))).lastrowid
+        self.codec = get_codec(self.codec_name, dictionary)
+
+        logger.info("Trained %s dictionary %d of %d bytes in %.2f seconds.", self.codec_name, self.dictionary_id,
+            len(dictionary), time.time() - started)
+
+
+    def compress(self, value):
+        """
+        Compresses a text value, unless it's too short or doesn't get any smaller.
+
+        Arguments:
+        value: The value of a text column.
+
+        Returns:
+        A blob of the header and the compressed value, or the value as it was.
+        """
+        if not isinstance(value, basestring):
+            return value
+
+        data = value.encode('utf-8') if isinstance(value, unicode) else value
+        self.bytes_in += len(data)
+
+        if len(data) >= MIN_LENGTH:
+            compressed = HEADER.pack(self.number, self.dictionary_id) + self.codec.compress(data)
+
+            if len(compressed) < len(data):
+                self.bytes_out += len(compressed)
+                return sqlite3.Binary(compressed)
+
+        self.bytes_out += len(data)
+
+        return value
+
+
+    def compress_rows(self, connection, rows, indexes):
+        """
+        Compresses the text columns of rows, training a dictionary first if enough values have been sampled. Call it
+        inside of a transaction, which the new dictionary is stored in.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        rows: A list of row tuples.
+        indexes: The indexes of the columns to compress.
+
+        Returns:
+        A list of the rows with those columns compressed.
+        """
+        if not indexes:
+            return rows
+
+        if not self.dictionary_id and self.training_samples:
+            for row in rows:
+                self.samples.extend(row[i].encode('utf-8') if isinstance(row[i], unicode) else row[i] for i in indexes
+                    if isinstance(row[i], basestring) and len(row[i]) >= MIN_LENGTH)
+
+            if len(self.samples) >= self.training_samples:
+                self.train(connection)
+
+        result = []
+
+        for row in rows:
+            row = list(row)
+
+            for i in indexes:
+                row[i] = self.compress(row[i])
+
+            result.append(tuple(row))
+
+        return result
+
+
+class Decompressor(object):
+    """
+    The `decompress()` SQL function: decompresses a value compressed by a Compressor, and returns any other value as
+    it is. The dictionaries values were compressed with are read from the connection's database as they're needed.
+    """
+
+    def __init__(self, connection):
+        """
+        Constructor for the Decompressor.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        self.connection = connection
+        # codecs by codec number and dictionary id
+        self.codecs = {}
+
+
+    def __call__(self, value):
+        if not isinstance(value, buffer):
+            return value
+
+        value = str(value)
+        number, dictionary_id = HEADER.unpack_from(value)
+
+        if (number, dictionary_id) not in self.codecs:
+            self.codecs[(number, dictionary_id)] = self.get_codec(number, dictionary_id)
+
+        return self.codecs[(number, dictionary_id)].decompress(value[HEADER.size:]).decode('utf-8')
+
+
+    def get_codec(self, number, dictionary_id):
+        """
+        Creates the codec decompressing values with a given header.
+        """
+        names = dict((v, k) for k, v in CODEC_NUMBERS.items())
+
+        if number not in names:
+            raise UnknownCodecException('%d is not the number of a known compression codec.' % (number,))
+
+        if not dictionary_id:
+            return get_codec(names[number])
+
+        found = load_dictionary(self.connection, dictionary_id)
+
+        if found is None:
+            raise UnknownCodecException('Compression dictionary %d is missing.' % (dictionary_id,))
+
+        return get_codec(found[0], found[1])
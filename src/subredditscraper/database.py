@@ -0,0 +1,137 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from subredditscraper.compression import Decompressor
+from subredditscraper.exceptions import UnknownProfileException
+from subredditscraper.ids import decode_id, encode_id
+
+
+"""
+Named sets of pragmas applied to every connection made to an archive database. Pragmas are applied in the order listed.
+
+safe:   SQLite's defaults; a rollback journal which locks readers out while writing and a full sync on every commit.
+wal:    Write-ahead logging, so readers never block the writer and vice versa, with a normal sync which only loses
+        the last transactions (but never corrupts the database) on power loss. The default for crawling.
+reader: Large caches for analysts and export tools reading a live archive; leaves the journal mode alone as changing
+        it requires a write.
+bulk:   For loading a new archive in bulk: the journal kept in memory and no syncs at all, so a crash or power loss
+        may corrupt the database, which is then loaded again from scratch. Never use it on an archive worth keeping.
+"""
+PROFILES = {
+    'safe': (
+        ('busy_timeout', 5000),
+        ('journal_mode', 'delete'),
+        ('synchronous', 'full'),
+    ),
+    'wal': (
+        ('busy_timeout', 5000),
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('cache_size', -65536),
+        ('mmap_size', 268435456),
+        ('temp_store', 'memory'),
+    ),
+    'reader': (
+        ('busy_timeout', 5000),
+        ('cache_size', -65536),
+        ('mmap_size', 268435456),
+        ('temp_store', 'memory'),
+    ),
+    'bulk': (
+        ('busy_timeout', 5000),
+        ('journal_mode', 'memory'),
+        ('synchronous', 'off'),
+        ('cache_size', -262144),
+        ('mmap_size', 268435456),
+        ('temp_store', 'memory'),
+    ),
+}
+
+
+"""
+The pragmas which change how the database file itself is written, rather than only the connection setting them: the
+journal mode persists in the file, and switching it takes a write lock. Read-only connections leave them alone.
+"""
+WRITER_PRAGMAS = ('journal_mode', 'synchronous')
+
+
+"""
+The names of the profiles meant for read-only connections, those without any of the `WRITER_PRAGMAS`.
+"""
+READ_PROFILES = tuple(sorted(i for i in PROFILES if not any(name in WRITER_PRAGMAS for name, value in PROFILES[i])))
+
+
+def apply_profile(connection, profile, skip=()):
+    """
+    Applies the pragmas of a named profile to a connection.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    profile: The name of a profile in `PROFILES`.
+    skip: The names of pragmas of the profile to leave alone.
+    """
+    if profile not in PROFILES:
+        raise UnknownProfileException('%s is not a known connection profile, expected one of %s.' % (profile,
+            ', '.join(sorted(PROFILES.keys()))))
+
+    for name, value in PROFILES[profile]:
+        if name not in skip:
+            connection.execute('pragma %s = %s;' % (name, value))
+
+
+def register_functions(connection):
+    """
+    Registers the SQL functions used by the views and queries of an archive database:
+
+    base36(id):        Encodes an integer id into its base-36 form.
+    base36_decode(id): Decodes a base-36 id, with or without its type prefix, into an integer.
+    decompress(value): Decompresses a text column compressed by `subredditscraper.compression`.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    """
+    connection.create_function('base36', 1, encode_id)
+    connection.create_function('base36_decode', 1, lambda a: decode_id(a) if a is not None else None)
+    connection.create_function('decompress', 1, Decompressor(connection))
+
+
+def connect(database_file, profile='wal', skip=()):
+    """
+    Opens a connection to an archive database with a given profile applied and its SQL functions registered.
+
+    Arguments:
+    database_file: The path to the database file.
+    profile: The name of a profile in `PROFILES`.
+    skip: The names of pragmas of the profile to leave alone.
+
+    Returns:
+    A properly configured SQLite connection object.
+    """
+    result = sqlite3.connect(database_file)
+    result.row_factory = sqlite3.Row
+
+    register_functions(result)
+    apply_profile(result, profile, skip)
+
+    return result
+
+
+def connect_reader(database_file, profile='reader'):
+    """
+    Opens a read-only connection to an archive database. On a database in WAL mode, readers see the last committed
+    state and never block, nor are blocked by, a running crawl. The `WRITER_PRAGMAS` of the profile are left alone,
+    so that a reader never switches the journal mode of a live archive, nor waits on its writer to do so.
+
+    Arguments:
+    database_file: The path to the database file.
+    profile: The name of a profile in `PROFILES`, preferably one of `READ_PROFILES`.
+
+    Returns:
+    A properly configured SQLite connection object which refuses all writes.
+    """
+    result = connect(database_file, profile, WRITER_PRAGMAS)
+    result.execute('pragma query_only = 1;')
+
+    return result
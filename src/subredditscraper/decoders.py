@@ -0,0 +1,291 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import importlib
+import io
+import json
+import re
+
+from decimal import Decimal
+from subredditscraper.exceptions import UnknownDecoderException
+
+try:
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ObjectBuilder = None
+
+# the fastest ijson backend installed, if any
+ijson = None
+
+for backend in ('yajl2_c', 'yajl2_cffi', 'yajl2', 'python'):
+    try:
+        ijson = importlib.import_module('ijson.backends.%s' % (backend,))
+        break
+    except ImportError:
+        pass
+
+
+"""
+Prefixes name the arrays whose items are decoded, in the notation used by ijson: object keys separated by dots, with
+`item` standing for every item of an array. Every listing response has its children at `data.children`; comment pages
+are an array of listings, with their children at `item.data.children`.
+"""
+
+
+class JSONDecoder(object):
+    """
+    Decodes the whole body into nested dictionaries before yielding any items. Uses the most memory, as every item of
+    the response is held at once; kept as a reference for the others.
+    """
+
+    def iter_items(self, body, prefix, found=None):
+        """
+        Yields the items of the arrays at a prefix of a JSON document.
+
+        Arguments:
+        body: The UTF-8 encoded JSON document.
+        prefix: The prefix of the arrays, such as `data.children`.
+        found: If given, the scalar values next to the arrays, such as `data.after`, are stored in this dictionary by
+               their key.
+        """
+        return self.walk(json.loads(body), prefix.split('.') if prefix else [], found)
+
+
+    def walk(self, value, path, found):
+        """
+        Yields the items of the arrays at the end of a path within a decoded value.
+
+        Arguments:
+        value: The decoded value.
+        path: The remaining keys of the prefix.
+        found: A dictionary for the scalar values next to the arrays, or None.
+        """
+        if not path:
+            if isinstance(value, list):
+                for item in value:
+                    yield item
+        elif path[0] == 'item':
+            if isinstance(value, list):
+                for item in value:
+                    for result in self.walk(item, path[1:], found):
+                        yield result
+        elif isinstance(value, dict):
+            if found is not None and len(path) == 1:
+                found.update((k, v) for k, v in value.iteritems() if not isinstance(v, (dict, list)))
+
+            if path[0] in value:
+                for result in self.walk(value[path[0]], path[1:], found):
+                    yield result
+
+
+class StreamingDecoder(object):
+    """
+    Scans the body for the arrays at a prefix, decoding each of their items on its own as it's reached and skipping
+    everything else, so only one item is held at a time. Works on the encoded body, sparing a decoded copy of it.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self):
+        """
+        Constructor for the StreamingDecoder.
+        """
+        self.decoder = json.JSONDecoder()
+
+
+    def iter_items(self, body, prefix, found=None):
+        """
+        Yields the items of the arrays at a prefix of a JSON document.
+
+        Arguments:
+        body: The UTF-8 encoded JSON document.
+        prefix: The prefix of the arrays, such as `data.children`.
+        found: If given, the scalar values next to the arrays, such as `data.after`, are stored in this dictionary by
+               their key.
+        """
+        return self.walk(body, [0], prefix.split('.') if prefix else [], found)
+
+
+    def walk(self, body, cursor, path, found):
+        """
+        Walks the value starting at the cursor, yielding the items of the arrays at the end of the path within it, and
+        leaves the cursor after the value.
+
+        Arguments:
+        body: The JSON document.
+        cursor: A single item list holding the position of the value, moved past the value once it's been walked.
+        path: The remaining keys of the prefix.
+        found: A dictionary for the scalar values next to the arrays, or None.
+        """
+        position = self.skip(body, cursor[0])
+        char = body[position:position + 1]
+
+        if char == '[' and (not path or path[0] == 'item'):
+            position = self.skip(body, position + 1)
+
+            if body[position:position + 1] != ']':
+                while True:
+                    if path:
+                        cursor[0] = position
+
+                        for result in self.walk(body, cursor, path[1:], found):
+                            yield result
+
+                        position = cursor[0]
+                    else:
+                        result, position = self.decoder.raw_decode(body, position)
+                        yield result
+
+                    position = self.expect(body, position, ',]')
+
+                    if body[position - 1] == ']':
+                        break
+
+                    position = self.skip(body, position)
+            else:
+                position += 1
+        elif char == '{' and path and path[0] != 'item':
+            position = self.skip(body, position + 1)
+
+            if body[position:position + 1] != '}':
+                while True:
+                    key, position = self.decoder.raw_decode(body, position)
+                    position = self.skip(body, self.expect(body, position, ':'))
+
+                    if key == path[0]:
+                        cursor[0] = position
+
+                        for result in self.walk(body, cursor, path[1:], found):
+                            yield result
+
+                        position = cursor[0]
+                    else:
+                        value, position = self.decoder.raw_decode(body, position)
+
+                        if found is not None and len(path) == 1 and not isinstance(value, (dict, list)):
+                            found[key] = value
+
+                    position = self.expect(body, position, ',}')
+
+                    if body[position - 1] == '}':
+                        break
+
+                    position = self.skip(body, position)
+            else:
+                position += 1
+        else:
+            # not on the path, or not the type of value the path expects
+            position = self.decoder.raw_decode(body, position)[1]
+
+        cursor[0] = position
+
+
+    def skip(self, body, position):
+        """
+        Returns the position of the first non-whitespace character at or after a position.
+        """
+        return self.whitespace.match(body, position).end()
+
+
+    def expect(self, body, position, chars):
+        """
+        Returns the position after the next non-whitespace character, which must be one of the expected characters.
+
+        Arguments:
+        body: The JSON document.
+        position: The position to start from.
+        chars: The expected characters.
+        """
+        position = self.skip(body, position)
+
+        if body[position:position + 1] not in tuple(chars):
+            raise ValueError('Expected one of %s at position %d of the JSON document.' % (', '.join(chars), position))
+
+        return position + 1
+
+
+class IjsonDecoder(object):
+    """
+    Yields the items of the arrays at a prefix from the events of ijson's parser, holding only one item at a time.
+    Uses the fastest ijson backend installed, preferably yajl2_c; even so, as items are built from parser events in
+    Python, it's several times slower than the StreamingDecoder on a body already in memory, and only pays off once
+    the body no longer fits in memory at all.
+    """
+
+    containers = ('start_map', 'start_array')
+
+    scalars = ('null', 'boolean', 'number', 'string')
+
+    def __init__(self):
+        """
+        Constructor for the IjsonDecoder.
+        """
+        if ijson is None:
+            raise UnknownDecoderException('The ijson decoder requires the ijson package to be installed.')
+
+
+    def iter_items(self, body, prefix, found=None):
+        """
+        Yields the items of the arrays at a prefix of a JSON document.
+
+        Arguments:
+        body: The UTF-8 encoded JSON document.
+        prefix: The prefix of the arrays, such as `data.children`.
+        found: If given, the scalar values next to the arrays, such as `data.after`, are stored in this dictionary by
+               their key.
+        """
+        items = '%s.item' % (prefix,) if prefix else 'item'
+        parent = prefix.rpartition('.')[0]
+
+        events = ijson.parse(io.BytesIO(body))
+
+        for current, event, value in events:
+            if current == items:
+                if event in self.containers:
+                    builder = ObjectBuilder()
+                    end = event.replace('start', 'end')
+
+                    while (current, event) != (items, end):
+                        builder.event(event, self.number(value) if event == 'number' else value)
+                        current, event, value = next(events)
+
+                    yield builder.value
+                elif event in self.scalars:
+                    yield self.number(value) if event == 'number' else value
+            elif found is not None and event in self.scalars and current != prefix and \
+                    current.rpartition('.')[0] == parent:
+                found[current.rpartition('.')[2]] = self.number(value) if event == 'number' else value
+
+
+    def number(self, value):
+        """
+        Converts the decimals ijson decodes non-integer numbers into to floats, as the json module decodes them.
+        """
+        return float(value) if isinstance(value, Decimal) else value
+
+
+"""
+The decoders available by name.
+"""
+DECODERS = {
+    'json': JSONDecoder,
+    'stream': StreamingDecoder,
+    'ijson': IjsonDecoder,
+}
+
+
+def get_decoder(name):
+    """
+    Creates a decoder by name.
+
+    Arguments:
+    name: The name of a decoder in `DECODERS`.
+
+    Returns:
+    A decoder with an `iter_items(body, prefix, found=None)` method.
+    """
+    if name not in DECODERS:
+        raise UnknownDecoderException('%s is not a known JSON decoder, expected one of %s.' % (name,
+            ', '.join(sorted(DECODERS.keys()))))
+
+    return DECODERS[name]()
@@ -8,3 +8,47 @@ class InvalidIdException(Exception):
     encountered.
     """
     pass
+
+
+class IncompatibleSchemaException(Exception):
+    """
+    An exception thrown when a database holds rows stored by a version of the schema which can't be read.
+    """
+    pass
+
+
+class IncompleteThreadException(Exception):
+    """
+    An exception thrown when the comments of a thread can't be read in tree order, as their paths haven't been built.
+    """
+    pass
+
+
+class UnknownProfileException(Exception):
+    """
+    An exception thrown when a database connection profile is requested which doesn't exist.
+    """
+    pass
+
+
+class UnknownDecoderException(Exception):
+    """
+    An exception thrown when a JSON decoder is requested which doesn't exist or whose dependencies aren't installed.
+    """
+    pass
+
+
+class UnknownCodecException(Exception):
+    """
+    An exception thrown when a compression codec is requested which doesn't exist or whose dependencies aren't
+    installed.
+    """
+    pass
+
+
+class UnknownFormatException(Exception):
+    """
+    An exception thrown when an export format is requested which doesn't exist or whose dependencies aren't
+    installed.
+    """
+    pass
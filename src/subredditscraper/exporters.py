@@ -0,0 +1,462 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import logging
+import os
+import struct
+import time
+
+from subredditscraper.database import connect_reader
+from subredditscraper.exceptions import UnknownFormatException
+from subredditscraper.query import parse_time, time_conditions
+from subredditscraper.schema import COMMENTS, LINKS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger('subredditscraper.exporters')
+
+
+"""
+The number of rows read from the database and written out at a time, which bounds the memory an export takes whatever
+the size of the archive.
+"""
+CHUNK_SIZE = 50000
+
+
+"""
+The tables which can be exported, by name.
+"""
+TABLES = {
+    'links': LINKS,
+    'comments': COMMENTS,
+}
+
+
+"""
+The types of exported columns by the SQL type of their column, see `export_type`.
+"""
+COLUMN_TYPES = {
+    'integer': 'int64',
+    'text': 'string',
+}
+
+
+def export_expression(schema, column):
+    """
+    Returns the SQL expression exporting a column of a table: its value as stored, ids being integers, but for
+    compressed and deduplicated text, which is exported as the view presents it.
+    """
+    field = schema.item_class.fields[column]
+
+    if field.get('compressed') or field.get('deduplicated'):
+        return '%s as %s' % (schema.view_expression(column), column)
+
+    return '%s.%s' % (schema.table, column)
+
+
+def export_type(schema, column):
+    """
+    Returns the type of an exported column, by its SQL type, but for deduplicated columns, whose blobs are exported
+    in place of their integer keys.
+    """
+    if schema.item_class.fields[column].get('deduplicated'):
+        return 'string'
+
+    return COLUMN_TYPES[schema.types[schema.columns.index(column)]]
+
+
+def project(schema, columns=None):
+    """
+    Returns the columns of a table to export: the id, followed by those of the given columns the table has, in order.
+
+    Arguments:
+    schema: The schema of the table.
+    columns: A list of column names, or None for every column.
+    """
+    if columns is None:
+        return list(schema.columns)
+
+    return ['id'] + [i for i in columns if i in schema.columns and i != 'id']
+
+
+def read_chunks(connection, schema, columns, since=None, until=None, chunk_size=CHUNK_SIZE):
+    """
+    Reads the rows of a table a chunk at a time, stepping through a single query rather than fetching every row.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    schema: The schema of the table.
+    columns: The names of the columns to read.
+    since: The earliest creation time of the rows, inclusive, in seconds since the epoch.
+    until: The latest creation time of the rows, exclusive, in seconds since the epoch.
+    chunk_size: The number of rows in each chunk.
+
+    Returns:
+    A generator of lists of row tuples.
+    """
+    conditions, parameters = time_conditions(schema.table, since, until)
+
+    cursor = connection.execute('select %s from %s%s;' % (', '.join(export_expression(schema, i) for i in columns),
+        schema.table, ' where %s' % (' and '.join(conditions),) if conditions else ''), parameters)
+
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+
+        if not rows:
+            return
+
+        yield rows
+
+
+class ColumnsWriter(object):
+    """
+    Writes a table as a directory of plain arrays, a few files per column, which need nothing but the standard library
+    to write and load straight into NumPy or Arrow buffers:
+
+    <column>.valid:   A byte per row, 1 unless the value is null; `numpy.fromfile(path, bool)`.
+    <column>.int64:   The values of integer columns, little-endian 64-bit integers, 0 for nulls;
+                      `numpy.fromfile(path, '<i8')`.
+    <column>.offsets: The offsets of the values of string columns into their `.utf8` file, little-endian 64-bit
+                      integers, one more than there are rows, as in Arrow's string arrays.
+    <column>.utf8:    The values of string columns, UTF-8 encoded, back to back, empty for nulls.
+    manifest.json:    The number of rows and the names and types of the columns. Written last, so that an export
+                      without it didn't finish.
+    """
+
+    extension = ''
+    available = True
+
+    def __init__(self, path, columns, types):
+        """
+        Constructor for the ColumnsWriter.
+
+        Arguments:
+        path: The path of the directory to write to, created if necessary.
+        columns: The names of the columns.
+        types: The types of the columns, `int64` or `string`.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # that of an earlier export to the same directory, which this one replaces
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            os.remove(os.path.join(path, 'manifest.json'))
+
+        self.path = path
+        self.columns = columns
+        self.types = types
+        self.rows = 0
+        self.files = []
+        # the open files of each column, and the offset of the end of each string column
+        self.outputs = []
+        self.offsets = {}
+
+        for column, column_type in zip(columns, types):
+            suffixes = ('valid', 'int64') if column_type == 'int64' else ('valid', 'offsets', 'utf8')
+            self.outputs.append([open(os.path.join(path, '%s.%s' % (column, i)), 'wb') for i in suffixes])
+            self.files.extend(i.name for i in self.outputs[-1])
+
+            if column_type == 'string':
+                self.offsets[column] = 0
+                self.outputs[-1][1].write(struct.pack('<q', 0))
+
+        self.files.append(os.path.join(path, 'manifest.json'))
+
+
+    def write(self, values):
+        """
+        Writes a chunk of rows.
+
+        Arguments:
+        values: A list of the values of each column in the chunk.
+        """
+        for column, column_type, outputs, column_values in zip(self.columns, self.types, self.outputs, values):
+            outputs[0].write(bytearray(i is not None for i in column_values))
+
+            if column_type == 'int64':
+                outputs[1].write(struct.pack('<%dq' % (len(column_values),), *(i or 0 for i in column_values)))
+                continue
+
+            data = [(i if isinstance(i, unicode) else unicode(i)).encode('utf-8') if i is not None else ''
+                for i in column_values]
+            offsets = []
+            offset = self.offsets[column]
+
+            for i in data:
+                offset += len(i)
+                offsets.append(offset)
+
+            self.offsets[column] = offset
+            outputs[1].write(struct.pack('<%dq' % (len(offsets),), *offsets))
+            outputs[2].write(''.join(data))
+
+        self.rows += len(values[0]) if values else 0
+
+
+    def close(self):
+        """
+        Closes the files of the columns and writes the manifest.
+        """
+        for outputs in self.outputs:
+            for i in outputs:
+                i.close()
+
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump({'rows': self.rows, 'columns': [{'name': i, 'type': j} for i, j in zip(self.columns,
+                self.types)]}, f, indent=2, sort_keys=True)
+
+
+def load_columns(path, columns=None):
+    """
+    Loads columns written by a ColumnsWriter, for exports small enough to fit in memory; larger ones are better
+    mapped with `numpy.memmap`.
+
+    Arguments:
+    path: The path of the directory written to.
+    columns: The names of the columns to load, or None for all of them.
+
+    Returns:
+    A dictionary of the list of the values of each column by its name, None for nulls.
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    rows = manifest['rows']
+    result = {}
+
+    for column in manifest['columns']:
+        name = column['name']
+
+        if columns is not None and name not in columns:
+            continue
+
+        with open(os.path.join(path, '%s.valid' % (name,)), 'rb') as f:
+            valid = bytearray(f.read())
+
+        if column['type'] == 'int64':
+            with open(os.path.join(path, '%s.int64' % (name,)), 'rb') as f:
+                values = struct.unpack('<%dq' % (rows,), f.read())
+        else:
+            with open(os.path.join(path, '%s.offsets' % (name,)), 'rb') as f:
+                offsets = struct.unpack('<%dq' % (rows + 1,), f.read())
+
+            with open(os.path.join(path, '%s.utf8' % (name,)), 'rb') as f:
+                data = f.read()
+
+            values = [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(rows)]
+
+        result[name] = [j if i else None for i, j in zip(valid, values)]
+
+    return result
+
+
+class ArrowWriter(object):
+    """
+    Writes a table to an Arrow IPC file, a record batch per chunk. Requires the pyarrow package.
+    """
+
+    extension = '.arrow'
+    available = pyarrow is not None
+
+    def __init__(self, path, columns, types):
+        """
+        Constructor for the ArrowWriter.
+
+        Arguments:
+        path: The path of the file to write.
+        columns: The names of the columns.
+        types: The types of the columns, `int64` or `string`.
+        """
+        self.columns = columns
+        self.schema = pyarrow.schema([pyarrow.field(i, getattr(pyarrow, j)()) for i, j in zip(columns, types)])
+        self.files = [path]
+        self.open(path)
+
+
+    def open(self, path):
+        self.sink = pyarrow.OSFile(path, 'wb')
+        self.writer = pyarrow.RecordBatchFileWriter(self.sink, self.schema)
+
+
+    def batch(self, values):
+        """
+        Converts a chunk of rows to a record batch.
+        """
+        return pyarrow.RecordBatch.from_arrays([pyarrow.array(list(i), type=j.type) for i, j in zip(values,
+            self.schema)], self.columns)
+
+
+    def write(self, values):
+        self.writer.write_batch(self.batch(values))
+
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Writes a table to a Parquet file, a row group per chunk. Requires the pyarrow package.
+    """
+
+    extension = '.parquet'
+
+    def open(self, path):
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+
+    def write(self, values):
+        self.writer.write_table(pyarrow.Table.from_batches([self.batch(values)]))
+
+
+    def close(self):
+        self.writer.close()
+
+
+"""
+The export formats by name.
+"""
+FORMATS = {
+    'columns': ColumnsWriter,
+    'arrow': ArrowWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def check_format(name):
+    """
+    Raises an UnknownFormatException unless a format exists and its dependencies are installed.
+
+    Arguments:
+    name: The name of a format in `FORMATS`.
+    """
+    if name not in FORMATS:
+        raise UnknownFormatException('%s is not a known export format, expected one of %s.' % (name,
+            ', '.join(sorted(FORMATS.keys()))))
+
+    if not FORMATS[name].available:
+        raise UnknownFormatException('The %s format requires the pyarrow package to be installed.' % (name,))
+
+
+def get_writer(name, path, columns, types):
+    """
+    Creates the writer of an export format.
+
+    Arguments:
+    name: The name of a format in `FORMATS`.
+    path: The path to write to, without the format's extension.
+    columns: The names of the columns.
+    types: The types of the columns, `int64` or `string`.
+
+    Returns:
+    A writer with `write(values)` and `close()` methods, and the `files` it writes.
+    """
+    check_format(name)
+
+    return FORMATS[name](path + FORMATS[name].extension, columns, types)
+
+
+def export_table(connection, schema, output, format='columns', columns=None, since=None, until=None,
+        chunk_size=CHUNK_SIZE):
+    """
+    Exports a table into a columnar format a chunk at a time, so that only a chunk of rows is ever held in memory.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    schema: The schema of the table.
+    output: The directory to write the export to, named after the table.
+    format: The name of a format in `FORMATS`.
+    columns: The names of the columns to export, or None for all of them; the id is always exported.
+    since: The earliest creation time of the rows, inclusive, in seconds since the epoch.
+    until: The latest creation time of the rows, exclusive, in seconds since the epoch.
+    chunk_size: The number of rows read and written at a time.
+
+    Returns:
+    A dictionary of the `table`, the number of `rows` and `bytes` written and the `seconds` it took.
+    """
+    started = time.time()
+    columns = project(schema, columns)
+    types = [export_type(schema, i) for i in columns]
+
+    check_format(format)
+
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    writer = get_writer(format, os.path.join(output, schema.table), columns, types)
+    rows = 0
+
+    for chunk in read_chunks(connection, schema, columns, since, until, chunk_size):
+        writer.write(zip(*chunk))
+        rows += len(chunk)
+
+    writer.close()
+
+    return {
+        'table': schema.table,
+        'rows': rows,
+        'bytes': sum(os.path.getsize(i) for i in writer.files),
+        'seconds': time.time() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-export',
+        description="Exports the posts and comments of an archive into a columnar format, a chunk at a time.")
+    parser.add_argument('-d', '--database-file', default="subreddits.db",
+        help="The database file to export.")
+    parser.add_argument('-o', '--output', required=True,
+        help="The directory to write the export to, a file or directory per table.")
+    parser.add_argument('-f', '--format', choices=sorted(FORMATS.keys()), default='columns',
+        help="The format to export to: plain arrays per column, an Arrow IPC file or a Parquet file; arrow and "
+             "parquet require the pyarrow package.")
+    parser.add_argument('-t', '--table', action='append', choices=sorted(TABLES.keys()),
+        help="A table to export, defaults to both.")
+    parser.add_argument('-c', '--columns',
+        help="A comma separated list of the columns to export, defaults to all of them; the id is always exported.")
+    parser.add_argument('--since', type=parse_time,
+        help="Only export posts and comments made at or after this time, a UTC date or seconds since the epoch.")
+    parser.add_argument('--until', type=parse_time,
+        help="Only export posts and comments made before this time, a UTC date or seconds since the epoch.")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help="The number of rows read and written at a time, which bounds the memory taken.")
+
+    args = parser.parse_args()
+
+    tables = [TABLES[i] for i in sorted(set(args.table or TABLES.keys()), reverse=True)]
+    columns = [i.strip() for i in args.columns.split(',')] if args.columns else None
+
+    unknown = set(columns or []).difference(*[i.columns for i in tables])
+
+    if unknown:
+        parser.error("unknown columns %s" % (', '.join(sorted(unknown)),))
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    try:
+        check_format(args.format)
+    except UnknownFormatException as e:
+        parser.error(str(e))
+
+    connection = connect_reader(args.database_file)
+
+    try:
+        for schema in tables:
+            result = export_table(connection, schema, args.output, args.format, columns, args.since, args.until,
+                args.chunk_size)
+
+            logger.info("Exported %d %s in %.1f seconds: %.0f rows/s, %.1f MB/s.", result['rows'], result['table'],
+                result['seconds'], result['rows'] / max(result['seconds'], 1e-9), result['bytes'] / 1048576.0 /
+                max(result['seconds'], 1e-9))
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    main()
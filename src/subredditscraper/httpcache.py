@@ -0,0 +1,251 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import time
+import zlib
+
+from collections import OrderedDict
+from scrapy.extensions.httpcache import RFC2616Policy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from scrapy.utils.url import canonicalize_url
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+logger = logging.getLogger('subredditscraper.httpcache')
+
+
+class EndpointPolicy(RFC2616Policy):
+    """
+    A cache policy for Reddit's API. Reddit marks every response `max-age=0, must-revalidate`, which is meant for
+    browsers; instead, a cached response stays fresh for as long as its endpoint's content is expected to stay the
+    same:
+
+    HTTPCACHE_LISTING_TTL:  Listings of posts, which gain new posts all the time, and posts fetched by id.
+    HTTPCACHE_THREAD_TTL:   The comment pages and collapsed comments of threads still open to new comments.
+    HTTPCACHE_ARCHIVED_TTL: Those of archived threads, which can no longer change.
+
+    Each is a number of seconds, where 0 means forever. Once stale, a response is revalidated by a conditional
+    request if it came with a `Last-Modified` or `ETag` header, and downloaded again otherwise. Only 200 responses are
+    cached.
+    """
+
+    def __init__(self, settings):
+        """
+        Constructor for the EndpointPolicy.
+
+        Arguments:
+        settings: The crawler's settings.
+        """
+        super(EndpointPolicy, self).__init__(settings)
+
+        self.listing_ttl = settings.getint('HTTPCACHE_LISTING_TTL', 300)
+        self.thread_ttl = settings.getint('HTTPCACHE_THREAD_TTL', 3600)
+        self.archived_ttl = settings.getint('HTTPCACHE_ARCHIVED_TTL', 0)
+
+
+    def should_cache_response(self, response, request):
+        return response.status == 200 and 'no-store' not in self._parse_cachecontrol(response)
+
+
+    def get_ttl(self, request):
+        """
+        Returns the number of seconds a response to a request stays fresh, 0 meaning forever.
+
+        Arguments:
+        request: A request made by the SubredditSpider.
+        """
+        if '/comments/' in request.url or '/api/morechildren' in request.url:
+            return self.archived_ttl if request.meta.get('thread', {}).get('archived') else self.thread_ttl
+
+        return self.listing_ttl
+
+
+    def _compute_freshness_lifetime(self, response, request, now):
+        return self.get_ttl(request) or self.MAXAGE
+
+
+class CompressedCacheStorage(object):
+    """
+    A cache storage keeping each response in a single file, named by a hash of its canonical URL, under
+    `HTTPCACHE_DIR`: a line of JSON metadata, then the raw headers and the body. Bodies are compressed unless they were
+    sent compressed already, in which case they're kept as they were received.
+
+    The files are evicted least recently used first once they take up more than `HTTPCACHE_MAX_BYTES`; the order in
+    which they were used is kept in their modification times, so it carries over from one crawl to the next.
+    """
+
+    def __init__(self, settings):
+        """
+        Constructor for the CompressedCacheStorage.
+
+        Arguments:
+        settings: The crawler's settings.
+        """
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'])
+        self.max_bytes = settings.getint('HTTPCACHE_MAX_BYTES', 256 * 1024 * 1024)
+        self.level = settings.getint('HTTPCACHE_COMPRESSION_LEVEL', 6)
+
+        self.stats = None
+        # the size of every file by path, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+
+
+    def open_spider(self, spider):
+        self.stats = getattr(getattr(spider, 'crawler', None), 'stats', None)
+
+        directory = os.path.join(self.cachedir, spider.name)
+        found = []
+
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+
+                if name.endswith('.tmp'):
+                    # left over from an interrupted write
+                    os.remove(path)
+                    continue
+
+                status = os.stat(path)
+                found.append((status.st_mtime, path, status.st_size))
+
+        for mtime, path, size in sorted(found):
+            self.entries[path] = size
+            self.size += size
+
+        logger.info("Opened the response cache at %s with %d responses in %d bytes.", directory, len(self.entries),
+            self.size)
+
+        self.evict()
+
+
+    def close_spider(self, spider):
+        self.set_stat('httpcache/bytes', self.size)
+
+
+    def retrieve_response(self, spider, request):
+        """
+        Returns the cached response to a request, or None if there is none.
+        """
+        path = self.get_path(spider, request)
+
+        if path not in self.entries:
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                metadata = json.loads(f.readline())
+                headers, body = f.read().split('\r\n\r\n', 1)
+        except (IOError, ValueError):
+            logger.warning("Discarding the unreadable cached response %s.", path, exc_info=True)
+            self.remove(path)
+            return None
+
+        self.touch(path)
+
+        if metadata['zlib']:
+            body = zlib.decompress(body)
+
+        url = metadata['url'].encode('utf-8')
+        headers = Headers(headers_raw_to_dict(headers))
+        cls = responsetypes.from_args(headers=headers, url=url)
+
+        return cls(url=url, status=metadata['status'], headers=headers, body=body)
+
+
+    def store_response(self, spider, request, response):
+        """
+        Stores the response to a request, evicting the least recently used responses if it takes the cache over its
+        budget.
+        """
+        path = self.get_path(spider, request)
+        # unless it was sent compressed, and the HttpCompressionMiddleware has yet to decode it
+        compress = not response.headers.get('Content-Encoding')
+
+        metadata = {
+            'url': response.url,
+            'status': response.status,
+            'timestamp': time.time(),
+            'zlib': compress,
+        }
+
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json.dumps(metadata))
+            f.write('\n')
+            f.write(headers_dict_to_raw(response.headers))
+            f.write('\r\n\r\n')
+            f.write(zlib.compress(response.body, self.level) if compress else response.body)
+
+        os.rename(path + '.tmp', path)
+
+        self.size -= self.entries.pop(path, 0)
+        self.entries[path] = os.path.getsize(path)
+        self.size += self.entries[path]
+
+        self.evict()
+
+
+    def get_path(self, spider, request):
+        """
+        Returns the path of the file caching the response to a request.
+        """
+        key = hashlib.sha1(canonicalize_url(request.url)).hexdigest()
+
+        return os.path.join(self.cachedir, spider.name, key[0:2], key)
+
+
+    def touch(self, path):
+        """
+        Marks a file as the most recently used.
+        """
+        self.entries[path] = self.entries.pop(path)
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache is within its budget.
+        """
+        while self.size > self.max_bytes and self.entries:
+            path = next(iter(self.entries))
+
+            logger.debug("Evicting %s from the response cache.", path)
+
+            self.remove(path)
+            self.inc_stat('httpcache/evicted')
+
+
+    def remove(self, path):
+        """
+        Removes a file from the cache.
+        """
+        self.size -= self.entries.pop(path, 0)
+
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+    def set_stat(self, key, value):
+        if self.stats is not None:
+            self.stats.set_value(key, value)
+
+
+    def inc_stat(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
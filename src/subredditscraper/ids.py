@@ -0,0 +1,120 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import re
+
+from subredditscraper.exceptions import InvalidIdException
+
+
+"""
+Base36 ids of any Reddit object type, with or without their type prefix, and of posts and comments specifically.
+"""
+id_regex = re.compile(r'\b(?:t[1-8]_)?([0-9a-z]+)\b')
+
+post_id_regex = re.compile(r'\b(?:t3_)?([0-9a-z]+)\b')
+
+comment_id_regex = re.compile(r'\b(?:t1_)?([0-9a-z]+)\b')
+
+"""
+The type prefixes of posts and comments.
+"""
+LINK_PREFIX = 't3_'
+
+COMMENT_PREFIX = 't1_'
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+"""
+The most base36 digits an id of 64 bits has.
+"""
+ID_DIGITS = 13
+
+
+def decode_id(id):
+    """
+    Decodes a base36 Reddit id, with or without its type prefix, into an integer. Every id Reddit has handed out so
+    far fits into 64 bits with plenty to spare.
+
+    Arguments:
+    id: A base36 id such as `3fn7gg` or `t3_3fn7gg`, or an already decoded integer id.
+
+    Returns:
+    The integer value of the id.
+
+    Raises:
+    InvalidIdException if the id isn't a lowercase base36 number with an optional type prefix.
+    """
+    if isinstance(id, (int, long)):
+        return id
+
+    match = id_regex.match(id) if isinstance(id, basestring) else None
+
+    # the regex only anchors on word boundaries, so the match has to span the whole id
+    if match is None or match.end() != len(id):
+        raise InvalidIdException('%s is not a valid Reddit base36 id.' % (id,))
+
+    return int(match.group(1), 36)
+
+
+def encode_id(id, prefix=''):
+    """
+    Encodes an integer Reddit id into its base36 form.
+
+    Arguments:
+    id: The integer value of the id.
+    prefix: The type prefix to prepend, such as `t3_`.
+
+    Returns:
+    The base36 id, or None if `id` is None.
+    """
+    if id is None:
+        return None
+
+    if id < 0:
+        raise ValueError('%d is not a valid Reddit id.' % (id,))
+
+    result = ''
+
+    while True:
+        id, remainder = divmod(id, 36)
+        result = DIGITS[remainder] + result
+
+        if id == 0:
+            return prefix + result
+
+
+def base36_sql(column):
+    """
+    Generates an SQL expression encoding an integer id column into its base36 form, as `encode_id` does, out of plain
+    arithmetic and string functions, so that views presenting ids can be read from any SQLite connection rather than
+    only from those with the functions of `subredditscraper.database` registered.
+
+    Arguments:
+    column: The name of the column.
+
+    Returns:
+    The SQL expression, which is null if the column is.
+    """
+    digits = []
+
+    for i in range(ID_DIGITS - 1, -1, -1):
+        # the remainder is worked out by hand, so that the expression can be used as a format string
+        value = '%s / %d' % (column, 36 ** i) if i else column
+
+        if i < ID_DIGITS - 1:
+            value = '%s - %s / %d * 36' % (value, column, 36 ** (i + 1))
+
+        digits.append("substr('%s', %s + 1, 1)" % (DIGITS, value))
+
+    return "ltrim(%s, '0') || %s" % (' || '.join(digits[:-1]), digits[-1])
+
+
+def parent_id_serializer(a):
+    """
+    Serializes the id of a comment's parent into the integer id of the parent comment, or None if the comment is a
+    top-level reply to the link itself.
+    """
+    if isinstance(a, (str, unicode)) and a.startswith(COMMENT_PREFIX):
+        return decode_id(a)
+    else:
+        return None
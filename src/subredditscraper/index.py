@@ -0,0 +1,186 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+from subredditscraper.ids import decode_id
+
+
+class IdIndex(object):
+    """
+    A compact set of Reddit ids, optionally mapping each id to a small integer value (such as a link's number of
+    comments).
+
+    Ids are decoded from base36 into integers and kept in a sorted array of machine longs, with values in a parallel
+    array of machine ints, so lookups are a binary search and no per-id Python objects are kept. Ids added after
+    loading go into a small overflow dictionary, which is merged into the arrays once it grows past `overflow_limit`.
+
+    Memory use on 64-bit platforms, once compacted:
+      * 8 bytes per id, or 8 MB per million ids.
+      * 12 bytes per id with values, or 12 MB per million ids.
+    """
+
+    def __init__(self, values=False, overflow_limit=65536):
+        """
+        Constructor for the IdIndex.
+
+        Arguments:
+        values: If True, the index maps each id to an integer value.
+        overflow_limit: The number of ids added since the last compaction which triggers a compaction.
+        """
+        self.ids = array('l')
+        self.values = array('i') if values else None
+        self.overflow = {}
+        self.overflow_limit = overflow_limit
+
+
+    @classmethod
+    def load(cls, rows, values=False, **kwargs):
+        """
+        Builds an index from database rows. Rows are streamed straight into the arrays; if they're sorted by id no
+        sort is required.
+
+        Arguments:
+        rows: An iterable of `(id,)` or, if `values` is True, `(id, value)` rows, with integer or base36 ids.
+        values: If True, the index maps each id to the integer value in the second column of each row.
+
+        Returns:
+        A new IdIndex.
+        """
+        result = cls(values=values, **kwargs)
+
+        ids, previous, ordered = result.ids, -1, True
+
+        for row in rows:
+            id = decode_id(row[0])
+
+            if id <= previous:
+                ordered = False
+
+            ids.append(id)
+            previous = id
+
+            if values:
+                result.values.append(row[1] or 0)
+
+        if not ordered:
+            result.sort()
+
+        return result
+
+
+    def sort(self):
+        """
+        Sorts the arrays by id, dropping duplicate ids.
+        """
+        if self.values is None:
+            self.ids = array('l', sorted(set(self.ids)))
+        else:
+            pairs = sorted(dict(izip(self.ids, self.values)).iteritems())
+
+            self.ids = array('l', (i[0] for i in pairs))
+            self.values = array('i', (i[1] for i in pairs))
+
+
+    def compact(self):
+        """
+        Merges the overflow dictionary into the sorted arrays.
+        """
+        if not self.overflow:
+            return
+
+        ids, values = array('l'), array('i') if self.values is not None else None
+        added = sorted(self.overflow.iteritems())
+
+        i, j = 0, 0
+
+        while i < len(self.ids) or j < len(added):
+            if j >= len(added) or (i < len(self.ids) and self.ids[i] < added[j][0]):
+                ids.append(self.ids[i])
+                if values is not None:
+                    values.append(self.values[i])
+                i += 1
+            else:
+                if i < len(self.ids) and self.ids[i] == added[j][0]:
+                    i += 1
+                ids.append(added[j][0])
+                if values is not None:
+                    values.append(added[j][1])
+                j += 1
+
+        self.ids, self.values, self.overflow = ids, values, {}
+
+
+    def add(self, id, value=None):
+        """
+        Adds an id to the index, or updates its value.
+
+        Arguments:
+        id: An integer id, or a base36 id with or without its type prefix.
+        value: The integer value of the id, if the index has values.
+        """
+        self.overflow[decode_id(id)] = (value or 0) if self.values is not None else True
+
+        if len(self.overflow) >= self.overflow_limit:
+            self.compact()
+
+
+    def find(self, id):
+        """
+        Finds the position of a decoded id in the sorted array.
+
+        Arguments:
+        id: An integer id.
+
+        Returns:
+        The position of the id, or -1 if it's not in the array.
+        """
+        position = bisect_left(self.ids, id)
+
+        return position if position < len(self.ids) and self.ids[position] == id else -1
+
+
+    def get(self, id, default=None):
+        """
+        Gets the value of an id.
+
+        Arguments:
+        id: An integer id, or a base36 id with or without its type prefix.
+        default: The value returned if the id isn't in the index.
+
+        Returns:
+        The value of the id, True if the index has no values, or `default` if the id isn't in the index.
+        """
+        id = decode_id(id)
+
+        if id in self.overflow:
+            return self.overflow[id]
+
+        position = self.find(id)
+
+        if position < 0:
+            return default
+
+        return self.values[position] if self.values is not None else True
+
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+
+    def __len__(self):
+        return len(self.ids) + sum(1 for i in self.overflow if self.find(i) < 0)
+
+
+    def memory_usage(self):
+        """
+        Returns the approximate number of bytes used by the index, excluding the overflow dictionary.
+        """
+        result = self.ids.buffer_info()[1] * self.ids.itemsize
+
+        if self.values is not None:
+            result += self.values.buffer_info()[1] * self.values.itemsize
+
+        return result
@@ -1,8 +1,10 @@
 #!/usr/bin/env python2.7
 # -*- coding: utf-8 -*-
 
+import json
 import scrapy
 
+from subredditscraper.ids import base36_sql, decode_id, parent_id_serializer
 from subredditscraper.spiders import SubredditSpider
 
 
@@ -51,6 +53,14 @@ def comment_id_serializer(a):
         return None
 
 
+def media_serializer(a):
+    """
+    Serializes a media dictionary into canonical JSON, with its keys sorted and no whitespace, so that equal
+    dictionaries always serialize into the same text.
+    """
+    return unicode(json.dumps(a, sort_keys=True, separators=(',', ':')))
+
+
 def time_serializer(a):
     """
     Simply rounds a floating point value for its input, as we must store dates and times as integers
@@ -59,7 +69,7 @@ def time_serializer(a):
     return round(float(a))
 
 
-class Created(object):
+class Created(scrapy.Item):
     """
     An object that keeps track of when it was created.
     """
@@ -81,7 +91,7 @@ class Created(object):
     created_utc = scrapy.Field(serializer=time_serializer)
 
 
-class Votable(object):
+class Votable(scrapy.Item):
     """
     An object that can be voted upon, taken from Reddit's documentation.
     """
@@ -114,23 +124,26 @@ class Votable(object):
     likes = scrapy.Field(serializer=bool_serializer)
 
 
-class Link(scrapy.Item, Created, Votable):
+class Link(Created, Votable):
     """
     A model representing a single Reddit link.
 
-    Exact mapping of original field names from JSON. Arrays and dicts are serialized to strings. Descriptions of fields
-    are taken from Reddit's official wiki: https://github.com/reddit/reddit/wiki/JSON
+    Exact mapping of original field names from JSON, unless a field names another key as its `source`. Arrays and
+    dicts are serialized to strings and ids to integers. The links table, and the links_view presenting the ids in
+    their base-36 form, are generated from these fields by `subredditscraper.schema`. Descriptions of fields are taken
+    from Reddit's official wiki: https://github.com/reddit/reddit/wiki/JSON
     """
 
     """
-    The base-36 id of the link.
+    The base-36 id of the link, stored as an integer.
     """
-    id = scrapy.Field(serializer=id_serializer)
+    id = scrapy.Field(serializer=decode_id)
 
     """
-    The prefixed base-36 id of the link.
+    The prefixed base-36 id of the link, Reddit's 'name' for it. Not stored, as it follows from the id.
     """
-    prefixed_id = scrapy.Field(serializer=link_id_serializer)
+    prefixed_id = scrapy.Field(serializer=link_id_serializer, source='name', stored=False,
+        view="'t3_' || " + base36_sql('id'))
 
     """
     The account name of the poster, null if it's a promotional link.
@@ -209,17 +222,19 @@ class Link(scrapy.Item, Created, Votable):
     Information on media relevant to the url.
 
     Description:
-    (dict) Used for streaming video. Technical embed-specific information is found here.
+    (dict) Used for streaming video. Technical embed-specific information is found here. Stored once per distinct
+          value in the media table, see `deduplicated` in `subredditscraper.schema`.
     """
-    media = scrapy.Field(serializer=unicode)
+    media = scrapy.Field(serializer=media_serializer, deduplicated=True)
 
     """
     More information on embedded media relevant to the url.
 
     Description:
-    (dict) Used for streaming video. Technical embed-specific information is found here.
+    (dict) Used for streaming video. Technical embed-specific information is found here. Stored once per distinct
+          value in the media table, see `deduplicated` in `subredditscraper.schema`.
     """
-    media_embed = scrapy.Field(serializer=unicode)
+    media_embed = scrapy.Field(serializer=media_serializer, deduplicated=True)
 
     """
     The number of comments on this link.
@@ -229,6 +244,13 @@ class Link(scrapy.Item, Created, Votable):
     """
     num_comments = scrapy.Field(serializer=int)
 
+    """
+    The number of comments on this link when its comments were last fetched. Not read from Reddit, but set by the
+    pipeline from a CommentsFetched item once every comment page of the thread has been parsed, so that a thread whose
+    comment requests failed or were never made is fetched again; upserts of the link leave it as it is.
+    """
+    comments_fetched = scrapy.Field(serializer=int, computed=True, preserved=True)
+
     """
     Whether the post is NSFW.
 
@@ -268,7 +290,7 @@ class Link(scrapy.Item, Created, Votable):
     (str) The raw text. this is the unformatted text which includes the raw markup characters such as ** for bold.
           <, >, and& are escaped. Empty if not present.
     """
-    selftext = scrapy.Field()
+    selftext = scrapy.Field(compressed=True)
 
     """
     The HTML generated text of the body from the raw Markdown.
@@ -279,7 +301,7 @@ class Link(scrapy.Item, Created, Votable):
           now be in HTML list format. NOTE: The HTML string will be escaped. You must unescape to get the raw HTML. Null
           if not present.
     """
-    selftext_html = scrapy.Field()
+    selftext_html = scrapy.Field(compressed=True)
 
     """
     Name of the subreddit which this link belongs to.
@@ -346,26 +368,29 @@ class Link(scrapy.Item, Created, Votable):
     Description:
     (bool) true if this post is set as the sticky in its subreddit.
     """
-    stickied = scrapy.Field()
+    stickied = scrapy.Field(serializer=bool_serializer)
 
 
-class Comment(scrapy.Item):
+class Comment(Created, Votable):
     """
     A model representing a single Reddit comment.
 
-    Exact mapping of original field names from JSON. Arrays and dicts are serialized to strings. Description of fields
-    are taken from Reddit's official wiki: https://github.com/reddit/reddit/wiki/JSON
+    Exact mapping of original field names from JSON, unless a field names another key as its `source`. Arrays and
+    dicts are serialized to strings and ids to integers. The comments table, and the comments_view presenting the ids in
+    their base-36 form, are generated from these fields by `subredditscraper.schema`. Description of fields are taken
+    from Reddit's official wiki: https://github.com/reddit/reddit/wiki/JSON
     """
 
     """
-    The base-36 id of this comment.
+    The base-36 id of this comment, stored as an integer.
     """
-    id = scrapy.Field(serializer=id_serializer)
+    id = scrapy.Field(serializer=decode_id)
 
     """
-    The prefixed base-36 id of this comment.
+    The prefixed base-36 id of this comment, Reddit's 'name' for it. Not stored, as it follows from the id.
     """
-    prefixed_id = scrapy.Field(serializer=comment_id_serializer)
+    prefixed_id = scrapy.Field(serializer=comment_id_serializer, source='name', stored=False,
+        view="'t1_' || " + base36_sql('id'))
 
     """
     The username of the approver of this comment.
@@ -414,7 +439,7 @@ class Comment(scrapy.Item):
     (str) the raw text. this is the unformatted text which includes the raw markup characters such as ** for bold. <,
           >, and & are escaped.
     """
-    body = scrapy.Field()
+    body = scrapy.Field(compressed=True)
 
     """
     The formatted HTML text of the comment generated from the raw Markdown text.
@@ -424,7 +449,7 @@ class Comment(scrapy.Item):
           tags wrapping it. Additionally, bullets and numbered lists will now be in HTML list format. NOTE: The HTML
           string will be escaped. You must unescape to get the raw HTML.
     """
-    body_html = scrapy.Field()
+    body_html = scrapy.Field(compressed=True)
 
     """
     The last time this comment was edited, or false if it was never edited.
@@ -456,9 +481,9 @@ class Comment(scrapy.Item):
     The id of the link this comment belongs to.
 
     Description:
-    (str) ID of the link this comment is in
+    (str) ID of the link this comment is in, stored as an integer.
     """
-    link_id = scrapy.Field(serializer=id_serializer)
+    link_id = scrapy.Field(serializer=decode_id)
 
     """
     The title of the link this comment belongs to.
@@ -490,9 +515,25 @@ class Comment(scrapy.Item):
     The parent ID of the thing this comment belongs to.
 
     Description:
-    (str) ID of the thing this comment is a reply to, either the link or a comment in it
+    (str) ID of the thing this comment is a reply to, either the link or a comment in it. Stored as the integer id of
+          the parent comment, or null for replies to the link.
+    """
+    parent_id = scrapy.Field(serializer=parent_id_serializer,
+        view="case when parent_id is null then 't3_' || %s else 't1_' || %s end" % (base36_sql('link_id'),
+            base36_sql('parent_id')))
+
+    """
+    The materialized path of this comment in its thread: the base-36 ids of the comments from the top-level one down
+    to this one, each zero-padded to 8 characters. Not read from Reddit, but built by `subredditscraper.threads` as
+    comments are stored, so that ordering a thread's comments by path gives them in tree order.
     """
-    parent_id = scrapy.Field()
+    path = scrapy.Field(computed=True)
+
+    """
+    Whether the path of this comment reaches up to a reply to the link. False while one of the comment's ancestors
+    hasn't been stored, in which case the path starts at the missing ancestor.
+    """
+    rooted = scrapy.Field(serializer=bool, computed=True)
 
     """
     Whether this comment has been saved by the current user.
@@ -542,3 +583,44 @@ class Comment(scrapy.Item):
     moderator = the green [M]. admin = the red [A]. special = various other special distinguishes
     """
     distinguished = scrapy.Field()
+
+
+class CommentsFetched(scrapy.Item):
+    """
+    A marker that every comment page of a link has been parsed, and its comments handed to the pipelines, which
+    records it in the link's `comments_fetched` column after storing the comments.
+    """
+
+    """
+    The id of the link, stored as an integer.
+    """
+    link_id = scrapy.Field(serializer=decode_id)
+
+    """
+    The number of comments on the link when its comments were requested.
+    """
+    num_comments = scrapy.Field(serializer=int)
+
+
+class LinkRow(scrapy.Item):
+    """
+    A link converted by the spider straight from its listing child into a row of the links table, by
+    `subredditscraper.schema.LINKS.convert`, rather than built into a Link item for the pipeline to serialize.
+    """
+
+    """
+    The row tuple, in the column order of the links table.
+    """
+    row = scrapy.Field()
+
+
+class CommentRow(scrapy.Item):
+    """
+    A comment converted by the spider straight from its listing child into a row of the comments table, by
+    `subredditscraper.schema.COMMENTS.convert`, rather than built into a Comment item for the pipeline to serialize.
+    """
+
+    """
+    The row tuple, in the column order of the comments table.
+    """
+    row = scrapy.Field()
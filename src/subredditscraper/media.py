@@ -0,0 +1,77 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import hashlib
+import struct
+
+from collections import OrderedDict
+
+
+"""
+The statement creating the table holding each distinct media blob once, keyed by `media_key`.
+"""
+MEDIA_TABLE = 'create table if not exists media (id integer primary key, value text not null);'
+
+
+"""
+The expression presenting a deduplicated column in views, formatted with the names of its table and column. The blobs
+of a compressed archive are compressed as well, and decompressed by the view.
+"""
+MEDIA_EXPRESSION = '(select value from media where media.id = %(table)s.%(column)s)'
+
+
+def media_key(value):
+    """
+    Returns the key of a canonical media blob in the media table: the first 8 bytes of its SHA-1 as a signed integer,
+    so that it's stored as the table's rowid.
+
+    Arguments:
+    value: The canonical JSON of the blob, as serialized by `subredditscraper.items.media_serializer`.
+    """
+    return struct.unpack('>q', hashlib.sha1(value.encode('utf-8')).digest()[:8])[0]
+
+
+class MediaCache(object):
+    """
+    The keys of the media blobs most recently stored, least recently used first, so that a blob repeated throughout
+    a crawl is only inserted into the media table once. A key missing from the cache only costs an `insert or ignore`
+    of a blob which may be stored already.
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        Constructor for the MediaCache.
+
+        Arguments:
+        capacity: The number of keys to hold.
+        """
+        self.capacity = capacity
+        self.keys = OrderedDict()
+
+
+    def __contains__(self, key):
+        if key not in self.keys:
+            return False
+
+        self.keys[key] = self.keys.pop(key)
+
+        return True
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def add(self, key):
+        """
+        Adds a key as the most recently used, evicting the least recently used if the cache is full.
+        """
+        self.keys.pop(key, None)
+        self.keys[key] = True
+
+        while len(self.keys) > self.capacity:
+            self.keys.popitem(last=False)
+
+
+    def clear(self):
+        self.keys.clear()
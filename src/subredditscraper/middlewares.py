@@ -0,0 +1,555 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import re
+import time
+
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Headers, Response, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.url import canonicalize_url
+
+from w3lib.url import url_query_cleaner
+from subredditscraper.synthetic import SyntheticReddit
+
+logger = logging.getLogger('subredditscraper.middlewares')
+
+
+class TokenBucket(object):
+    """
+    A token bucket holding the number of requests which may be made right away. Tokens refill continuously at `rate`
+    tokens per second up to `capacity`. A bucket may also be paused until a given time, during which it gains no
+    tokens and none may be used.
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        """
+        Constructor for the TokenBucket.
+
+        Arguments:
+        rate: The number of tokens gained per second.
+        capacity: The maximum number of tokens held; the largest burst of requests allowed.
+        now: The current time, defaults to `time.time()`.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time() if now is None else now
+        self.paused_until = 0.0
+
+
+    def refill(self, now):
+        """
+        Adds the tokens gained since the last refill.
+
+        Arguments:
+        now: The current time.
+        """
+        start = max(self.updated, self.paused_until)
+
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+
+        self.updated = max(self.updated, now)
+
+
+    def consume(self, now, tokens=1):
+        """
+        Takes tokens out of the bucket. The bucket may go into debt, which is paid back before any further tokens are
+        available.
+
+        Arguments:
+        now: The current time.
+        tokens: The number of tokens to take.
+        """
+        self.refill(now)
+        self.tokens -= tokens
+
+
+    def wait_time(self, now):
+        """
+        Returns the number of seconds until a token is available.
+
+        Arguments:
+        now: The current time.
+        """
+        self.refill(now)
+
+        paused = max(0.0, self.paused_until - now)
+
+        if self.tokens >= 1:
+            return paused
+
+        if self.rate <= 0:
+            return float('inf')
+
+        return paused + (1 - self.tokens) / self.rate
+
+
+    def pause(self, now, seconds):
+        """
+        Pauses the bucket for a number of seconds. The pause is expected to last until a fresh allowance, so any debt
+        is forgiven and a single token is available once it ends.
+
+        Arguments:
+        now: The current time.
+        seconds: The number of seconds to pause for.
+        """
+        self.refill(now)
+        self.tokens = min(self.capacity, 1.0)
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class RateLimitMiddleware(object):
+    """
+    A downloader middleware pacing requests by the rate limit headers Reddit sends with every response:
+
+    X-Ratelimit-Used:      The number of requests made in the current period.
+    X-Ratelimit-Remaining: The number of requests left in the current period.
+    X-Ratelimit-Reset:     The number of seconds until the current period ends.
+
+    The remaining allowance, less a reserve, is spread evenly over what's left of the period by a token bucket, and
+    the delay of the download slot is set to the time until the bucket has a token for the next request. When the
+    allowance is used up, or a 429 is received anyway, the bucket is paused until the period resets. Without headers,
+    the slot's delay is left alone, and responses served from the cache are passed through.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('RATELIMIT_ENABLED', False):
+            raise NotConfigured
+
+        return cls(
+            crawler = crawler,
+            min_delay = crawler.settings.getfloat('RATELIMIT_MIN_DELAY', 0.0),
+            max_delay = crawler.settings.getfloat('RATELIMIT_MAX_DELAY', 600.0),
+            reserve = crawler.settings.getfloat('RATELIMIT_RESERVE', 5.0),
+            burst = crawler.settings.getfloat('RATELIMIT_BURST', 5.0),
+            start_rate = crawler.settings.getfloat('RATELIMIT_START_RATE', 0.5),
+        )
+
+    def __init__(self, crawler, min_delay=0.0, max_delay=600.0, reserve=5.0, burst=5.0, start_rate=0.5):
+        """
+        Constructor for the RateLimitMiddleware.
+
+        Arguments:
+        crawler: The crawler whose download slots are paced.
+        min_delay: The minimum number of seconds between requests.
+        max_delay: The maximum number of seconds between requests.
+        reserve: The number of requests of each period left unused, as a margin for requests already in flight.
+        burst: The maximum number of requests made back to back when the allowance permits.
+        start_rate: The number of requests per second made until the first rate limit headers are received.
+        """
+        self.crawler = crawler
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.reserve = reserve
+        self.burst = burst
+
+        self.bucket = TokenBucket(start_rate, 1)
+
+
+    def process_response(self, request, response, spider):
+        # served from the cache, so no request was made and its headers are out of date
+        if 'cached' in response.flags:
+            return response
+
+        now = time.time()
+
+        self.bucket.consume(now)
+
+        self.update(response, now)
+
+        slot = self.crawler.engine.downloader.slots.get(request.meta.get('download_slot'))
+
+        if slot is not None and (self.has_headers(response) or response.status == 429):
+            slot.delay = self.get_delay(now, slot.lastseen)
+            self.crawler.stats.set_value('ratelimit/delay', slot.delay)
+
+        if response.status == 429:
+            logger.warning("Rate limited by %s, retrying in %.1f seconds.", request.url, self.bucket.wait_time(now))
+            self.crawler.stats.inc_value('ratelimit/throttled')
+
+            return request.replace(dont_filter=True)
+
+        return response
+
+
+    def has_headers(self, response):
+        """
+        Determines whether a response carries rate limit headers.
+
+        Arguments:
+        response: The response to inspect.
+
+        Returns:
+        True if the response has rate limit headers.
+        """
+        return 'X-Ratelimit-Remaining' in response.headers and 'X-Ratelimit-Reset' in response.headers
+
+
+    def update(self, response, now):
+        """
+        Updates the token bucket from the rate limit headers of a response.
+
+        Arguments:
+        response: The response carrying the headers.
+        now: The time the response was received.
+        """
+        if not self.has_headers(response):
+            if response.status == 429:
+                self.bucket.pause(now, float(response.headers.get('Retry-After') or 60))
+            return
+
+        remaining = float(response.headers['X-Ratelimit-Remaining'])
+        reset = max(float(response.headers['X-Ratelimit-Reset']), 1.0)
+        available = remaining - self.reserve
+
+        self.crawler.stats.set_value('ratelimit/remaining', remaining)
+        self.crawler.stats.set_value('ratelimit/used', float(response.headers.get('X-Ratelimit-Used') or 0))
+
+        if available < 1 or response.status == 429:
+            logger.info("Rate limit allowance used up, pausing for %.0f seconds.", reset)
+            self.crawler.stats.inc_value('ratelimit/paused')
+
+            self.bucket.pause(now, reset)
+            # once the period resets, proceed at the pace of the last period until new headers arrive
+            return
+
+        self.bucket.refill(now)
+        self.bucket.rate = available / reset
+        self.bucket.capacity = min(self.burst, available)
+        self.bucket.tokens = min(self.bucket.tokens, self.bucket.capacity)
+
+
+    def get_delay(self, now, lastseen):
+        """
+        Computes the delay of a download slot such that its next request is made once the bucket has a token.
+
+        Arguments:
+        now: The current time.
+        lastseen: The time at which the slot last started a request.
+
+        Returns:
+        The number of seconds between the slot's last request and its next one.
+        """
+        return min(max(self.min_delay, now - lastseen + self.bucket.wait_time(now)), self.max_delay)
+
+
+class ReplayMiddleware(object):
+    """
+    A downloader middleware serving requests from a directory of recorded responses rather than the network, so that
+    a crawl can be repeated without Reddit: every request is answered by the recording of its URL, or by a 404 if there
+    is none, and never reaches the downloader.
+
+    Recordings are laid out as in the fixtures directory of the package. Each `<name>.json` file holds a response body
+    tagged with the URL it was requested from, in a `__request_url` key of the top-level object, or in an object of
+    its own at the start of a top-level array. If a raw HTTP capture of the same response sits next to it as
+    `<name>-raw.txt`, its status, headers and body are served as they are; otherwise the tagged body is served with
+    the tag removed.
+
+    URLs are matched once canonicalized, so that the order of query parameters doesn't matter. A request without a
+    recording of its exact URL is matched without the parameters in `REPLAY_IGNORED_PARAMS`, which only shape a page
+    rather than choosing what it holds, so that responses recorded with another page size or depth than the spider
+    asks for are still served.
+    """
+
+    # the tag holding the URL of a recording
+    url_key = '__request_url'
+
+    url_regex = re.compile(r'"__request_url"\s*:\s*"([^"]*)"')
+
+    # headers describing the body as it was sent, which no longer hold for the body served
+    transfer_headers = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        directory = crawler.settings.get('REPLAY_DIR')
+
+        if not directory:
+            raise NotConfigured
+
+        return cls(crawler, directory,
+            ignored_params = crawler.settings.getlist('REPLAY_IGNORED_PARAMS', ['depth', 'limit', 'showmore']),
+        )
+
+    def __init__(self, crawler, directory, ignored_params=('depth', 'limit', 'showmore')):
+        """
+        Constructor for the ReplayMiddleware.
+
+        Arguments:
+        crawler: The crawler whose requests are served.
+        directory: The directory of the recordings, searched recursively.
+        ignored_params: The query parameters left out when a request has no recording of its exact URL.
+        """
+        self.crawler = crawler
+        self.directory = directory
+        self.ignored_params = tuple(ignored_params)
+        self.recordings = self.load_recordings(directory)
+
+        # taken in URL order, so that which of several recordings matching a request is served doesn't depend on the
+        # order of the walk
+        self.loose_recordings = {}
+
+        for url in sorted(self.recordings):
+            self.loose_recordings.setdefault(self.loosen_url(url), self.recordings[url])
+
+        logger.info("Replaying %d recorded responses from %s.", len(self.recordings), directory)
+
+
+    def load_recordings(self, directory):
+        """
+        Finds the recordings in a directory. Only the start of each file is read to find its URL, the rest is read
+        when it's requested.
+
+        Arguments:
+        directory: The directory to search.
+
+        Returns:
+        A dictionary of the paths of the recordings by canonical URL.
+        """
+        result = {}
+
+        for root, dirs, files in os.walk(directory):
+            for name in sorted(files):
+                if not name.endswith('.json'):
+                    continue
+
+                path = os.path.join(root, name)
+
+                with open(path, 'rb') as f:
+                    match = self.url_regex.search(f.read(4096))
+
+                if match is None:
+                    # a tag this far in means a very large array or object, or no tag at all
+                    url = self.get_url(self.read_json(path))
+                else:
+                    url = json.loads('"%s"' % (match.group(1),))
+
+                if url is None:
+                    logger.debug("Skipping %s, it isn't tagged with a URL.", path)
+                    continue
+
+                result[canonicalize_url(url)] = path
+
+        return result
+
+
+    def loosen_url(self, url):
+        """
+        Returns the canonical form of a URL without its ignored query parameters.
+        """
+        return canonicalize_url(url_query_cleaner(url, self.ignored_params, remove=True))
+
+
+    def read_json(self, path):
+        """
+        Decodes a recording.
+        """
+        with open(path, 'rb') as f:
+            return json.load(f)
+
+
+    def get_url(self, document):
+        """
+        Returns the URL a decoded recording is tagged with, or None if it isn't.
+        """
+        if isinstance(document, dict):
+            return document.get(self.url_key)
+
+        if isinstance(document, list) and document and isinstance(document[0], dict):
+            return document[0].get(self.url_key)
+
+        return None
+
+
+    def untag(self, document):
+        """
+        Removes the URL tag from a decoded recording.
+
+        Arguments:
+        document: The decoded recording.
+
+        Returns:
+        The document as it was received.
+        """
+        if isinstance(document, dict):
+            document.pop(self.url_key, None)
+        elif isinstance(document, list) and document and document[0] == {self.url_key: self.get_url(document)}:
+            del document[0]
+
+        return document
+
+
+    def read_capture(self, path):
+        """
+        Reads a raw HTTP capture.
+
+        Arguments:
+        path: The path of the capture.
+
+        Returns:
+        A tuple of the status, a dictionary of header lists by name and the body.
+        """
+        with open(path, 'rb') as f:
+            head, body = re.split(r'\r?\n\r?\n', f.read(), 1)
+
+        lines = head.splitlines()
+        status = int(lines[0].split()[1])
+        headers = {}
+
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+
+            if name.strip() and name.strip().title() not in self.transfer_headers:
+                headers.setdefault(name.strip(), []).append(value.strip())
+
+        return status, headers, body
+
+
+    def process_request(self, request, spider):
+        path = self.recordings.get(canonicalize_url(request.url)) or \
+            self.loose_recordings.get(self.loosen_url(request.url))
+
+        if path is None:
+            logger.warning("No recorded response for %s.", request.url)
+            self.crawler.stats.inc_value('replay/missed')
+
+            return Response(request.url, status=404, flags=['replay'], request=request)
+
+        capture = path[:-len('.json')] + '-raw.txt'
+
+        if os.path.exists(capture):
+            status, headers, body = self.read_capture(capture)
+        else:
+            status, headers = 200, {'Content-Type': ['application/json; charset=UTF-8']}
+            body = json.dumps(self.untag(self.read_json(path)))
+
+        self.crawler.stats.inc_value('replay/hits')
+        self.crawler.stats.inc_value('replay/bytes', len(body))
+
+        headers = Headers(headers)
+        cls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+
+        return cls(request.url, status=status, headers=headers, body=body, flags=['replay'], request=request)
+
+
+class SyntheticMiddleware(object):
+    """
+    A downloader middleware serving requests from synthetic subreddits rather than the network, generated as they're
+    requested by a `subredditscraper.synthetic.SyntheticReddit` of the spider's subreddits, so that a crawl of any
+    size can be run without Reddit or a directory of recordings. Requests the synthetic subreddits have no response
+    to get a 404.
+
+    Enabled by `SYNTHETIC_ENABLED`; the subreddits are shaped by `SYNTHETIC_SEED`, `SYNTHETIC_POSTS`,
+    `SYNTHETIC_COMMENTS_PER_POST`, `SYNTHETIC_DEPTH`, `SYNTHETIC_BODY_LENGTH` and `SYNTHETIC_EDIT_RATE`, as described
+    by the SyntheticReddit.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SYNTHETIC_ENABLED', False):
+            raise NotConfigured
+
+        return cls(crawler,
+            seed = crawler.settings.getint('SYNTHETIC_SEED', 0),
+            posts = crawler.settings.getint('SYNTHETIC_POSTS', 1000),
+            comments_per_post = crawler.settings.getint('SYNTHETIC_COMMENTS_PER_POST', 50),
+            depth = crawler.settings.getint('SYNTHETIC_DEPTH', 8),
+            body_length = crawler.settings.getint('SYNTHETIC_BODY_LENGTH', 120),
+            edit_rate = crawler.settings.getfloat('SYNTHETIC_EDIT_RATE', 0.05),
+        )
+
+    def __init__(self, crawler, **options):
+        """
+        Constructor for the SyntheticMiddleware.
+
+        Arguments:
+        crawler: The crawler whose requests are served.
+        options: The keyword arguments of the SyntheticReddit, other than the names of the subreddits.
+        """
+        self.crawler = crawler
+        self.options = options
+        # created for the spider's subreddits on its first request
+        self.reddit = None
+
+
+    def process_request(self, request, spider):
+        if self.reddit is None:
+            self.reddit = SyntheticReddit(spider.subreddit_names, **self.options)
+
+        document = self.reddit.respond(request.url)
+
+        if document is None:
+            logger.warning("No synthetic response for %s.", request.url)
+            self.crawler.stats.inc_value('synthetic/missed')
+
+            return Response(request.url, status=404, flags=['synthetic'], request=request)
+
+        body = json.dumps(document)
+
+        self.crawler.stats.inc_value('synthetic/responses')
+        self.crawler.stats.inc_value('synthetic/bytes', len(body))
+
+        return TextResponse(request.url, status=200, headers={'Content-Type': 'application/json; charset=UTF-8'},
+            body=body, encoding='utf-8', flags=['synthetic'], request=request)
+
+
+class CacheMiddleware(HttpCacheMiddleware):
+    """
+    Scrapy's HTTP cache middleware, which also counts the bytes that didn't have to be downloaded thanks to the cache
+    as `httpcache/bytes_saved`: the whole of each response served fresh from the cache, and the body of each one
+    revalidated by a 304. A response revalidated by a 304 is stored again with the 304's headers, so that it's fresh
+    from the time of the 304 rather than stale from then on. Meant to be used with the EndpointPolicy and
+    CompressedCacheStorage of `subredditscraper.httpcache`.
+    """
+
+    # the headers of a 304 which replace those of the cached response, its age following from the 304's Date
+    refreshed_headers = ('Age', 'Cache-Control', 'Date', 'ETag', 'Expires', 'Last-Modified')
+
+    def process_request(self, request, spider):
+        result = super(CacheMiddleware, self).process_request(request, spider)
+
+        if result is not None:
+            self.stats.inc_value('httpcache/bytes_saved', len(result.body), spider=spider)
+
+        return result
+
+
+    def process_response(self, request, response, spider):
+        result = super(CacheMiddleware, self).process_response(request, response, spider)
+
+        if result is not response:
+            self.stats.inc_value('httpcache/bytes_saved', len(result.body) - len(response.body), spider=spider)
+
+            if response.status == 304:
+                result = self.refresh(result, response)
+                self.storage.store_response(spider, request, result)
+
+        return result
+
+
+    def refresh(self, cached, response):
+        """
+        Updates the headers of a cached response with those of the 304 revalidating it.
+
+        Arguments:
+        cached: The cached response.
+        response: The 304 response.
+
+        Returns:
+        A copy of the cached response with the refreshed headers.
+        """
+        headers = cached.headers.copy()
+
+        for name in self.refreshed_headers:
+            if name in response.headers:
+                headers.setlist(name, response.headers.getlist(name))
+            elif name == 'Age':
+                headers.pop(name, None)
+
+        return cached.replace(headers=headers)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import calendar
+import json
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+
+from subredditscraper.database import connect_reader
+from subredditscraper.exceptions import UnknownCodecException
+from subredditscraper.exporters import CHUNK_SIZE, TABLES
+from subredditscraper.items import bool_serializer
+from subredditscraper.query import parse_time, time_conditions
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('subredditscraper.ndjson')
+
+
+"""
+The number of bytes of lines gathered before they're compressed and written out, and a file checked for its size.
+"""
+BUFFER_SIZE = 1048576
+
+
+class Uncompressed(object):
+    """
+    Passes data through as it is, for exports which aren't compressed.
+    """
+
+    def compress(self, data):
+        return data
+
+
+    def flush(self):
+        return ''
+
+
+"""
+The compressions of exported files by name: the extension of their files, and a function creating a compressor with
+the `compress(data)` and `flush()` methods of zlib's, streaming a single gzip member or zstd frame per file.
+"""
+COMPRESSIONS = {
+    'gzip': ('.gz', lambda: zlib.compressobj(6, zlib.DEFLATED, 31)),
+    'none': ('', lambda: Uncompressed()),
+    'zstd': ('.zst', lambda: zstandard.ZstdCompressor(level=3).compressobj()),
+}
+
+
+def check_compression(name):
+    """
+    Raises an UnknownCodecException unless a compression exists and its dependencies are installed.
+
+    Arguments:
+    name: The name of a compression in `COMPRESSIONS`.
+    """
+    if name not in COMPRESSIONS:
+        raise UnknownCodecException('%s is not a known compression, expected one of %s.' % (name,
+            ', '.join(sorted(COMPRESSIONS.keys()))))
+
+    if name == 'zstd' and zstandard is None:
+        raise UnknownCodecException('The zstd compression requires the zstandard package to be installed.')
+
+
+def month_bounds(timestamp):
+    """
+    Returns the start of the UTC month of a time and that of the next month, in seconds since the epoch.
+    """
+    year, month = time.gmtime(timestamp)[:2]
+
+    return (calendar.timegm((year, month, 1, 0, 0, 0)), calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0,
+        0)))
+
+
+def list_partitions(connection, schema, by_month=False, since=None, until=None):
+    """
+    Lists the partitions of the export of a table: the whole table, or every month of `created_utc` with rows in it,
+    found by seeking through the index on it rather than scanning the table, and the rows without a time. Partitions
+    are exported independently of each other, and may be exported in parallel.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    schema: The schema of the table.
+    by_month: Whether to partition the table by month.
+    since: The earliest creation time of the rows, inclusive, in seconds since the epoch.
+    until: The latest creation time of the rows, exclusive, in seconds since the epoch.
+
+    Returns:
+    A list of dictionaries of the `table` and `name` of each partition, the `conditions` and `parameters` selecting its
+    rows, and the `key` columns its rows are exported in the order of, and resumed after.
+    """
+    if not by_month:
+        conditions, parameters = time_conditions(schema.table, since, until)
+
+        return [{'table': schema.table, 'name': schema.table, 'conditions': conditions, 'parameters': parameters,
+            'key': ['id']}]
+
+    result = []
+    start = since
+
+    while True:
+        conditions, parameters = time_conditions(schema.table, start, until)
+        first = connection.execute('select min(created_utc) from %s%s;' % (schema.table, ' where %s' % (
+            ' and '.join(conditions),) if conditions else ''), parameters).fetchone()[0]
+
+        if first is None:
+            break
+
+        month, start = month_bounds(first)
+        year, number = time.gmtime(month)[:2]
+        conditions, parameters = time_conditions(schema.table, month if since is None else max(month,
+            since), start if until is None else min(start, until))
+
+        result.append({'table': schema.table, 'name': '%s-%04d-%02d' % (schema.table, year, number),
+            'conditions': conditions, 'parameters': parameters, 'key': ['created_utc', 'id']})
+
+    if since is None and until is None and connection.execute('select exists (select 1 from %s where created_utc is '
+            'null);' % (schema.table,)).fetchone()[0]:
+        result.append({'table': schema.table, 'name': '%s-undated' % (schema.table,),
+            'conditions': ['%s.created_utc is null' % (schema.table,)], 'parameters': [], 'key': ['id']})
+
+    return result
+
+
+def partition_query(schema, partition, after=None):
+    """
+    Builds the query of the rows of a partition in the order of its key, each its key columns followed by the columns
+    of the table's view.
+
+    Arguments:
+    schema: The schema of the table.
+    partition: A partition, as listed by `list_partitions`.
+    after: The key of the last row already exported, to resume after, or None to start from the first row.
+
+    Returns:
+    A tuple of the statement and its parameters.
+    """
+    conditions, parameters = list(partition['conditions']), list(partition['parameters'])
+    key = ', '.join('%s.%s' % (schema.table, i) for i in partition['key'])
+
+    if after is not None:
+        conditions.append('(%s) > (%s)' % (key, ', '.join(['?'] * len(after))))
+        parameters.extend(after)
+
+    return ('select %s, %s from %s%s order by %s;' % (key, schema.view_columns(), schema.table, ' where %s' % (
+        ' and '.join(conditions),) if conditions else '', key), parameters)
+
+
+def row_encoder(schema, cursor, offset):
+    """
+    Returns a function encoding rows of a cursor into lines of JSON objects with the fields of the table's items,
+    as the view presents them but for booleans, which are stored as integers. Keys aren't sorted, as sorting them
+    keeps the json module from using its C encoder, which is several times faster.
+
+    Arguments:
+    schema: The schema of the table.
+    cursor: The cursor the rows are read from.
+    offset: The number of columns before those of the view in each row.
+    """
+    fields = schema.item_class.fields
+    names = [i[0] for i in cursor.description[offset:]]
+    booleans = [i for i in names if fields[i].get('serializer') in (bool, bool_serializer)]
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+
+    def encode_row(row):
+        values = dict(zip(names, row[offset:]))
+
+        for i in booleans:
+            if values[i] is not None:
+                values[i] = bool(values[i])
+
+        return encode(values) + '\n'
+
+    return encode_row
+
+
+class NdjsonFile(object):
+    """
+    A compressed NDJSON file being written: under a temporary `.part` name until it's closed, so that a file with its
+    final name is always complete.
+    """
+
+    def __init__(self, path, compression):
+        """
+        Constructor for the NdjsonFile.
+
+        Arguments:
+        path: The final path of the file.
+        compression: The name of a compression in `COMPRESSIONS`.
+        """
+        self.path = path
+        self.output = open(path + '.part', 'wb')
+        self.compressor = COMPRESSIONS[compression][1]()
+        self.buffer = []
+        self.buffered = 0
+        self.rows = 0
+
+
+    def write(self, line):
+        """
+        Writes a line, compressing and writing out the lines gathered once there are enough of them.
+
+        Returns:
+        Whether the lines were written out, and the size of the file is up to date.
+        """
+        self.buffer.append(line)
+        self.buffered += len(line)
+        self.rows += 1
+
+        if self.buffered < BUFFER_SIZE:
+            return False
+
+        self.drain()
+
+        return True
+
+
+    def drain(self):
+        self.output.write(self.compressor.compress(''.join(self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+
+
+    def size(self):
+        """
+        Returns the number of bytes written out to the file.
+        """
+        return self.output.tell()
+
+
+    def close(self):
+        """
+        Writes out the rest of the file and gives it its final name.
+        """
+        self.drain()
+        self.output.write(self.compressor.flush())
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.output.close()
+
+        os.rename(self.output.name, self.path)
+
+
+def save_manifest(path, manifest):
+    """
+    Writes the manifest of a partition, replacing the last one at once.
+    """
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    os.rename(path + '.part', path)
+
+
+def export_partition(database_file, partition, output, compression='gzip', max_bytes=None, chunk_size=CHUNK_SIZE,
+        resume=False):
+    """
+    Exports a partition of a table into NDJSON files, `<output>/<table>/<partition>-<number>.ndjson<extension>`,
+    stepping through a single query of its rows in the order of its key, a chunk at a time. A new file is started
+    whenever one reaches `max_bytes`.
+
+    The partition's manifest, `<output>/<table>/<partition>.json`, lists the files completed, their rows, sizes and the
+    key of their last row, and whether the partition is complete. Resuming an export skips complete partitions, and
+    continues the others after the last row of their last complete file, writing the file after it again.
+
+    Arguments:
+    database_file: The path to the database file, opened by each partition, so that partitions may be exported by
+                   separate processes.
+    partition: A partition, as listed by `list_partitions`.
+    output: The directory to write the export to.
+    compression: The name of a compression in `COMPRESSIONS`.
+    max_bytes: The size of the files, compressed, after which another is started, or None for a single file.
+    chunk_size: The number of rows read at a time.
+    resume: Whether to resume an earlier export of the partition, rather than replace it.
+
+    Returns:
+    A dictionary of the `partition`, the numbers of `rows`, `files` and `bytes` written and the `seconds` it took.
+
+    Raises:
+    ValueError: If resuming a partition exported with another compression.
+    """
+    started = time.time()
+    schema = TABLES[partition['table']]
+    directory = os.path.join(output, partition['table'])
+    manifest_path = os.path.join(directory, '%s.json' % (partition['name'],))
+    manifest = {'compression': compression, 'complete': False, 'files': []}
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            earlier = json.load(f)
+
+        if resume and earlier['compression'] != compression:
+            raise ValueError("%s was exported with %s compression, not %s" % (partition['name'],
+                earlier['compression'], compression))
+
+        if resume:
+            manifest = earlier
+        else:
+            for i in earlier['files']:
+                if os.path.exists(os.path.join(directory, i['name'])):
+                    os.remove(os.path.join(directory, i['name']))
+
+    result = {'partition': partition['name'], 'rows': 0, 'files': 0, 'bytes': 0}
+
+    if manifest['complete']:
+        result['seconds'] = time.time() - started
+        return result
+
+    connection = connect_reader(database_file)
+    key_length = len(partition['key'])
+    current = None
+
+    try:
+        # plain tuples rather than rows, which can't be sliced
+        cursor = connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(*partition_query(schema, partition, manifest['files'][-1]['last'] if manifest['files'] else
+            None))
+        encode_row = row_encoder(schema, cursor, key_length)
+
+        def finish(last):
+            current.close()
+            size = os.path.getsize(current.path)
+
+            manifest['files'].append({'name': os.path.basename(current.path), 'rows': current.rows, 'bytes': size,
+                'last': list(last)})
+            save_manifest(manifest_path, manifest)
+
+            result['rows'] += current.rows
+            result['files'] += 1
+            result['bytes'] += size
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+
+            if not rows:
+                break
+
+            for row in rows:
+                if current is None:
+                    current = NdjsonFile(os.path.join(directory, '%s-%04d.ndjson%s' % (partition['name'],
+                        len(manifest['files']), COMPRESSIONS[compression][0])), compression)
+
+                if current.write(encode_row(row)) and max_bytes is not None and current.size() >= max_bytes:
+                    finish(row[:key_length])
+                    current = None
+
+        if current is not None:
+            finish(row[:key_length])
+
+        manifest['complete'] = True
+        save_manifest(manifest_path, manifest)
+    finally:
+        connection.close()
+
+    result['seconds'] = time.time() - started
+
+    return result
+
+
+def export_ndjson(database_file, output, tables=('links', 'comments'), compression='gzip', by_month=False,
+        max_bytes=None, since=None, until=None, jobs=1, chunk_size=CHUNK_SIZE, resume=False):
+    """
+    Exports tables into compressed NDJSON files, a JSON object with the fields of an item per line, partitioned by
+    month if asked, and rotated by size within each partition.
+
+    Arguments:
+    database_file: The path to the database file.
+    output: The directory to write the export to, a directory per table.
+    tables: The names of the tables to export, in `subredditscraper.exporters.TABLES`.
+    compression: The name of a compression in `COMPRESSIONS`.
+    by_month: Whether to partition the tables by the month of `created_utc`.
+    max_bytes: The size of the files, compressed, after which another is started, or None to rotate by month only.
+    since: The earliest creation time of the rows, inclusive, in seconds since the epoch.
+    until: The latest creation time of the rows, exclusive, in seconds since the epoch.
+    jobs: The number of partitions to export at once, each in a process of its own.
+    chunk_size: The number of rows read at a time.
+    resume: Whether to resume an earlier export into the same directory.
+
+    Returns:
+    A list of the results of `export_partition` for every partition.
+    """
+    check_compression(compression)
+
+    connection = connect_reader(database_file)
+
+    try:
+        partitions = [j for i in tables for j in list_partitions(connection, TABLES[i], by_month, since, until)]
+    finally:
+        connection.close()
+
+    for i in tables:
+        if not os.path.isdir(os.path.join(output, i)):
+            os.makedirs(os.path.join(output, i))
+
+    arguments = [(database_file, i, output, compression, max_bytes, chunk_size, resume) for i in partitions]
+
+    if jobs <= 1:
+        return [export_partition(*i) for i in arguments]
+
+    pool = multiprocessing.Pool(jobs)
+
+    try:
+        return [i.get() for i in [pool.apply_async(export_partition, j) for j in arguments]]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-ndjson',
+        description="Exports the posts and comments of an archive into compressed newline-delimited JSON files, "
+                    "rotated by month or size, and resumable.")
+    parser.add_argument('-d', '--database-file', default="subreddits.db",
+        help="The database file to export.")
+    parser.add_argument('-o', '--output', required=True,
+        help="The directory to write the export to, a directory per table.")
+    parser.add_argument('-t', '--table', action='append', choices=sorted(TABLES.keys()),
+        help="A table to export, defaults to both.")
+    parser.add_argument('-z', '--compression', choices=sorted(COMPRESSIONS.keys()), default='gzip',
+        help="The compression of the files; zstd requires the zstandard package.")
+    parser.add_argument('-m', '--by-month', action='store_true',
+        help="Write the posts and comments of every month to files of their own.")
+    parser.add_argument('-s', '--max-size', type=float,
+        help="Start another file once one reaches this many megabytes, compressed.")
+    parser.add_argument('--since', type=parse_time,
+        help="Only export posts and comments made at or after this time, a UTC date or seconds since the epoch.")
+    parser.add_argument('--until', type=parse_time,
+        help="Only export posts and comments made before this time, a UTC date or seconds since the epoch.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help="The number of months, or tables, to export at once.")
+    parser.add_argument('-r', '--resume', action='store_true',
+        help="Resume an interrupted export into the same directory after its last complete file.")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help="The number of rows read at a time.")
+
+    args = parser.parse_args()
+
+    try:
+        check_compression(args.compression)
+    except UnknownCodecException as e:
+        parser.error(str(e))
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    started = time.time()
+
+    try:
+        results = export_ndjson(args.database_file, args.output, sorted(set(args.table or TABLES.keys()),
+            reverse=True), args.compression, args.by_month, int(args.max_size * 1048576) if args.max_size else None,
+            args.since, args.until, args.jobs, args.chunk_size, args.resume)
+    except ValueError as e:
+        parser.error("couldn't resume: %s" % (e,))
+
+    seconds = time.time() - started
+
+    for i in results:
+        logger.info("Exported %d rows of %s into %d files, %.1f MB, in %.1f seconds.", i['rows'], i['partition'],
+            i['files'], i['bytes'] / 1048576.0, i['seconds'])
+
+    logger.info("Exported %d rows in %.1f seconds: %.0f rows/s, %.1f MB/s.", sum(i['rows'] for i in results), seconds,
+        sum(i['rows'] for i in results) / max(seconds, 1e-9), sum(i['bytes'] for i in results) / 1048576.0 /
+        max(seconds, 1e-9))
+
+if __name__ == "__main__":
+    main()
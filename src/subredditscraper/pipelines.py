@@ -1,62 +1,434 @@
 #!/usr/bin/env python2.7
 # -*- coding: utf-8 -*-
 
+import logging
+import Queue
 import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+
+from subredditscraper.compression import Compressor
+from subredditscraper.database import apply_profile, register_functions
+from subredditscraper.index import IdIndex
+from subredditscraper.exceptions import IncompatibleSchemaException
+from subredditscraper.ids import decode_id
+from subredditscraper.items import Comment, CommentRow, CommentsFetched, Link, LinkRow
+from subredditscraper.media import MEDIA_TABLE, MediaCache, media_key
+from subredditscraper.schema import COMMENTS, INDEX_TABLE, LINKS, SCHEMA_VERSION
+from subredditscraper.search import COMMENTS_SEARCH, LINKS_SEARCH
+from subredditscraper.threads import PathBuilder
+
+logger = logging.getLogger('subredditscraper.pipelines')
+
+
+"""
+The least number of rows a bulk load writes per transaction, and the least number of seconds it buffers them for.
+"""
+BULK_BATCH_SIZE = 50000
+
+BULK_FLUSH_INTERVAL = 60.0
 
 
 class SQLiteItemPipeline(object):
 
+    """
+    The columns of the links table, in the order in which they're created and written.
+    """
+    link_columns = LINKS.columns
+
+    """
+    The columns of the comments table, in the order in which they're created and written.
+    """
+    comment_columns = COMMENTS.columns
+
     @classmethod
     def from_crawler(cls, crawler):
         return cls(
             database_file = crawler.settings.get('DATABASE_FILE', 'subreddits.db'),
+            batch_size = crawler.settings.getint('DATABASE_BATCH_SIZE', 500),
+            flush_interval = crawler.settings.getfloat('DATABASE_FLUSH_INTERVAL', 5.0),
+            writer_thread = crawler.settings.getbool('DATABASE_WRITER_THREAD', False),
+            queue_size = crawler.settings.getint('DATABASE_QUEUE_SIZE', 10000),
+            profile = crawler.settings.get('DATABASE_PROFILE', 'wal'),
+            read_profile = crawler.settings.get('DATABASE_READ_PROFILE', 'reader'),
+            compression = crawler.settings.get('DATABASE_COMPRESSION'),
+            media_cache_size = crawler.settings.getint('DATABASE_MEDIA_CACHE_SIZE', 10000),
+            bulk_load = crawler.settings.getbool('DATABASE_BULK_LOAD', False),
+            stats = crawler.stats,
         )
 
-    def __init__(self, database_file):
+    def __init__(self, database_file, batch_size=500, flush_interval=5.0, writer_thread=False, queue_size=10000,
+            profile='wal', read_profile='reader', compression=None, media_cache_size=10000, bulk_load=False,
+            stats=None, clock=None):
         """
         Constructor for the SQLiteItemPipeline.
 
         Arguments:
         database_file: The path to the database file to write to.
+        batch_size: The number of buffered rows which triggers a flush to the database.
+        flush_interval: The maximum number of seconds buffered rows may wait before being flushed.
+        writer_thread: If True, all database work is done by a dedicated writer thread instead of the reactor thread.
+        queue_size: The maximum number of rows waiting to be picked up by the writer thread.
+        profile: The name of the connection profile applied to the writing connection.
+        read_profile: The name of the connection profile used for read-only connections made during the crawl.
+        compression: The name of a codec in `subredditscraper.compression.CODECS` to compress large text columns
+                     with, trained on the archive, or None to store them as they are. Either way, the views present
+                     them decompressed.
+        media_cache_size: The number of keys of recently stored media blobs to remember, so that they aren't
+                          inserted into the media table again.
+        bulk_load: If True, load a new archive as fast as possible: without its secondary indexes, full-text indexes
+                   or comment paths, which are all built once the crawl finishes, in large transactions, and with
+                   the `bulk` connection profile until then, which a crash may corrupt the database under.
+        stats: An optional Scrapy stats collector to report write statistics to.
+        clock: The reactor scheduling the checks for rows buffered longer than the flush interval, defaults to the
+               global reactor.
         """
         self.database_file = database_file
+        self.batch_size = max(batch_size, BULK_BATCH_SIZE) if bulk_load else batch_size
+        self.flush_interval = max(flush_interval, BULK_FLUSH_INTERVAL) if bulk_load else flush_interval
+        self.writer_thread = writer_thread
+        self.queue_size = queue_size
+        self.profile = profile
+        self.read_profile = read_profile
+        self.compression = compression if compression != 'none' else None
+        self.clock = clock if clock is not None else reactor
+        self.bulk_load = bulk_load
+        self.stats = stats
+
+        self.connection = None
+        self.flush_loop = None
+        self.links = OrderedDict()
+        self.comments = OrderedDict()
+        self.fetched = OrderedDict()
+        self.last_flush = time.time()
+
+        self.link_index = IdIndex(values=True)
+        self.comment_index = IdIndex()
+
+        self.queue = None
+        self.writer = None
+        self.writer_error = None
+        self.queue_max_depth = 0
+
+        # a single thread of its own putting rows into a full queue, in the order they came in
+        self.put_pool = None
+        self.pending_puts = 0
+
+        self.compressor = None
+
+        self.media_cache = MediaCache(media_cache_size)
+        self.media_references = 0
+        self.media_inserted = 0
+
+        self.paths = PathBuilder()
 
 
     def open_spider(self, spider):
         """
-        Callback method triggered on start of the spider.
+        Callback method triggered on start of the spider. Opens the long-lived connection used for all writes, or
+        starts the writer thread which owns it, and shares the indexes of stored ids with the spider. Without the
+        writer thread, which waits on its queue for no longer than the flush interval, a looping call flushes rows
+        buffered for longer than the interval even while no items arrive.
 
         Arguments:
         spider: The spider instance which is opening this pipeline.
         """
-        # TODO determine if tables exist in the database and create if necessary
-        pass
+        if self.writer_thread:
+            self.start_writer()
+        else:
+            self.open_connection()
+
+            self.flush_loop = task.LoopingCall(self.flush_expired)
+            self.flush_loop.clock = self.clock
+            # checked at least every second, so that rows wait no longer than a second past the interval
+            self.flush_loop.start(min(self.flush_interval, 1.0), now=False).addErrback(self.flush_loop_failed)
+
+        if spider is not None:
+            spider.link_index = self.link_index
+            spider.comment_index = self.comment_index
+
+
+    def open_connection(self):
+        """
+        Opens the long-lived connection used for all writes and creates the database tables if necessary. The
+        connection may only be used by the thread which calls this method.
+        """
+        self.connection = self.new_connection()
+
+        if not self.tables_exist(self.connection):
+            self.create_tables(self.connection)
+        elif self.get_schema_version(self.connection) < SCHEMA_VERSION:
+            self.replace_tables(self.connection)
+
+        if self.bulk_load:
+            self.start_bulk_load(self.connection)
+        elif self.bulk_load_pending(self.connection):
+            logger.warning("The last bulk load of the database didn't finish, finishing it before crawling.")
+            self.finish_bulk_load(self.connection)
+        else:
+            self.update_indexes(self.connection)
+
+        self.create_staging_tables(self.connection)
+        self.load_indexes(self.connection)
+        self.paths.load(self.connection)
+
+        if self.compression is not None:
+            self.compressor = Compressor(self.compression)
+            self.compressor.load(self.connection)
+
+        # replaced whenever the archive is opened, as compressing it for the first time changes them
+        self.create_views(self.connection)
+
+        if not self.bulk_load:
+            self.create_search_triggers(self.connection)
+
+        self.links, self.comments, self.fetched = OrderedDict(), OrderedDict(), OrderedDict()
+        self.last_flush = time.time()
+
+        if self.stats is not None:
+            self.stats.set_value('sqlite/profile', 'bulk' if self.bulk_load else self.profile)
+            self.stats.set_value('sqlite/read_profile', self.read_profile)
+            self.stats.set_value('sqlite/journal_mode', self.connection.execute('pragma journal_mode;').fetchone()[0])
+
+
+    def close_connection(self):
+        """
+        Finishes writing and closes the long-lived connection.
+        """
+        try:
+            self.finish_writing()
+        finally:
+            self.connection.close()
+            self.connection = None
+
+
+    def finish_writing(self):
+        """
+        Does the work left once the last row has been received, in either mode: flushes any buffered rows, finishes a
+        bulk load and reports on the media stored.
+        """
+        self.flush()
+
+        if self.bulk_load:
+            self.finish_bulk_load(self.connection)
+
+        if self.media_references:
+            self.report_media(self.connection)
+
+
+    def report_media(self, connection):
+        """
+        Reports how well media blobs are deduplicated: the references to blobs throughout the links table over the
+        distinct blobs stored in the media table, which doesn't depend on how many of them this crawl inserted.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        references = connection.execute('select %s from links;' % (' + '.join('count(%s)' % (LINKS.columns[i],)
+            for i in LINKS.deduplicated),)).fetchone()[0]
+        blobs = connection.execute('select count(*) from media;').fetchone()[0]
+
+        if not blobs:
+            return
+
+        logger.info("Stored %d media references with %d new media blobs; the archive holds %d references to %d "
+            "distinct blobs, a deduplication ratio of %.1f.", self.media_references, self.media_inserted, references,
+            blobs, references / float(blobs))
+
+        if self.stats is not None:
+            self.stats.set_value('sqlite/media/dedup_ratio', references / float(blobs))
+
+
+    def load_indexes(self, connection):
+        """
+        Loads the ids of all stored links, along with their number of comments when their comments were last fetched,
+        -1 if they never were, and the ids of all stored comments into compact in-memory indexes. Ids are read in rowid
+        order so that no sort is required.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        started = time.time()
+
+        self.link_index = IdIndex.load(connection.execute('select id, coalesce(comments_fetched, -1) from links order '
+            'by id;'), values=True)
+        self.comment_index = IdIndex.load(connection.execute('select id from comments order by id;'))
+
+        memory_usage = self.link_index.memory_usage() + self.comment_index.memory_usage()
+
+        logger.info("Loaded %d link and %d comment ids (%d bytes) in %.2f seconds.", len(self.link_index),
+            len(self.comment_index), memory_usage, time.time() - started)
+
+        if self.stats is not None:
+            self.stats.set_value('sqlite/index/links', len(self.link_index))
+            self.stats.set_value('sqlite/index/comments', len(self.comment_index))
+            self.stats.set_value('sqlite/index/bytes', memory_usage)
+
+
+    def start_writer(self):
+        """
+        Starts the writer thread along with the bounded queue which feeds it rows. Blocks until the writer has opened
+        its connection so that schema problems surface when the spider opens.
+        """
+        self.queue = Queue.Queue(self.queue_size)
+        self.writer_error = None
+        self.queue_max_depth = 0
+
+        ready = threading.Event()
+
+        self.writer = threading.Thread(target=self.run_writer, args=(ready,), name='sqlite-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+        ready.wait()
+
+        if self.writer_error is not None:
+            raise self.writer_error
+
+
+    def run_writer(self, ready):
+        """
+        The body of the writer thread. Takes rows off of the queue and buffers them, flushing on the same batch size
+        and interval rules as the reactor-thread mode, until it receives `None` from `stop_writer`.
+
+        If writing fails, the error is kept in `writer_error` and the remaining rows are drained and discarded so
+        that producers never block on a dead writer.
+
+        Arguments:
+        ready: An event set once the writer's connection has been opened (or failed to open).
+        """
+        try:
+            self.open_connection()
+        except Exception as e:
+            self.writer_error = e
+            return
+        finally:
+            ready.set()
+
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.time() - self.last_flush))
+
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                entry = ()
+
+            if entry is None:
+                break
+
+            if self.writer_error is not None:
+                continue
+
+            try:
+                if entry:
+                    self.buffer(*entry)
+                else:
+                    self.flush()
+            except Exception as e:
+                logger.exception("SQLite writer failed, discarding all further rows.")
+                self.writer_error = e
+
+        try:
+            if self.writer_error is None:
+                self.finish_writing()
+        finally:
+            self.connection.close()
+            self.connection = None
+
+
+    def stop_writer(self):
+        """
+        Signals the writer thread to flush and finish once the queue has been drained, and waits for it to exit.
+        Blocks, so call it off of the reactor thread.
+        """
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
 
+        logger.info("SQLite writer stopped; the queue held at most %d rows.", self.queue_max_depth)
 
-    def save_link(self, link):
+        if self.stats is not None:
+            self.stats.max_value('sqlite/queue_max_depth', self.queue_max_depth)
+
+        if self.writer_error is not None:
+            raise self.writer_error
+
+
+    def enqueue(self, entry, item):
         """
-        Insert a new row into the links table, storing the link.
+        Hands a serialized row to the writer thread without blocking the reactor. If the queue is full, the put is
+        done from a thread of the pipeline's own, rather than one of the reactor's pool which also resolves DNS, and
+        the returned deferred only fires once there's room, which holds back Scrapy's item processing until the writer
+        catches up. Rows are put by that thread for as long as any are waiting on it, so that none overtake them.
+
+        Arguments:
+        entry: A tuple of the table name and the row to write to it.
+        item: The item the row was serialized from.
+
+        Returns:
+        A deferred firing with the item once the row has been queued.
         """
-        pass
+        if self.writer_error is not None:
+            return defer.fail(self.writer_error)
+
+        if not self.pending_puts:
+            try:
+                self.queue.put_nowait(entry)
+            except Queue.Full:
+                pass
+            else:
+                self.queue_max_depth = max(self.queue_max_depth, self.queue.qsize())
+
+                return defer.succeed(item)
+
+        self.queue_max_depth = self.queue_size
+        self.inc_stat('sqlite/queue_full')
 
-    def update_link(self, link):
+        if self.put_pool is None:
+            self.put_pool = ThreadPool(1, 1, 'sqlite-put')
+            self.put_pool.start()
+
+        self.pending_puts += 1
+
+        return threads.deferToThreadPool(reactor, self.put_pool, self.queue.put, entry).addBoth(self.put_done, item)
+
+
+    def put_done(self, result, item):
         """
-        Update an existing row in the database with the given link information.
+        Callback of a put done by the put thread, on the reactor thread.
+
+        Arguments:
+        result: The result of the put, or its failure.
+        item: The item the row was serialized from.
+
+        Returns:
+        The item, or the failure.
         """
-        pass
+        self.pending_puts -= 1
 
+        return item if not isinstance(result, failure.Failure) else result
 
-    def link_exists(self, link):
+
+    def stop_put_pool(self, result):
         """
-        Evaluates whether a link exists in the database. Use this method to determine whether to insert or update
-        a link in the database.
+        Stops the put thread once the writer has stopped, passing on the result of stopping it.
         """
-        pass
+        if self.put_pool is not None:
+            self.put_pool.stop()
+            self.put_pool = None
+
+        return result
 
 
     def new_connection(self):
         """
-        Factory method for creating a new connection to the SQLite database.
+        Factory method for creating a new connection to the SQLite database, configured by the pipeline's connection
+        profile and with the SQL functions used by the views registered.
 
         Returns:
         A properly configured SQLite connection object.
@@ -64,6 +436,9 @@ class SQLiteItemPipeline(object):
         result = sqlite3.connect(self.database_file)
         result.row_factory = sqlite3.Row
 
+        register_functions(result)
+        apply_profile(result, 'bulk' if self.bulk_load else self.profile)
+
         return result
 
 
@@ -100,108 +475,571 @@ class SQLiteItemPipeline(object):
 
     def create_tables(self, connection):
         """
-        Creates the database tables for links and comments. If database tables previously exist in the database,
-        they'll be dropped and recreated by this method. Only call this method if you understand the implications.
+        Creates the database tables for links and comments and their views, generated from their items by
+        `subredditscraper.schema`, and their full-text indexes, and records the version of the schema in the database.
+        If database tables previously exist in the database, they'll be dropped and recreated by this method. Only call
+        this method if you understand the implications.
 
         Arguments:
         connection: SQLite connection to the database.
         """
         with connection:
+            for index in (LINKS_SEARCH, COMMENTS_SEARCH):
+                for statement in index.drop_statements():
+                    connection.execute(statement)
+
             # drop links if it exists
             connection.execute('drop table if exists links;')
             # create links table
-            connection.execute(
-                "create table links ("
-                "    id text primary key,"
-                "    created integer,"
-                "    created_utc integer,"
-                "    ups integer,"
-                "    downs integer,"
-                "    likes integer,"
-                "    prefixed_id text,"
-                "    author text,"
-                "    author_flair_css_class text,"
-                "    author_flair_text text,"
-                "    clicked integer,"
-                "    domain text,"
-                "    hidden integer,"
-                "    is_self integer,"
-                "    link_flair_css_class text,"
-                "    link_flair_text text,"
-                "    media text,"
-                "    media_embed text,"
-                "    num_comments integer,"
-                "    over_18 integer,"
-                "    permalink text,"
-                "    saved integer,"
-                "    score integer,"
-                "    selftext text,"
-                "    selftext_html text,"
-                "    subreddit text,"
-                "    subreddit_id text,"
-                "    thumbnail text,"
-                "    title text,"
-                "    url text,"
-                "    edited integer,"
-                "    distinguished text,"
-                "    stickied integer"
-                ");"
-            )
+            connection.execute(LINKS.create_statement())
             # drop comments if it exists
             connection.execute('drop table if exists comments;')
             # create comments table
-            connection.execute(
-                "create table comments ("
-                "    id text primary key,"
-                "    created integer,"
-                "    created_utc integer,"
-                "    ups integer,"
-                "    downs integer,"
-                "    likes integer,"
-                "    prefixed_id text,"
-                "    approved_by text,"
-                "    author text,"
-                "    author_flair_css_class text,"
-                "    author_flair_text text,"
-                "    banned_by text,"
-                "    body text, "
-                "    body_html text,"
-                "    edited integer,"
-                "    gilded integer,"
-                "    link_author text,"
-                "    link_id text,"
-                "    link_title text,"
-                "    link_url text,"
-                "    num_reports integer,"
-                "    parent_id text,"
-                "    saved integer,"
-                "    score integer,"
-                "    score_hidden integer,"
-                "    subreddit text,"
-                "    subreddit_id text,"
-                "    distinguished text"
-                ");"
-            )
+            connection.execute(COMMENTS.create_statement())
+            # create the table of media blobs, which the links table refers to
+            connection.execute('drop table if exists media;')
+            connection.execute(MEDIA_TABLE)
+            connection.execute('drop table if exists schema_indexes;')
+            connection.execute(INDEX_TABLE)
+
+            for schema in (LINKS, COMMENTS):
+                for statement in schema.create_index_statements():
+                    connection.execute(statement)
+
+            self.record_indexes(connection)
+
+            for index in (LINKS_SEARCH, COMMENTS_SEARCH):
+                for statement in index.create_statements():
+                    connection.execute(statement)
+
+        self.create_views(connection)
+
+        connection.execute('pragma user_version = %d;' % (SCHEMA_VERSION,))
+
+
+    def create_views(self, connection):
+        """
+        Creates the views presenting the links and comments tables with prefixed base-36 ids, replacing any existing
+        ones. Once the archive has been written with compression, the views decompress its text with the
+        `decompress()` SQL function, which `subredditscraper.database` registers on every connection it makes;
+        until then they can be read from any connection.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        compressed = self.is_compressed(connection)
+
+        with connection:
+            for schema in (LINKS, COMMENTS):
+                connection.execute('drop view if exists %s;' % (schema.view,))
+                connection.execute(schema.create_view_statement(compressed))
+
+
+    def create_search_triggers(self, connection):
+        """
+        Replaces the content views and the triggers of the full-text indexes with those suiting the archive: reading
+        the text as it is, or decompressing it in temporary triggers, which only exist on this connection until it's
+        closed.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        compressed = self.is_compressed(connection)
+
+        with connection:
+            for index in (LINKS_SEARCH, COMMENTS_SEARCH):
+                for statement in index.drop_statements(keep_index=True) + index.create_statements(compressed):
+                    connection.execute(statement)
+
+
+    def is_compressed(self, connection):
+        """
+        Determines whether the archive may hold compressed values: whether it has ever been written with compression,
+        which creates the table of compression dictionaries.
+
+        Arguments:
+        connection: SQLite connection to the database.
+
+        Returns:
+        True if the archive may hold compressed values, False otherwise.
+        """
+        return 'compression_dictionaries' in self.get_table_names(connection)
+
+
+    def get_schema_version(self, connection):
+        """
+        Returns the version of the schema recorded in the database, 0 for databases created before it was recorded.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        return connection.execute('pragma user_version;').fetchone()[0]
+
+
+    def replace_tables(self, connection):
+        """
+        Replaces the tables of a database created by an earlier version of the schema. The only earlier version is
+        that of the tables `create_tables` created before the schema was versioned, which the pipeline never stored
+        rows in, so tables holding rows are left alone rather than migrated.
+
+        Arguments:
+        connection: SQLite connection to the database.
+
+        Raises:
+        IncompatibleSchemaException: If the tables hold rows.
+        """
+        version = self.get_schema_version(connection)
+        rows = sum(connection.execute('select count(*) from %s;' % (i,)).fetchone()[0] for i in ('links', 'comments'))
+
+        if rows:
+            raise IncompatibleSchemaException('The database holds %d rows stored by version %d of the schema, which '
+                'version %d can\'t read; crawl into a new database instead.' % (rows, version, SCHEMA_VERSION))
+
+        logger.warning("Replacing the empty tables of schema version %d with those of version %d.", version,
+            SCHEMA_VERSION)
+
+        self.create_tables(connection)
+
+
+    def update_indexes(self, connection):
+        """
+        Creates the indexes of the links and comments tables which the schema declares and the database lacks, as those
+        added since the database was created, and drops those which were created from the schema but which it no
+        longer declares. Indexes added to the database by hand are left alone. Creating an index on a large archive
+        takes a while.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        with connection:
+            connection.execute(INDEX_TABLE)
+
+            for schema in (LINKS, COMMENTS):
+                existing = set(i[0] for i in connection.execute("select name from sqlite_master where type = 'index' "
+                    "and tbl_name = ?;", (schema.table,)))
+                created = set(i[0] for i in connection.execute('select name from schema_indexes where tbl_name = ?;',
+                    (schema.table,)))
+                declared = [i[0] for i in schema.indexes]
+
+                for name, statement in zip(declared, schema.create_index_statements()):
+                    if name not in existing:
+                        logger.info("Creating index %s, this may take a while.", name)
+                        connection.execute(statement)
+
+                for name in created.difference(declared):
+                    if name in existing:
+                        logger.info("Dropping index %s, which the schema no longer declares.", name)
+                        connection.execute('drop index %s;' % (name,))
+
+                    connection.execute('delete from schema_indexes where name = ?;', (name,))
+
+            self.record_indexes(connection)
+
+
+    def record_indexes(self, connection):
+        """
+        Records the indexes declared by the schema of the links and comments tables as created from it, so that they're
+        dropped once it no longer declares them.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        connection.executemany('insert or ignore into schema_indexes (name, tbl_name) values (?, ?);',
+            ((i[0], schema.table) for schema in (LINKS, COMMENTS) for i in schema.indexes))
+
+
+    def start_bulk_load(self, connection):
+        """
+        Drops the secondary and full-text indexes of the links and comments tables for a bulk load, which builds them
+        again once it's finished. An index is quicker to build in one go than to update row by row.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        rows = sum(connection.execute('select count(*) from %s;' % (i,)).fetchone()[0] for i in ('links', 'comments'))
+
+        if rows:
+            logger.warning("Bulk loading into a database of %d rows, whose indexes will be built again from scratch.",
+                rows)
+
+        with connection:
+            for index in (LINKS_SEARCH, COMMENTS_SEARCH):
+                for statement in index.drop_statements():
+                    connection.execute(statement)
+
+            for schema in (LINKS, COMMENTS):
+                for name, columns, where in schema.indexes:
+                    connection.execute('drop index if exists %s;' % (name,))
+
+
+    def bulk_load_pending(self, connection):
+        """
+        Returns whether a bulk load of the database was interrupted before it finished: its full-text indexes, which
+        exist otherwise, are missing.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        return LINKS_SEARCH.name not in self.get_table_names(connection)
+
+
+    def finish_bulk_load(self, connection):
+        """
+        Finishes a bulk load: builds the secondary indexes, the paths of the comments and the full-text indexes,
+        gathers the statistics the query planner chooses indexes by, and applies the pipeline's connection profile
+        in place of the `bulk` one.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        started = time.time()
+
+        logger.info("Building the indexes of the bulk loaded database, this may take a while.")
+
+        self.update_indexes(connection)
+        compressed = self.is_compressed(connection)
+
+        with connection:
+            self.paths.rebuild(connection)
+
+            for index in (LINKS_SEARCH, COMMENTS_SEARCH):
+                for statement in index.create_statements(compressed):
+                    connection.execute(statement)
+
+                connection.execute(index.rebuild_statement())
+
+        # sampling a bounded number of rows per index, so that it doesn't take as long as building them
+        connection.execute('pragma analysis_limit = 1000;')
+        connection.execute('analyze;')
+
+        apply_profile(connection, self.profile)
+        self.bulk_load = False
+
+        logger.info("Built the indexes of the bulk loaded database in %.1f seconds.", time.time() - started)
+
+        if self.stats is not None:
+            self.stats.set_value('sqlite/bulk_load/finish_seconds', time.time() - started)
+            self.stats.set_value('sqlite/profile', self.profile)
+
+
+    def create_staging_tables(self, connection):
+        """
+        Creates the temporary staging tables that batches are loaded into before being upserted into the links and
+        comments tables. Temporary tables are private to the connection and vanish when it's closed.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        with connection:
+            connection.execute('create temp table if not exists link_staging as select * from main.links limit 0;')
+            connection.execute('create temp table if not exists comment_staging as select * from main.comments '
+                'limit 0;')
 
 
     def close_spider(self, spider):
         """
-        Callback method triggered on finish of the spider.
+        Callback method triggered on finish of the spider. Flushes any buffered rows and closes the connection. In
+        writer thread mode, the queue is drained off of the reactor thread.
 
         Arguments:
         spider: The spider instance which has finished with this pipeline.
+
+        Returns:
+        A deferred firing once the writer thread has finished, in writer thread mode.
         """
-        pass
+        if self.flush_loop is not None:
+            self.flush_loop.stop()
+            self.flush_loop = None
+
+        if self.writer_thread:
+            # behind any rows still waiting on the put thread, so that the writer stores them before it stops
+            if self.put_pool is not None:
+                return threads.deferToThreadPool(reactor, self.put_pool, self.stop_writer).addBoth(self.stop_put_pool)
+
+            return threads.deferToThread(self.stop_writer)
+
+        self.close_connection()
 
 
     def process_item(self, item, spider):
         """
-        Callback method triggered for each item recovered from the spider.
+        Callback method triggered for each item recovered from the spider. Items are serialized into rows, unless the
+        spider converted them into rows already, and buffered; the buffer is written in a single transaction once it
+        holds `batch_size` rows or once `flush_interval` seconds have passed since the last flush. In writer thread
+        mode, rows are handed to the writer thread instead and a deferred is returned.
 
         Arguments:
         item: The item produced by the spider.
         spider: The spider which produced the item.
         """
-        # TODO create a connection object to the database file for every single item (because sqlite hates threads)
-        # TODO select count(*) from [links|comments] where id = ?; if > 0, update, else insert
-        pass
+        if isinstance(item, (LinkRow, Link)):
+            entry = ('links', item['row'] if isinstance(item, LinkRow) else LINKS.serialize(item))
+
+            if entry[1][0] not in self.link_index:
+                self.link_index.add(entry[1][0], -1)
+        elif isinstance(item, (CommentRow, Comment)):
+            entry = ('comments', item['row'] if isinstance(item, CommentRow) else COMMENTS.serialize(item))
+            self.comment_index.add(entry[1][0])
+        elif isinstance(item, CommentsFetched):
+            entry = ('fetched', (decode_id(item['link_id']), item['num_comments']))
+            self.link_index.add(entry[1][0], entry[1][1])
+        else:
+            return item
+
+        if self.writer_thread:
+            return self.enqueue(entry, item)
+
+        self.buffer(*entry)
+
+        return item
+
+
+    def buffer(self, table, row):
+        """
+        Buffers a serialized row for writing, flushing the buffer if it's full or if the flush interval has passed.
+
+        Arguments:
+        table: The name of the table the row belongs to.
+        row: The serialized row tuple.
+        """
+        if table == 'links':
+            self.links[row[0]] = row
+        elif table == 'comments':
+            self.comments[row[0]] = row
+        else:
+            self.fetched[row[0]] = row[1]
+
+        if len(self.links) + len(self.comments) + len(self.fetched) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_expired()
+
+
+    def flush_loop_failed(self, reason):
+        """
+        Errback of the looping call flushing the buffer on an interval, which stops once a flush fails. Buffered rows
+        are still flushed as items arrive, where any further failure is raised.
+        """
+        logger.error("Flushing buffered rows on an interval failed, only flushing them as items arrive: %s",
+            reason.getErrorMessage())
+
+
+    def flush_expired(self):
+        """
+        Flushes the buffer if the flush interval has passed since the last flush.
+        """
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Writes all buffered link and comment rows to the database in a single transaction. Rows are buffered by id,
+        so an item seen twice within a batch is only written once. The links whose comments have been fetched are
+        marked last, in the same transaction as their comments or one after it. If the transaction fails, the rows
+        stay buffered for the next flush.
+
+        Returns:
+        A dictionary mapping each table name to a dictionary of `inserted`, `updated` and `unchanged` row counts.
+        """
+        self.last_flush = time.time()
+
+        if not self.links and not self.comments and not self.fetched:
+            return {}
+
+        links, comments, fetched = self.links.values(), self.comments.values(), self.fetched.items()
+
+        result = {}
+        keys = []
+        adopted = 0
+        dictionary = (self.compressor.dictionary_id, self.compressor.codec) if self.compressor is not None else None
+
+        try:
+            with self.connection:
+                if links:
+                    links, keys = self.store_media(self.connection, links)
+
+                # a bulk load builds the paths once it's finished, as the indexes they're built with don't exist yet
+                if comments and not self.bulk_load:
+                    comments = self.paths.build_paths(self.connection, comments)
+
+                if self.compressor is not None:
+                    links = self.compressor.compress_rows(self.connection, links, LINKS.compressed)
+                    comments = self.compressor.compress_rows(self.connection, comments, COMMENTS.compressed)
+
+                if links:
+                    result['links'] = self.upsert(self.connection, 'links', 'link_staging', self.link_columns, links,
+                        [self.link_columns[i] for i in LINKS.preserved])
+                if comments:
+                    result['comments'] = self.upsert(self.connection, 'comments', 'comment_staging',
+                        self.comment_columns, comments, [self.comment_columns[i] for i in COMMENTS.preserved])
+                    adopted = self.paths.adopt(self.connection, comments) if not self.bulk_load else 0
+                if fetched:
+                    self.connection.executemany('update links set comments_fetched = ? where id = ?;', ((count, id)
+                        for id, count in fetched))
+        except Exception:
+            # the rows stay buffered for the next flush to retry, so forget what the rolled back transaction did
+            self.paths.load(self.connection)
+
+            if dictionary is not None:
+                self.compressor.dictionary_id, self.compressor.codec = dictionary
+
+            raise
+
+        self.links, self.comments, self.fetched = OrderedDict(), OrderedDict(), OrderedDict()
+
+        # only once they're committed, lest a failed flush leave keys of blobs which were never stored
+        for key in keys:
+            self.media_cache.add(key)
+
+        for table, counts in result.items():
+            logger.debug("Flushed %(table)s: %(inserted)d inserted, %(updated)d updated, %(unchanged)d unchanged.",
+                dict(counts, table=table))
+
+            for key, value in counts.items():
+                self.inc_stat('sqlite/%s/%s' % (table, key), value)
+
+        if adopted:
+            self.inc_stat('sqlite/comments/adopted', adopted)
+
+        self.inc_stat('sqlite/commits')
+        self.inc_stat('sqlite/rows', len(links) + len(comments))
+
+        if self.stats is not None:
+            self.stats.set_value('sqlite/rows_per_commit',
+                float(self.stats.get_value('sqlite/rows')) / self.stats.get_value('sqlite/commits'))
+            self.stats.set_value('sqlite/comments/orphans', len(self.paths.orphans))
+
+            if self.compressor is not None:
+                self.stats.set_value('sqlite/compression/bytes_in', self.compressor.bytes_in)
+                self.stats.set_value('sqlite/compression/bytes_out', self.compressor.bytes_out)
+                self.stats.set_value('sqlite/compression/dictionary', self.compressor.dictionary_id)
+
+        return result
+
+
+    def store_media(self, connection, rows):
+        """
+        Replaces the media blobs of link rows by their keys, storing those which aren't in the media cache in the media
+        table, compressed if the pipeline compresses. This method doesn't commit; call it inside of a transaction.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        rows: A list of link row tuples.
+
+        Returns:
+        A tuple of the rows with their blobs replaced and the keys of the blobs stored, to add to the media cache once
+        committed.
+        """
+        result = []
+        blobs = {}
+        references = hits = 0
+
+        for row in rows:
+            row = list(row)
+
+            for i in LINKS.deduplicated:
+                if row[i] is None:
+                    continue
+
+                key = media_key(row[i])
+
+                if key in self.media_cache:
+                    hits += 1
+                else:
+                    blobs[key] = row[i]
+
+                row[i] = key
+                references += 1
+
+            result.append(tuple(row))
+
+        self.media_references += references
+        self.inc_stat('sqlite/media/references', references)
+        self.inc_stat('sqlite/media/cache_hits', hits)
+
+        if blobs:
+            compress = self.compressor.compress if self.compressor is not None else lambda a: a
+            inserted = connection.executemany('insert or ignore into media (id, value) values (?, ?);',
+                [(key, compress(value)) for key, value in blobs.items()]).rowcount
+
+            self.media_inserted += inserted
+            self.inc_stat('sqlite/media/inserted', inserted)
+
+        return result, blobs.keys()
+
+
+    def upsert(self, connection, table, staging_table, columns, rows, preserved=()):
+        """
+        Inserts or updates rows in a table with a single set-based statement. Rows are first loaded into a staging
+        table and then merged on the `id` primary key; existing rows are only rewritten if at least one of their
+        columns actually differs, so re-crawling unchanged content causes no write traffic.
+
+        This method doesn't commit; call it inside of a transaction.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        table: The name of the table to merge the rows into.
+        staging_table: The name of the temporary staging table for `table`.
+        columns: The column names of the rows, in order. The first column must be the primary key.
+        rows: A list of row tuples with unique primary keys.
+        preserved: The names of the columns which are only set by inserts, and which updates leave as they are.
+
+        Returns:
+        A dictionary of `inserted`, `updated` and `unchanged` row counts.
+        """
+        connection.execute('delete from temp.%s;' % (staging_table,))
+        connection.executemany('insert into temp.%(staging)s (%(columns)s) values (%(params)s);' % {
+            'staging': staging_table,
+            'columns': ', '.join(columns),
+            'params': ', '.join('?' * len(columns)),
+        }, rows)
+
+        existing = connection.execute('select count(*) from temp.%(staging)s where id in (select id from %(table)s);'
+            % {'staging': staging_table, 'table': table}).fetchone()[0]
+
+        changed = connection.execute(self.upsert_statement(table, staging_table, columns, preserved)).rowcount
+
+        inserted = len(rows) - existing
+        updated = changed - inserted
+
+        return {'inserted': inserted, 'updated': updated, 'unchanged': existing - updated}
+
+
+    def upsert_statement(self, table, staging_table, columns, preserved=()):
+        """
+        Builds the statement merging a staging table into its table.
+
+        Arguments:
+        table: The name of the table to merge the rows into.
+        staging_table: The name of the temporary staging table for `table`.
+        columns: The column names of the rows, in order. The first column must be the primary key.
+        preserved: The names of the columns which updates leave as they are.
+
+        Returns:
+        An SQL statement string.
+        """
+        updated = [c for c in columns[1:] if c not in preserved]
+
+        return ('insert into %(table)s (%(columns)s) select %(columns)s from temp.%(staging)s where true '
+            'on conflict(%(key)s) do update set %(assignments)s where %(changes)s;') % {
+            'table': table,
+            'staging': staging_table,
+            'key': columns[0],
+            'columns': ', '.join(columns),
+            'assignments': ', '.join('%(c)s = excluded.%(c)s' % {'c': c} for c in updated),
+            'changes': ' or '.join('excluded.%(c)s is not %(t)s.%(c)s' % {'c': c, 't': table} for c in updated),
+        }
+
+
+    def inc_stat(self, key, count=1):
+        """
+        Increments a stats value if a stats collector is available. In writer thread mode this is called from the
+        writer thread; that's safe as the keys written by this pipeline aren't touched by anything else.
+
+        Arguments:
+        key: The name of the stat to increment.
+        count: The amount to increment the stat by.
+        """
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import calendar
+import json
+import sys
+import time
+
+from subredditscraper.database import connect_reader
+from subredditscraper.exceptions import InvalidIdException
+from subredditscraper.ids import COMMENT_PREFIX, LINK_PREFIX, decode_id
+from subredditscraper.schema import COMMENTS, LINKS
+
+
+"""
+The orders results can be listed in, by the SQL ordering their table by it. Listing comments in `thread` order, as
+`subredditscraper.threads` does, is only quick within a single link.
+"""
+ORDERS = {
+    'new': '%(table)s.created_utc desc',
+    'old': '%(table)s.created_utc',
+    'top': '%(table)s.score desc',
+    'thread': '%(table)s.link_id, %(table)s.path',
+}
+
+
+def parse_time(value):
+    """
+    Parses a time given on the command line, either in seconds since the epoch or as a UTC date, with or without a
+    time: `2015-08-03` or `2015-08-03T18:30:00`.
+
+    Arguments:
+    value: The text of the time.
+
+    Returns:
+    The time in seconds since the epoch.
+
+    Raises:
+    ValueError: If the time isn't in either format.
+    """
+    if value.isdigit():
+        return int(value)
+
+    for format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return calendar.timegm(time.strptime(value, format))
+        except ValueError:
+            pass
+
+    raise ValueError("%s is neither seconds since the epoch nor a date" % (value,))
+
+
+def build_query(schema, conditions, parameters, order='new', limit=None):
+    """
+    Builds a query of the rows of a table, presented as its view presents them, which meet some conditions. Conditions
+    refer to the columns of the table, not those of the view.
+
+    Arguments:
+    schema: The schema of the table.
+    conditions: A list of SQL conditions, all of which rows must meet.
+    parameters: A list of the parameters of the conditions.
+    order: The name of an order in `ORDERS`.
+    limit: The maximum number of rows, or None for all of them.
+
+    Returns:
+    A tuple of the statement and its parameters.
+    """
+    return ('select %s from %s%s order by %s limit ?;' % (schema.view_columns(), schema.table, ' where %s' % (
+        ' and '.join(conditions),) if conditions else '', ORDERS[order] % {'table': schema.table}),
+        tuple(parameters) + (limit if limit is not None else -1,))
+
+
+def time_conditions(table, since=None, until=None, min_score=None):
+    """
+    Returns the conditions and parameters shared by queries of links and comments.
+    """
+    conditions, parameters = [], []
+
+    if since is not None:
+        conditions.append('%s.created_utc >= ?' % (table,))
+        parameters.append(since)
+
+    if until is not None:
+        conditions.append('%s.created_utc < ?' % (table,))
+        parameters.append(until)
+
+    if min_score is not None:
+        conditions.append('%s.score >= ?' % (table,))
+        parameters.append(min_score)
+
+    return conditions, parameters
+
+
+def query_links(subreddit=None, author=None, since=None, until=None, min_score=None, order='new', limit=None):
+    """
+    Builds a query of links. Each filter is served by an index of its own: `subreddit` by `links_subreddit`, `author`
+    by `links_author`, a time range by `links_created` and a minimum score by `links_score`.
+
+    Arguments:
+    subreddit: The name of the subreddit, in any case.
+    author: The name of the author.
+    since: The earliest time the links were posted, inclusive, in seconds since the epoch.
+    until: The latest time the links were posted, exclusive, in seconds since the epoch.
+    min_score: The lowest score of the links.
+    order: The name of an order in `ORDERS`, but `thread`.
+    limit: The maximum number of links, or None for all of them.
+
+    Returns:
+    A tuple of the statement and its parameters.
+    """
+    conditions, parameters = time_conditions('links', since, until, min_score)
+
+    if subreddit is not None:
+        conditions.append('links.subreddit = ? collate nocase')
+        parameters.append(subreddit)
+
+    if author is not None:
+        conditions.append('links.author = ?')
+        parameters.append(author)
+
+    return build_query(LINKS, conditions, parameters, order, limit)
+
+
+def query_comments(author=None, link_id=None, parent_id=None, since=None, until=None, min_score=None, order='new',
+        limit=None):
+    """
+    Builds a query of comments. Each filter is served by an index of its own: `author` by `comments_author`, `link_id`
+    by `comments_thread`, `parent_id` by `comments_parent`, or by `comments_thread` for the replies to a link, a time
+    range by `comments_created` and a minimum score by `comments_score`.
+
+    Arguments:
+    author: The name of the author.
+    link_id: The id of the link commented on, base-36 with or without its prefix.
+    parent_id: The prefixed base-36 id of the comment or link replied to.
+    since: The earliest time the comments were posted, inclusive, in seconds since the epoch.
+    until: The latest time the comments were posted, exclusive, in seconds since the epoch.
+    min_score: The lowest score of the comments.
+    order: The name of an order in `ORDERS`.
+    limit: The maximum number of comments, or None for all of them.
+
+    Returns:
+    A tuple of the statement and its parameters.
+    """
+    conditions, parameters = time_conditions('comments', since, until, min_score)
+
+    if author is not None:
+        conditions.append('comments.author = ?')
+        parameters.append(author)
+
+    if link_id is not None:
+        conditions.append('comments.link_id = ?')
+        parameters.append(decode_id(link_id))
+
+    if parent_id is not None and parent_id.startswith(LINK_PREFIX):
+        # top-level comments have no parent id, and are found by their link instead
+        conditions.extend(['comments.link_id = ?', 'comments.parent_id is null'])
+        parameters.append(decode_id(parent_id))
+    elif parent_id is not None:
+        conditions.append('comments.parent_id = ?')
+        parameters.append(decode_id(parent_id))
+
+    return build_query(COMMENTS, conditions, parameters, order, limit)
+
+
+def find_links(connection, **kwargs):
+    """
+    Reads links, as filtered by `query_links`.
+
+    Returns:
+    A cursor of rows with the columns of the links view, read as they're iterated over.
+    """
+    return connection.execute(*query_links(**kwargs))
+
+
+def find_comments(connection, **kwargs):
+    """
+    Reads comments, as filtered by `query_comments`.
+
+    Returns:
+    A cursor of rows with the columns of the comments view, read as they're iterated over.
+    """
+    return connection.execute(*query_comments(**kwargs))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-query',
+        description="Lists the posts or comments in an archive by subreddit, author, thread, time or score, as they're "
+                    "read rather than all at once.")
+    parser.add_argument('-d', '--database-file', default="subreddits.db",
+        help="The database file to read from.")
+    parser.add_argument('-c', '--comments', action='store_true',
+        help="List comments rather than posts; implied by --link and --parent.")
+    parser.add_argument('-s', '--subreddit',
+        help="Only list posts in this subreddit.")
+    parser.add_argument('-a', '--author',
+        help="Only list posts or comments by this author.")
+    parser.add_argument('-l', '--link',
+        help="Only list comments on the post with this id.")
+    parser.add_argument('-p', '--parent',
+        help="Only list replies to the comment or post with this prefixed id.")
+    parser.add_argument('--since', type=parse_time,
+        help="Only list posts or comments made at or after this time, a UTC date or seconds since the epoch.")
+    parser.add_argument('--until', type=parse_time,
+        help="Only list posts or comments made before this time, a UTC date or seconds since the epoch.")
+    parser.add_argument('--min-score', type=int,
+        help="Only list posts or comments scoring at least this much.")
+    parser.add_argument('-o', '--order', choices=sorted(ORDERS.keys()), default='new',
+        help="The order to list posts or comments in; thread order only applies to comments.")
+    parser.add_argument('-n', '--limit', type=int,
+        help="The maximum number of posts or comments to list.")
+    parser.add_argument('--json', action='store_true',
+        help="Print every post or comment as a JSON object on a line of its own.")
+
+    args = parser.parse_args()
+
+    comments = args.comments or args.link is not None or args.parent is not None
+
+    if args.parent is not None and not args.parent.startswith((COMMENT_PREFIX, LINK_PREFIX)):
+        parser.error("the parent id must be prefixed by %s or %s" % (COMMENT_PREFIX, LINK_PREFIX))
+
+    if comments and args.subreddit is not None:
+        parser.error("comments can't be listed by subreddit, list the posts of the subreddit instead")
+
+    if not comments and args.order == 'thread':
+        parser.error("posts can't be listed in thread order")
+
+    filters = dict(author=args.author, since=args.since, until=args.until, min_score=args.min_score,
+        order=args.order, limit=args.limit)
+
+    connection = connect_reader(args.database_file)
+
+    try:
+        try:
+            if comments:
+                rows = find_comments(connection, link_id=args.link, parent_id=args.parent, **filters)
+            else:
+                rows = find_links(connection, subreddit=args.subreddit, **filters)
+        except InvalidIdException as e:
+            parser.error(str(e))
+
+        for row in rows:
+            if args.json:
+                line = json.dumps(dict(zip(row.keys(), row)), sort_keys=True)
+            else:
+                line = u'%s\t%s\t%s\t%s\t%s' % (row['prefixed_id'],
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(row['created_utc'] or 0)), row['author'],
+                    row['score'], ((row['body'] if comments else row['title']) or u'').replace(u'\n', u' ')[:100])
+
+            sys.stdout.write(line.encode('utf-8') + '\n')
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+from subredditscraper.ids import base36_sql, decode_id, parent_id_serializer
+from subredditscraper.items import (
+    Comment,
+    Link,
+    bool_serializer,
+    edited_serializer,
+    time_serializer,
+)
+from subredditscraper.media import MEDIA_EXPRESSION
+
+
+"""
+The version of the schema, stored in the database's `user_version` pragma when its tables are created. Bump it whenever
+the tables generated from the items change.
+"""
+SCHEMA_VERSION = 1
+
+
+"""
+The statement creating the table recording the indexes created from the schemas by name, so that an index the schema
+no longer declares is dropped, while those added to the database by hand are left alone.
+"""
+INDEX_TABLE = 'create table if not exists schema_indexes (name text primary key, tbl_name text not null);'
+
+
+"""
+The SQL types of columns by the serializer of their field; columns of fields without one of these are text.
+"""
+SQL_TYPES = {
+    int: 'integer',
+    bool: 'integer',
+    bool_serializer: 'integer',
+    decode_id: 'integer',
+    edited_serializer: 'integer',
+    parent_id_serializer: 'integer',
+    time_serializer: 'integer',
+}
+
+
+"""
+The expressions presenting columns in views by the serializer of their field, formatted with the name of the column.
+Ids are shown in their base-36 form, worked out in plain SQL so that any connection can read them.
+"""
+VIEW_EXPRESSIONS = {
+    decode_id: base36_sql('%(column)s'),
+}
+
+
+"""
+The expression presenting compressed columns in views, formatted with the name of the column. Values are decompressed by
+the `decompress()` function registered by `subredditscraper.database`, which returns uncompressed values as they are.
+"""
+COMPRESSED_EXPRESSION = 'decompress(%(column)s)'
+
+
+"""
+Expressions inlined into the serializer in place of calls to common serializers, formatted with the name of the variable
+holding the value.
+"""
+INLINE_SERIALIZERS = {
+    int: 'int(%s)',
+    bool: 'bool(%s)',
+    bool_serializer: 'bool(%s)',
+    time_serializer: 'round(float(%s))',
+    unicode: 'unicode(%s)',
+}
+
+
+class Schema(object):
+    """
+    The table of an item class. Every field of the item is a column, the `id` first and the rest by name, unless it's
+    declared with `stored=False`; a column's type follows from the field's serializer, and its value is read from the
+    key of a Reddit thing's 'data' named by the field's `source`, or by the field's name if it has none. The `id` is an
+    integer primary key, so that the table is keyed by its rowid.
+
+    Fields declared with `computed=True` aren't read from Reddit, but filled in by the pipeline as rows are stored;
+    those also declared with `preserved=True` are set by updates of their own, and upserts leave them as they are;
+    `preserved` lists the indexes of their columns.
+    `indexes` are tuples of the name, the columns and, for partial indexes, the condition of the indexes of the table.
+
+    Every field, stored or not, is a column of the table's view, which presents the table as Reddit does, with
+    prefixed base-36 ids: a field's `view` is the SQL expression of its column in the view. Fields declared with
+    `compressed=True` hold large text, which the pipeline may store compressed; `compressed` lists the indexes of their
+    columns, and the view of a compressed archive decompresses them. Fields declared with `deduplicated=True` hold blobs
+    stored once in the media table, by `subredditscraper.media`; their columns hold the blobs' keys, `deduplicated`
+    lists their indexes, and the view looks the blobs up. The views of an archive stored without compression can be
+    read from any SQLite connection; those of a compressed one need the `decompress()` function which
+    `subredditscraper.database` registers.
+
+    From this, a schema generates the table's create statements and two converters into row tuples in column order,
+    each compiled into a single function with the serializers of every column inlined or bound in advance:
+
+    convert(data):   Converts the 'data' dictionary of a raw Reddit thing, such as a `t3` listing child, as the spider
+                     does with every child it parses.
+    serialize(item): Converts a Link or Comment item.
+    """
+
+    def __init__(self, table, item_class, indexes=()):
+        """
+        Constructor for the Schema.
+
+        Arguments:
+        table: The name of the table.
+        item_class: The item class stored in the table.
+        indexes: The indexes of the table.
+        """
+        self.table = table
+        self.view = '%s_view' % (table,)
+        self.item_class = item_class
+        self.indexes = indexes
+
+        fields = item_class.fields
+
+        self.columns = ('id',) + tuple(sorted(i for i in fields.keys() if i != 'id' and fields[i].get('stored', True)))
+        self.types = tuple('integer' if fields[i].get('deduplicated') else SQL_TYPES.get(fields[i].get('serializer'),
+            'text') for i in self.columns)
+        self.sources = tuple(fields[i].get('source', i) for i in self.columns)
+        self.compressed = tuple(n for n, i in enumerate(self.columns) if fields[i].get('compressed'))
+        self.deduplicated = tuple(n for n, i in enumerate(self.columns) if fields[i].get('deduplicated'))
+        self.preserved = tuple(n for n, i in enumerate(self.columns) if fields[i].get('preserved'))
+
+        self.convert = self.compile('convert_%s' % (table,), self.sources)
+        self.serialize = self.compile('serialize_%s' % (table,), self.columns)
+
+
+    def compile(self, name, keys):
+        """
+        Generates and compiles a converter reading each column from a mapping.
+
+        Arguments:
+        name: The name of the generated function.
+        keys: The key each column is read from, in column order.
+
+        Returns:
+        A function taking a mapping and returning a row tuple.
+        """
+        namespace = {}
+        lines = ['def %s(data):' % (name,), '    get = data.get']
+
+        for i, (column, key) in enumerate(zip(self.columns, keys)):
+            serializer = self.item_class.fields[column].get('serializer')
+
+            if self.item_class.fields[column].get('computed'):
+                lines.append('    c%d = None' % (i,))
+                continue
+
+            lines.append('    c%d = get(%r)' % (i, key))
+
+            if serializer in INLINE_SERIALIZERS:
+                lines.append('    if c%d is not None: c%d = %s' % (i, i, INLINE_SERIALIZERS[serializer] % ('c%d' % i,)))
+            elif serializer is not None:
+                namespace['s%d' % (i,)] = serializer
+                lines.append('    if c%d is not None: c%d = s%d(c%d)' % (i, i, i, i))
+
+        lines.append('    return (%s,)' % (', '.join('c%d' % (i,) for i in range(len(self.columns))),))
+
+        exec compile('\n'.join(lines), '<schema %s>' % (self.table,), 'exec') in namespace
+
+        return namespace[name]
+
+
+    def create_statement(self):
+        """
+        Generates the statement creating the table.
+        """
+        return 'create table %s (%s);' % (self.table, ', '.join('%s %s%s' % (column, sql_type,
+            ' primary key' if column == 'id' else '') for column, sql_type in zip(self.columns, self.types)))
+
+
+    def create_index_statements(self):
+        """
+        Generates the statements creating the table's indexes, unless they exist.
+        """
+        return ['create index if not exists %s on %s (%s)%s;' % (name, self.table, columns, ' where %s' % (where,)
+            if where else '') for name, columns, where in self.indexes]
+
+
+    def create_view_statement(self, compressed=True):
+        """
+        Generates the statement creating the table's view.
+
+        Arguments:
+        compressed: Whether the archive may hold compressed values, which the view then decompresses.
+        """
+        return 'create view %s as select %s from %s;' % (self.view, self.view_columns(compressed), self.table)
+
+
+    def view_columns(self, compressed=True):
+        """
+        Generates the columns of the table's view, as the expressions of a select from the table.
+
+        Arguments:
+        compressed: Whether the archive may hold compressed values, which are then decompressed.
+        """
+        fields = self.item_class.fields
+
+        return ', '.join('%s as %s' % (self.view_expression(i, compressed), i) for i in ('id',) + tuple(sorted(i for
+            i in fields.keys() if i != 'id')))
+
+
+    def view_expression(self, name, compressed=True):
+        """
+        Returns the SQL expression presenting a field in the table's view.
+
+        Arguments:
+        name: The name of the field.
+        compressed: Whether the archive may hold compressed values, which are then decompressed.
+        """
+        field = self.item_class.fields[name]
+
+        if field.get('view'):
+            return field['view']
+
+        if field.get('deduplicated'):
+            expression = MEDIA_EXPRESSION % {'table': self.table, 'column': name}
+
+            return COMPRESSED_EXPRESSION % {'column': expression} if compressed else expression
+
+        if field.get('compressed'):
+            return COMPRESSED_EXPRESSION % {'column': name} if compressed else name
+
+        return VIEW_EXPRESSIONS.get(field.get('serializer'), '%(column)s') % {'column': name}
+
+
+# every index slows down writes; only add those serving an access pattern of the spider or subredditscraper.query
+LINKS = Schema('links', Link, indexes=(
+    ('links_subreddit', 'subreddit collate nocase, created_utc', None),
+    ('links_author', 'author, created_utc', None),
+    ('links_created', 'created_utc', None),
+    ('links_score', 'score', None),
+))
+
+COMMENTS = Schema('comments', Comment, indexes=(
+    ('comments_thread', 'link_id, path', None),
+    ('comments_orphans', 'path', 'rooted = 0'),
+    ('comments_author', 'author, created_utc', None),
+    ('comments_parent', 'parent_id', None),
+    ('comments_created', 'created_utc', None),
+    ('comments_score', 'score', None),
+))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sqlite3
+import sys
+
+from subredditscraper.database import connect_reader
+
+
+"""
+The tokenizer of the full-text indexes: words folded to lowercase ASCII where they have an accent, and stemmed, so that
+a search for "looping" finds "loop" and "loops".
+"""
+TOKENIZER = 'porter unicode61 remove_diacritics 2'
+
+
+class SearchIndex(object):
+    """
+    A full-text index of the text columns of a table, an FTS5 table with external content: it only holds the index,
+    and reads the text of the rows it matches, for snippets, back from the table through a view.
+
+    The index is kept up to date by triggers on the table, so that every batch the pipeline upserts is indexed in the
+    same transaction, and a row updated without its text changing, as most are when crawling again, isn't reindexed.
+    In an archive stored without compression, the triggers and the view read the columns as they are, so the archive
+    can be written from any SQLite connection. In a compressed one they decompress them with the `decompress()` SQL
+    function, which only connections made by `subredditscraper.database` have; there the triggers are temporary ones,
+    created by the pipeline on its own connection, so that other connections can still write to the archive. Their
+    changes aren't indexed until the index is rebuilt.
+    """
+
+    def __init__(self, name, table, columns):
+        """
+        Constructor for the SearchIndex.
+
+        Arguments:
+        name: The name of the FTS5 table.
+        table: The name of the table indexed.
+        columns: The names of the text columns indexed.
+        """
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.content = '%s_content' % (name,)
+
+
+    def create_statements(self, compressed=False):
+        """
+        Generates the statements creating the index, its content view and its triggers, unless they exist. The index
+        is empty until it's rebuilt.
+
+        Arguments:
+        compressed: Whether the archive may hold compressed values, which the view and the triggers then decompress,
+                    the triggers being temporary ones on the connection which runs the statements.
+        """
+        expression = 'decompress(%s)' if compressed else '%s'
+
+        values = {
+            'name': self.name,
+            'table': self.table,
+            'content': self.content,
+            'temp': 'temp ' if compressed else '',
+            # temporary triggers live in the temp schema, so have to name the schema of their table
+            'target': 'main.%s' % (self.table,) if compressed else self.table,
+            'columns': ', '.join(self.columns),
+            'values': ', '.join('%s as %s' % (expression % (i,), i) for i in self.columns),
+            'old': ', '.join(expression % ('old.%s' % (i,),) for i in self.columns),
+            'new': ', '.join(expression % ('new.%s' % (i,),) for i in self.columns),
+            'changed': ' or '.join('old.%s is not new.%s' % (i, i) for i in self.columns),
+            'tokenizer': TOKENIZER,
+        }
+
+        return [i % values for i in (
+            'create view if not exists %(content)s as select id, %(values)s from %(table)s;',
+            "create virtual table if not exists %(name)s using fts5(%(columns)s, content='%(content)s', "
+                "content_rowid='id', tokenize='%(tokenizer)s');",
+            'create %(temp)strigger if not exists %(name)s_insert after insert on %(target)s begin '
+                'insert into %(name)s (rowid, %(columns)s) values (new.id, %(new)s); end;',
+            'create %(temp)strigger if not exists %(name)s_delete after delete on %(target)s begin '
+                "insert into %(name)s (%(name)s, rowid, %(columns)s) values ('delete', old.id, %(old)s); end;",
+            'create %(temp)strigger if not exists %(name)s_update after update of %(columns)s on %(target)s when '
+                "%(changed)s begin insert into %(name)s (%(name)s, rowid, %(columns)s) values ('delete', old.id, "
+                "%(old)s); insert into %(name)s (rowid, %(columns)s) values (new.id, %(new)s); end;",
+        )]
+
+
+    def drop_statements(self, keep_index=False):
+        """
+        Generates the statements dropping the index, its content view and its triggers, if they exist.
+
+        Arguments:
+        keep_index: If True, only drop the view and the triggers, so that they can be created again for an archive
+                    which has been compressed since, leaving what's been indexed as it is.
+        """
+        result = ['drop trigger if exists %s.%s_%s;' % (schema, self.name, i) for schema in ('main', 'temp') for i in
+            ('insert', 'delete', 'update')] + ['drop view if exists %s;' % (self.content,)]
+
+        return result if keep_index else result + ['drop table if exists %s;' % (self.name,)]
+
+
+    def rebuild_statement(self):
+        """
+        Generates the statement indexing every row of the table again, as after a bulk load.
+        """
+        return "insert into %(name)s (%(name)s) values ('rebuild');" % {'name': self.name}
+
+
+LINKS_SEARCH = SearchIndex('links_search', 'links', ('title', 'selftext'))
+
+COMMENTS_SEARCH = SearchIndex('comments_search', 'comments', ('body',))
+
+
+"""
+The queries searching each kind of thing, all giving the columns of a search result, with named parameters for the
+query, the markers of the matches in snippets and the number of tokens in a snippet.
+"""
+SEARCH_QUERIES = {
+    't3': "select 't3_' || base36(links.id) as id, 't3_' || base36(links.id) as link_id, links.subreddit as subreddit, "
+        "links.author as author, links.score as score, links.created_utc as created_utc, decompress(links.title) as "
+        "title, snippet(links_search, -1, :open, :close, '...', :tokens) as snippet, links_search.rank as rank from "
+        "links_search join links on links.id = links_search.rowid where links_search match :query",
+    't1': "select 't1_' || base36(comments.id) as id, 't3_' || base36(comments.link_id) as link_id, comments.subreddit "
+        "as subreddit, comments.author as author, comments.score as score, comments.created_utc as created_utc, null "
+        "as title, snippet(comments_search, 0, :open, :close, '...', :tokens) as snippet, comments_search.rank as rank "
+        "from comments_search join comments on comments.id = comments_search.rowid where comments_search match :query",
+}
+
+
+def search(connection, query, kinds=('t3', 't1'), limit=20, offset=0, highlight=('[', ']'), tokens=16):
+    """
+    Searches the text of links and comments, best matches first.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    query: An FTS5 query: words, "quoted phrases", prefixes*, AND, OR, NOT, and columns such as `title: loop`.
+    kinds: The kinds of things to search, `t3` for links and `t1` for comments.
+    limit: The number of results to return.
+    offset: The number of results to skip, for the pages after the first.
+    highlight: The texts marking the start and the end of each match in snippets.
+    tokens: The number of tokens in a snippet.
+
+    Returns:
+    A cursor of rows of the prefixed `id` and `link_id` of each thing, its `subreddit`, `author`, `score`,
+    `created_utc`, the `title` of links, a `snippet` of its text, and its `rank`, lower being better. Ranks of links
+    and comments are both BM25, but computed over different tables, so they only roughly compare.
+
+    Raises:
+    sqlite3.OperationalError: If the query isn't valid FTS5 syntax.
+    """
+    return connection.execute('select * from (%s) order by rank limit :limit offset :offset;' % (' union all '.join(
+        SEARCH_QUERIES[i] for i in kinds),), {'query': query, 'limit': limit, 'offset': offset,
+        'open': highlight[0], 'close': highlight[1], 'tokens': tokens})
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-search',
+        description="Searches the titles and text of the posts and the bodies of the comments in an archive.")
+    parser.add_argument('-d', '--database-file', default="subreddits.db",
+        help="The database file to search.")
+    parser.add_argument('--posts', action='store_const', dest='kinds', const=('t3',), default=('t3', 't1'),
+        help="Only search posts.")
+    parser.add_argument('--comments', action='store_const', dest='kinds', const=('t1',),
+        help="Only search comments.")
+    parser.add_argument('-n', '--per-page', type=int, default=20,
+        help="The number of results per page.")
+    parser.add_argument('-p', '--page', type=int, default=1,
+        help="The page of results to print, starting at 1.")
+    parser.add_argument('--json', action='store_true',
+        help="Print every result as a JSON object on a line of its own.")
+    parser.add_argument('query', nargs='+',
+        help="The words to search for, in FTS5 query syntax: \"quoted phrases\", prefixes*, AND, OR and NOT.")
+
+    args = parser.parse_args()
+
+    if args.page < 1 or args.per_page < 1:
+        parser.error("the page and the number of results per page must be positive")
+
+    connection = connect_reader(args.database_file)
+
+    try:
+        rows = search(connection, ' '.join(args.query), args.kinds, args.per_page, (args.page - 1) * args.per_page)
+
+        for row in rows:
+            if args.json:
+                line = json.dumps(dict(zip(row.keys(), row)), sort_keys=True)
+            else:
+                line = u'%s /r/%s %s (%s)%s\n    %s' % (row['id'], row['subreddit'], row['author'], row['score'],
+                    u' %s' % (row['title'],) if row['title'] else u'', row['snippet'].replace(u'\n', u' '))
+
+            sys.stdout.write(line.encode('utf-8') + '\n')
+    except sqlite3.OperationalError as e:
+        parser.error("couldn't search for %s: %s" % (' '.join(args.query), e))
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import re
 import scrapy
+import sqlite3
 
+from subredditscraper.database import connect_reader
+from subredditscraper.decoders import get_decoder
+from subredditscraper import ids
 from subredditscraper.exceptions import InvalidIdException
 from urllib import urlencode
 
@@ -45,70 +48,663 @@ class SubredditSpider(scrapy.spiders.Spider):
     Multi comment GET more (before last post of previous request):
         https://www.reddit.com/r/woahdude/comments/3f6fp6/new.json?depth=1&sort=new&showmore=false&before=ctmlaqo&limit=5
 
+    Paging through comments like this takes hundreds of requests for a large thread. Instead, the whole tree is fetched
+    at once, as far as Reddit will render it, and the comments it leaves out are listed in 'more' stubs holding their
+    ids. Those are expanded in batches of up to 100 ids:
+        https://www.reddit.com/api/morechildren.json?api_type=json&children=ctmn4x3,ctmlaqo&link_id=t3_3f6fp6&sort=new
+
+    which returns a flat list of the comments, along with further 'more' stubs, in 'json.data.things'. A stub with no
+    ids ("continue this thread") marks a reply chain too deep to render, which is fetched as a tree of its own rooted
+    at the stub's parent:
+        https://www.reddit.com/r/woahdude/comments/3f6fp6/new.json?comment=ctmlaqo&limit=500&sort=new
+
+    Note that `before` pages towards _newer_ posts; `before=3fn7gg` in fixtures/list-posts-before.json returns the same
+    page as the first one. Paging back through older posts is done with the listing's `data.after` value.
+
     Here's the process for scraping Reddit.
 
     1. GET https://www.reddit.com/r/$sub_name/new.json?sort=new
     2. For each post in 'data.children':
-        2a. GET https://www.reddit.com/r/$sub_name/comments/$post_id/new.json?sort=new
-        2b. While length of 'data.children' is greater than zero:
-          2b1. last_comment = data.children[data.children.length - 1].id
-          2b2. GET https://www.reddit.com/r/$sub_name/comments/$post_id/new.json?sort=new&before=t1_$last_comment
-    3. While length of 'data.children' is greater than zero:
-        3a. last_post = data.children[data.children.length - 1].id
-        3b. GET https://www.reddit.com/r/$sub_name/new.json?sort=new?before=t3_$last_post
-        3c. Return to step 2 to process the children
+        2a. GET https://www.reddit.com/r/$sub_name/comments/$post_id/new.json?sort=new&limit=500
+        2b. Walk the comment tree through each comment's 'data.replies', collecting the ids of 'more' stubs.
+        2c. While ids have been collected, GET https://www.reddit.com/api/morechildren.json for the next 100 of them
+            and collect the ids of the stubs it returns.
+    3. While 'data.after' is not null:
+        3a. GET https://www.reddit.com/r/$sub_name/new.json?sort=new&after=$after
+        3b. Return to step 2 to process the children
+
+    In refresh mode, the listing isn't walked at all. The fullnames of the subreddit's stored posts are read from the
+    database instead, and the posts are fetched again 100 at a time:
+        https://www.reddit.com/api/info.json?id=t3_3fnayn,t3_3fn9z7
+
+    which returns a listing of the posts in the same shape as the subreddit's, updating their scores, number of
+    comments and so on for a hundredth of the requests. Their comments aren't fetched, and their stored number of
+    comments isn't what decides whether they are: the next walk of the listing compares it against the number the
+    post had when its comments were last fetched, and fetches the comments of posts that have gained some since.
+
+    In incremental mode, step 3 stops once the listing reaches posts older than the newest post already stored for the
+    subreddit, less an overlap window so that recent edits and votes are still picked up.
+
+    Many subreddits can be crawled by one spider. They all share the spider's download slot for www.reddit.com, and
+    so one rate budget, and the nth request of every subreddit is scheduled before the (n + 1)th request of any of
+    them, so that busy subreddits don't starve quiet ones.
+
+    Once the last request of a thread is parsed, its requests and comments are added to the totals of all threads in
+    the crawl stats, 'threads/count', 'threads/requests' and 'threads/comments', from which 'threads/mean_requests'
+    and 'threads/expansion_ratio', the comments retrieved per request, follow, along with 'threads/max_requests'.
+    Threads taking more than `outlier_requests` requests are logged.
 
     """
 
-    id_regex = re.compile(r'\b(?:t[1-8]_)?([0-9a-z]+)\b')
+    id_regex = ids.id_regex
+
+    post_id_regex = ids.post_id_regex
+
+    comment_id_regex = ids.comment_id_regex
+
+    name = 'subreddit'
+
+    # the maximum number of comments rendered in one comment tree
+    comments_limit = 500
 
-    post_id_regex = re.compile(r'\b(?:t3_)?([0-9a-z]+)\b')
+    # the maximum number of ids expanded by one morechildren request
+    more_comments_limit = 100
+
+    # the maximum number of fullnames fetched by one info request
+    info_limit = 100
+
+    # the number of requests for the comments of one post beyond which the post is logged
+    outlier_requests = 20
+
+    def __init__(self, subreddit_names, incremental=False, overlap=86400, refresh=False, *args, **kwargs):
+        """
+        Constructor for the SubredditSpider.
+
+        Arguments:
+        subreddit_names: The name of the subreddit to crawl, excluding the /r/ prefix, or a list of them.
+        incremental: If True, stop paging back through the subreddit once posts which have already been stored are
+                     reached.
+        overlap: The number of seconds before the newest stored post to keep crawling in incremental mode.
+        refresh: If True, fetch the stored posts of each subreddit again by their ids rather than walking its listing.
+        """
+        super(SubredditSpider, self).__init__(*args, **kwargs)
 
-    comment_id_regex = re.compile(r'\b(?:t1_)?([0-9a-z]+)\b')
+        if isinstance(subreddit_names, basestring):
+            subreddit_names = [subreddit_names]
 
-    def __init__(self, subreddit_name):
-        self.subreddit_name = subreddit_name
+        self.subreddit_names = list(subreddit_names or [])
+        self.incremental = incremental
+        self.overlap = overlap
+        self.refresh = refresh
+        self.cutoffs = {}
+        self.request_counts = {}
+
+        # indexes of stored ids, shared by SQLiteItemPipeline when the spider opens
+        self.link_index = None
+        self.comment_index = None
+
+        # created from the JSON_DECODER setting once the first response is parsed
+        self.decoder = None
 
     def start_requests(self):
-        return [
-            self.request('https://www.reddit.com/r/%(subreddit_name)/new.json' % {'subreddit_name': self.subreddit_name},
-                params={'sort': 'new'})
-        ]
+        if self.refresh:
+            for request in self.refresh_requests():
+                yield request
+            return
+
+        for subreddit_name in self.subreddit_names:
+            if self.incremental:
+                self.cutoffs[subreddit_name] = self.get_cutoff(subreddit_name)
+
+            yield self.get_posts(subreddit_name)
 
-    def get_posts(self, before=None):
+    def get_cutoff(self, subreddit_name):
         """
-        Get the newest posts of this sub, optionally posts before a given post.
+        Determines the creation time before which the listing doesn't need to be crawled in incremental mode, reading
+        the newest stored post of the subreddit from the database.
 
         Arguments:
+        subreddit_name: The name of the subreddit.
+
+        Returns:
+        An epoch-second UTC timestamp, or None if no posts of this subreddit have been stored yet.
+        """
+        connection = connect_reader(self.settings.get('DATABASE_FILE', 'subreddits.db'),
+            self.settings.get('DATABASE_READ_PROFILE', 'reader'))
+
+        try:
+            high_water_mark = self.get_high_water_mark(connection, subreddit_name)
+        finally:
+            connection.close()
+
+        if high_water_mark is None:
+            logger.info("No stored posts for %s, crawling the entire subreddit.", subreddit_name)
+            return None
+
+        logger.info("Newest stored post for %s is %s, crawling back to %d seconds before it.", subreddit_name,
+            ids.encode_id(high_water_mark[0]), self.overlap)
+
+        self.set_stat('subreddit/%s/high_water_mark' % (subreddit_name,), high_water_mark[1])
+
+        return high_water_mark[1] - self.overlap
+
+    def get_high_water_mark(self, connection, subreddit_name):
+        """
+        Finds the newest stored post of a subreddit.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        subreddit_name: The name of the subreddit.
+
+        Returns:
+        A tuple of the integer id and UTC creation time of the newest stored post, or None if there's none.
+        """
+        try:
+            result = connection.execute('select id, created_utc from links where subreddit = ? collate nocase '
+                'order by created_utc desc limit 1;', (subreddit_name,)).fetchone()
+        except sqlite3.OperationalError:
+            # the tables haven't been created yet
+            return None
+
+        return (result[0], result[1]) if result else None
+
+    def refresh_requests(self):
+        """
+        Yields info requests for the stored posts of every subreddit, taking batches from each subreddit in turn.
+        """
+        connection = connect_reader(self.settings.get('DATABASE_FILE', 'subreddits.db'),
+            self.settings.get('DATABASE_READ_PROFILE', 'reader'))
+
+        try:
+            fullnames = dict((i, self.get_stored_fullnames(connection, i)) for i in self.subreddit_names)
+        finally:
+            connection.close()
+
+        for subreddit_name in self.subreddit_names:
+            logger.info("Refreshing %d stored posts of %s.", len(fullnames[subreddit_name]), subreddit_name)
+            self.set_stat('subreddit/%s/refreshed' % (subreddit_name,), len(fullnames[subreddit_name]))
+
+        for offset in xrange(0, max([len(i) for i in fullnames.values()] or [0]), self.info_limit):
+            for subreddit_name in self.subreddit_names:
+                batch = fullnames[subreddit_name][offset:offset + self.info_limit]
+
+                if batch:
+                    yield self.get_info(subreddit_name, batch)
+
+    def get_stored_fullnames(self, connection, subreddit_name):
+        """
+        Reads the prefixed ids of the stored posts of a subreddit, newest first.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        subreddit_name: The name of the subreddit.
+
+        Returns:
+        A list of prefixed base36 post ids, empty if there are none.
+        """
+        try:
+            return [ids.encode_id(i[0], ids.LINK_PREFIX) for i in connection.execute('select id from links where '
+                'subreddit = ? collate nocase order by created_utc desc;', (subreddit_name,))]
+        except sqlite3.OperationalError:
+            # the tables haven't been created yet
+            return []
+
+    def get_posts(self, subreddit_name, before=None, after=None):
+        """
+        Get the newest posts of a sub, optionally posts before or after a given post.
+
+        Arguments:
+        subreddit_name: The name of the subreddit.
         before: A base36 ID of a Reddit 'link' (in their terminology, what we refer to as a post).
                 This value can match either `[0-9a-z]+` or `t3_[0-9a-z]+`.
+        after: A base36 ID of a Reddit link; if specified, the posts returned were posted chronologically _before_
+               the post specified. This value can match either `[0-9a-z]+` or `t3_[0-9a-z]+`.
         """
         params = {
             'sort': 'new',
         }
 
-        if not self.post_id_regex.match(before):
-            raise Exception('Invalid post id %s' % (before,))
-        else:
-            # format as t3_%(id)s
-            params['before'] = 't3_%(id)s' % {'id': self.post_id_regex.match(before).group(1)}
+        if before is not None:
+            params['before'] = self.get_post_id(before)
+
+        if after is not None:
+            params['after'] = self.get_post_id(after)
+
+        return self.request(
+            'https://www.reddit.com/r/%(subreddit_name)s/new.json' % {'subreddit_name': subreddit_name},
+            params=params,
+            callback=self.parse_posts,
+            meta={'subreddit_name': subreddit_name},
+            priority=self.get_priority(subreddit_name),
+        )
+
+
+    def parse_posts(self, response):
+        """
+        Parses a listing of posts, yielding a LinkRow item and a comments request for each post and a request for
+        the next page of the listing.
+
+        Arguments:
+        response: The response to a request made by `get_posts`.
+        """
+        # imported here as the items and schema modules depend on this one
+        from subredditscraper.items import LinkRow
+        from subredditscraper.schema import LINKS
+
+        subreddit_name = response.meta['subreddit_name']
+        cutoff = self.cutoffs.get(subreddit_name)
+
+        listing = {}
+
+        for child in self.iter_children(response, 'data.children', listing):
+            if child['kind'] != 't3':
+                continue
+
+            if cutoff is not None and child['data']['created_utc'] < cutoff:
+                logger.info("Reached posts of %s stored by a previous crawl at %s, stopping.", subreddit_name,
+                    child['data']['name'])
+                self.set_stat('subreddit/%s/stopped_at' % (subreddit_name,), child['data']['name'])
+                return
+
+            self.inc_stat('subreddit/%s/links' % (subreddit_name,))
+
+            # check before yielding the link, as the pipeline updates the index when it receives it
+            unchanged = self.comments_unchanged(child['data'])
 
+            yield LinkRow(row=LINKS.convert(child['data']))
+
+            if unchanged:
+                self.inc_stat('subreddit/%s/unchanged_comments' % (subreddit_name,))
+            else:
+                yield self.get_comments(subreddit_name, child['data']['id'], archived=child['data'].get('archived'),
+                    num_comments=child['data'].get('num_comments'))
+
+        if listing.get('after'):
+            yield self.get_posts(subreddit_name, after=listing['after'])
+
+
+    def get_info(self, subreddit_name, ids):
+        """
+        Get posts by their ids.
+
+        Arguments:
+        subreddit_name: The name of the subreddit of the posts.
+        ids: A list of at most `info_limit` base36 post ids, with or without their `t3_` prefix.
+        """
         return self.request(
-            'https://www.reddit.com/r/%(subreddit_name)/new.json' % {'subreddit_name': self.subreddit_name},
-            params=params
+            'https://www.reddit.com/api/info.json',
+            params={
+                'id': ','.join(self.get_post_id(i) for i in ids),
+            },
+            callback=self.parse_info,
+            meta={'subreddit_name': subreddit_name},
+            priority=self.get_priority(subreddit_name),
         )
 
 
-    def get_comments(self, post_id, before=None):
+    def parse_info(self, response):
+        """
+        Parses a listing of posts fetched by their ids, yielding a LinkRow item for each.
+
+        Arguments:
+        response: The response to a request made by `get_info`.
+        """
+        # imported here as the items and schema modules depend on this one
+        from subredditscraper.items import LinkRow
+        from subredditscraper.schema import LINKS
+
+        for child in self.iter_children(response, 'data.children'):
+            if child['kind'] != 't3':
+                continue
+
+            self.inc_stat('subreddit/%s/links' % (response.meta['subreddit_name'],))
+
+            yield LinkRow(row=LINKS.convert(child['data']))
+
+
+    def comments_unchanged(self, data):
+        """
+        Determines whether the comments of a post have already been stored, in which case they don't need to be
+        fetched again. The index holds the number of comments a post had when all of its comment pages were last
+        fetched and stored, so a post whose comment requests failed is fetched again.
+
+        Arguments:
+        data: The 'data' dictionary of a Reddit link.
+
+        Returns:
+        True if the post's comments were stored when it had the same number of comments, False otherwise.
+        """
+        if self.link_index is None:
+            return False
+
+        return self.link_index.get(data['id']) == data['num_comments']
+
+
+    def get_comments(self, subreddit_name, post_id, before=None, comment=None, thread=None, archived=False,
+            num_comments=None):
         """
         Get the newest comments for a given post, optionally before a given comment.
 
         Arguments:
+        subreddit_name: The name of the subreddit of the post.
         post_id: The base36 id for the Reddit post.
         before: A base36 id of a Reddit comment. If specified, the comments returned by this request
                 will have been posted chronologically _before_ the comment specified.
+        comment: A base36 id of a Reddit comment. If specified, only the tree of replies rooted at this comment is
+                 returned.
+        thread: The expansion state of the post's comments, as created by `new_thread`, if comments of this post have
+                already been requested.
+        archived: Whether the post is archived, and so can no longer be commented on; used for a new thread.
+        num_comments: The number of comments on the post, as listed; used for a new thread.
+        """
+        params = {
+            'sort': 'new',
+            'limit': self.comments_limit,
+        }
+
+        if before is not None:
+            params['before'] = self.get_comment_id(before)
+
+        if comment is not None:
+            params['comment'] = self.get_raw_id(comment)
+
+        if thread is None:
+            thread = self.new_thread(post_id, archived, num_comments)
+
+        thread['outstanding'] += 1
+
+        return self.request(
+            'https://www.reddit.com/r/%(subreddit_name)s/comments/%(post_id)s/new.json' % {
+                'subreddit_name': subreddit_name,
+                'post_id': self.get_raw_id(post_id),
+            },
+            params=params,
+            callback=self.parse_comments,
+            meta={'subreddit_name': subreddit_name, 'thread': thread},
+            priority=self.get_priority(subreddit_name),
+        )
+
+
+    def get_more_comments(self, subreddit_name, thread, ids):
+        """
+        Get the comments left out of a post's comment tree by their ids.
+
+        Arguments:
+        subreddit_name: The name of the subreddit of the post.
+        thread: The expansion state of the post's comments, as created by `new_thread`.
+        ids: A list of at most `more_comments_limit` base36 comment ids.
+        """
+        thread['outstanding'] += 1
+
+        self.inc_stat('subreddit/%s/more_requests' % (subreddit_name,))
+
+        return self.request(
+            'https://www.reddit.com/api/morechildren.json',
+            params={
+                'api_type': 'json',
+                'children': ','.join(self.get_raw_id(i) for i in ids),
+                'link_id': self.get_post_id(thread['post_id']),
+                'sort': 'new',
+            },
+            callback=self.parse_more_comments,
+            meta={'subreddit_name': subreddit_name, 'thread': thread},
+            priority=self.get_priority(subreddit_name),
+        )
+
+
+    def new_thread(self, post_id, archived=False, num_comments=None):
+        """
+        Creates the expansion state of a post's comments, shared by every request made for them.
+
+        Arguments:
+        post_id: The base36 id of the Reddit post.
+        archived: Whether the post is archived.
+        num_comments: The number of comments on the post when its comments were first requested, if known.
+
+        Returns:
+        A dictionary of the post's raw id, whether it's archived, its number of comments, the ids of comments waiting
+        to be expanded, whether a morechildren request is in flight, and counts of the requests made, still
+        outstanding and comments retrieved.
+        """
+        return {
+            'post_id': self.get_raw_id(post_id),
+            'archived': bool(archived),
+            'num_comments': num_comments,
+            'pending': [],
+            'expanding': False,
+            'requests': 0,
+            'outstanding': 0,
+            'comments': 0,
+        }
+
+
+    def parse_comments(self, response):
+        """
+        Parses a comment page of a post, yielding a CommentRow item for every comment in the tree and requests
+        expanding the comments left out of it.
+
+        Arguments:
+        response: The response to a request made by `get_comments`.
+        """
+        # the post is the only child of the page's first listing, and the comments are the children of its last
+        children = self.iter_children(response, 'item.data.children')
+        thread = response.meta.get('thread')
+
+        if thread is None:
+            for child in children:
+                if child['kind'] == 't3':
+                    thread = self.new_thread(child['data']['id'], child['data'].get('archived'),
+                        child['data'].get('num_comments'))
+                    thread['outstanding'] = 1
+                    break
+
+        for result in self.expand_comments(response.meta['subreddit_name'], thread, children):
+            yield result
+
+
+    def parse_more_comments(self, response):
+        """
+        Parses the comments returned by a morechildren request, yielding a CommentRow item for each and requests
+        expanding those still left out.
+
+        Arguments:
+        response: The response to a request made by `get_more_comments`.
+        """
+        thread = response.meta['thread']
+        thread['expanding'] = False
+
+        for result in self.expand_comments(response.meta['subreddit_name'], thread,
+                self.iter_children(response, 'json.data.things')):
+            yield result
+
+
+    def expand_comments(self, subreddit_name, thread, children):
+        """
+        Yields a CommentRow item for every comment of a parsed response, followed by requests for the comments it
+        left out. At most one morechildren request is in flight per post, so that the ids of stubs it returns are
+        batched with those still pending. Once no requests are outstanding, every comment of the post has been
+        yielded, and a CommentsFetched item is yielded after them; a failed request is never parsed, and so leaves it
+        out.
+
+        Arguments:
+        subreddit_name: The name of the subreddit of the post.
+        thread: The expansion state of the post's comments.
+        children: The comments and 'more' stubs of the response.
+        """
+        # imported here as the items module depends on this one
+        from subredditscraper.items import CommentsFetched
+
+        thread['requests'] += 1
+        thread['outstanding'] -= 1
+
+        more = []
+
+        for comment in self.walk_comments(children, more):
+            thread['comments'] += 1
+            self.inc_stat('subreddit/%s/comments' % (subreddit_name,))
+            yield comment
+
+        for stub in more:
+            if stub.get('children'):
+                thread['pending'].extend(stub['children'])
+            elif stub.get('parent_id', '').startswith('t1_'):
+                # continue this thread
+                yield self.get_comments(subreddit_name, thread['post_id'], comment=stub['parent_id'], thread=thread)
+
+        if thread['pending'] and not thread['expanding']:
+            ids = thread['pending'][:self.more_comments_limit]
+            del thread['pending'][:self.more_comments_limit]
+
+            thread['expanding'] = True
+
+            yield self.get_more_comments(subreddit_name, thread, ids)
+
+        if thread['outstanding'] == 0:
+            if thread['num_comments'] is not None:
+                yield CommentsFetched(link_id=thread['post_id'], num_comments=thread['num_comments'])
+
+            self.record_thread(subreddit_name, thread)
+
+
+    def record_thread(self, subreddit_name, thread):
+        """
+        Adds the requests and comments of a thread whose last request has been parsed to the totals of all threads,
+        and logs it if it took more than `outlier_requests` requests.
+
+        Arguments:
+        subreddit_name: The name of the subreddit of the post.
+        thread: The expansion state of the post's comments.
+        """
+        if thread['requests'] > self.outlier_requests:
+            logger.info("The comments of %s in %s took %d requests for %d comments.", thread['post_id'],
+                subreddit_name, thread['requests'], thread['comments'])
+
+        if getattr(self, 'crawler', None) is None:
+            return
+
+        stats = self.crawler.stats
+
+        stats.inc_value('threads/count')
+        stats.inc_value('threads/requests', thread['requests'])
+        stats.inc_value('threads/comments', thread['comments'])
+        stats.max_value('threads/max_requests', thread['requests'])
+
+        stats.set_value('threads/mean_requests',
+            float(stats.get_value('threads/requests')) / stats.get_value('threads/count'))
+        stats.set_value('threads/expansion_ratio',
+            float(stats.get_value('threads/comments')) / stats.get_value('threads/requests'))
+
+
+    def walk_comments(self, children, more=None):
+        """
+        Walks a comment tree depth-first, yielding a CommentRow item for each comment.
+
+        Arguments:
+        children: The 'data.children' list of a comment listing.
+        more: If given, the 'data' of every 'more' stub in the tree is appended to this list.
+        """
+        # imported here as the items and schema modules depend on this one
+        from subredditscraper.items import CommentRow
+        from subredditscraper.schema import COMMENTS
+
+        for child in children:
+            if child['kind'] == 'more' and more is not None:
+                more.append(child['data'])
+
+            if child['kind'] != 't1':
+                continue
+
+            yield CommentRow(row=COMMENTS.convert(child['data']))
+
+            if child['data'].get('replies'):
+                for comment in self.walk_comments(child['data']['replies']['data']['children'], more):
+                    yield comment
+
+
+    def iter_children(self, response, prefix, found=None):
+        """
+        Decodes the children of a response one at a time, with the decoder named by the JSON_DECODER setting.
+
+        Arguments:
+        response: The response to decode.
+        prefix: The prefix of the arrays holding the children, in the notation of `subredditscraper.decoders`.
+        found: If given, the scalar values next to the children, such as a listing's 'after', are stored in this
+               dictionary once the children have been decoded.
+        """
+        if self.decoder is None:
+            settings = getattr(self, 'settings', None)
+            self.decoder = get_decoder(settings.get('JSON_DECODER', 'stream') if settings is not None else 'stream')
+
+        return self.decoder.iter_items(response.body, prefix, found)
+
+
+    def get_priority(self, subreddit_name):
+        """
+        Gets the scheduling priority of the next request for a subreddit. Each request of a subreddit gets a lower
+        priority than the last, so the scheduler takes requests from each subreddit in turn.
+
+        Arguments:
+        subreddit_name: The name of the subreddit the request is made for.
+
+        Returns:
+        The priority of the request.
+        """
+        self.request_counts[subreddit_name] = self.request_counts.get(subreddit_name, 0) + 1
+        self.inc_stat('subreddit/%s/requests' % (subreddit_name,))
+
+        return -self.request_counts[subreddit_name]
+
+
+    def build_item(self, cls, data):
+        """
+        Builds an item from the 'data' of a Reddit thing, copying every field the item declares from the key named by
+        the field's `source`, or by the field's name if it has none. Fields computed by the pipeline are left out. The
+        spider converts the things it parses straight into rows instead, which is quicker; see
+        `subredditscraper.schema.Schema`.
+
+        Arguments:
+        cls: The item class to build.
+        data: The 'data' dictionary of a Reddit thing.
+
+        Returns:
+        An instance of `cls`.
+        """
+        result = cls()
+
+        for name, field in cls.fields.iteritems():
+            source = field.get('source', name)
+
+            if field.get('computed'):
+                continue
+
+            if source in data:
+                result[name] = data[source]
+
+        return result
+
+
+    def set_stat(self, key, value):
+        """
+        Sets a stats value if the spider is running in a crawler.
+
+        Arguments:
+        key: The name of the stat.
+        value: The value of the stat.
+        """
+        if getattr(self, 'crawler', None) is not None:
+            self.crawler.stats.set_value(key, value)
+
+
+    def inc_stat(self, key, count=1):
+        """
+        Increments a stats value if the spider is running in a crawler.
+
+        Arguments:
+        key: The name of the stat.
+        count: The amount to increment the stat by.
         """
-        pass
+        if getattr(self, 'crawler', None) is not None:
+            self.crawler.stats.inc_value(key, count)
 
 
     def request(self, url, params=None, **kwargs):
@@ -125,8 +721,9 @@ class SubredditSpider(scrapy.spiders.Spider):
         A scrapy.Request object with the given ultimate URL.
         """
         if params:
-            # set the URL to
-            url = '?'.join(url, urlencode(params)) if not url.endswith('?') else ''.join(url, urlencode(params))
+            # sort the parameters so that the same request always produces the same URL
+            params = urlencode(sorted(params.items()))
+            url = '?'.join([url, params]) if not url.endswith('?') else ''.join([url, params])
 
         return scrapy.Request(url, **kwargs)
 
@@ -0,0 +1,561 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import cgi
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import urlparse
+
+from subredditscraper.exceptions import InvalidIdException
+from subredditscraper.ids import decode_id, encode_id
+from subredditscraper.spiders import SubredditSpider
+
+logger = logging.getLogger('subredditscraper.synthetic')
+
+
+"""
+The time of the newest synthetic post, the time `fixtures/list-posts.json` was recorded.
+"""
+EPOCH = 1438560000
+
+"""
+The ids of synthetic posts and comments count up from these, so that they look like the ids of their time.
+"""
+POST_BASE = decode_id('3f0000')
+
+COMMENT_BASE = decode_id('ct00000')
+
+"""
+The number of seconds between synthetic posts; each post is made at a random time within its interval.
+"""
+POST_INTERVAL = 600
+
+"""
+The number of children of a page of a listing, Reddit's default.
+"""
+PAGE_SIZE = 25
+
+"""
+The words synthetic titles and bodies are made of.
+"""
+WORDS = (
+    'the', 'of', 'and', 'a', 'to', 'in', 'is', 'you', 'that', 'it', 'he', 'was', 'for', 'on', 'are', 'as', 'with',
+    'his', 'they', 'at', 'be', 'this', 'have', 'from', 'or', 'one', 'had', 'by', 'word', 'but', 'not', 'what', 'all',
+    'were', 'we', 'when', 'your', 'can', 'said', 'there', 'use', 'an', 'each', 'which', 'she', 'do', 'how', 'their',
+    'if', 'will', 'up', 'other', 'about', 'out', 'many', 'then', 'them', 'these', 'so', 'some', 'her', 'would',
+    'make', 'like', 'him', 'into', 'time', 'has', 'look', 'two', 'more', 'write', 'go', 'see', 'number', 'no', 'way',
+    'could', 'people', 'my', 'than', 'first', 'water', 'been', 'call', 'who', 'oil', 'its', 'now', 'find', 'long',
+    'down', 'day', 'did', 'get', 'come', 'made', 'may', 'part', 'woah', 'dude', 'trippy', 'gif', 'music', 'mind',
+)
+
+
+def seeded_random(*parts):
+    """
+    Creates a random number generator seeded by a hash of the given parts, so that it produces the same numbers in
+    every process and on every platform.
+    """
+    return random.Random(int(hashlib.sha1('/'.join(str(i) for i in parts)).hexdigest()[:16], 16))
+
+
+class SyntheticReddit(object):
+    """
+    Generates subreddits of posts and comment trees as Reddit's API would return them, in the shape of the responses
+    recorded in the fixtures directory. Everything is derived from the seed: a post, its comments and the pages listing
+    them are generated on their own whenever they're asked for, so any number of posts can be served without holding
+    them, and a crawl of the same seed always sees the same data.
+
+    Each subreddit has `posts` posts, made one every ten minutes or so before the time `fixtures/list-posts.json` was
+    recorded. Each post has a number of comments drawn from an exponential distribution averaging
+    `comments_per_post`, replying to the post or to an earlier comment no deeper than `depth`; the length of their
+    bodies is drawn from a log-normal distribution with a median of `body_length` characters. A fraction `edit_rate`
+    of comments have been edited.
+
+    Comment trees are rendered whole, rather than being cut short by `more` stubs past 500 comments as Reddit does.
+    """
+
+    def __init__(self, subreddit_names, posts=1000, comments_per_post=50, depth=8, body_length=120, edit_rate=0.05,
+            seed=0):
+        """
+        Constructor for the SyntheticReddit.
+
+        Arguments:
+        subreddit_names: The names of the subreddits.
+        posts: The number of posts of each subreddit.
+        comments_per_post: The average number of comments of a post.
+        depth: The maximum depth of a comment tree; top-level comments are at depth 0.
+        body_length: The median length of a comment's body in characters.
+        edit_rate: The fraction of comments which have been edited.
+        seed: The seed all of the data is derived from.
+        """
+        self.subreddit_names = list(subreddit_names)
+        self.posts = posts
+        self.comments_per_post = comments_per_post
+        self.depth = depth
+        self.body_length = body_length
+        self.edit_rate = edit_rate
+        self.seed = seed
+
+        # the last comment tree generated, as consecutive requests are usually for the same post
+        self.last_comments = (None, None)
+
+
+    def get_post_index(self, post_id):
+        """
+        Returns the subreddit number and the index within it of a post, or None if the id isn't one of a synthetic
+        post.
+
+        Arguments:
+        post_id: The base36 id of the post, with or without its `t3_` prefix.
+        """
+        try:
+            number, index = divmod(decode_id(post_id) - POST_BASE, self.posts)
+        except InvalidIdException:
+            return None
+
+        if number < 0 or number >= len(self.subreddit_names):
+            return None
+
+        return number, index
+
+
+    def text(self, rng, length):
+        """
+        Generates text of about a given length out of `WORDS`.
+        """
+        words = []
+        size = 0
+
+        while size < length:
+            words.append(rng.choice(WORDS))
+            size += len(words[-1]) + 1
+
+        return ' '.join(words).capitalize()
+
+
+    def post(self, number, index):
+        """
+        Generates a post.
+
+        Arguments:
+        number: The number of the post's subreddit.
+        index: The index of the post within its subreddit, the newest being 0.
+
+        Returns:
+        The `t3` listing child of the post.
+        """
+        rng = seeded_random(self.seed, 'post', number, index)
+        subreddit_name = self.subreddit_names[number]
+        post_id = encode_id(POST_BASE + number * self.posts + index)
+        created_utc = EPOCH - index * POST_INTERVAL - rng.randint(0, POST_INTERVAL - 1)
+        is_self = rng.random() < 0.3
+        title = self.text(rng, rng.randint(10, 120))
+        selftext = self.text(rng, int(rng.lognormvariate(math.log(self.body_length * 4), 1.0))) if is_self else ''
+        permalink = '/r/%s/comments/%s/%s/' % (subreddit_name, post_id, '_'.join(title.lower().split()[:6]))
+        ups = int(rng.paretovariate(1.2))
+
+        return {
+            'kind': 't3',
+            'data': {
+                'approved_by': None,
+                'archived': False,
+                'author': 'user_%d' % (rng.randint(1, 100000),),
+                'author_flair_css_class': None,
+                'author_flair_text': None,
+                'banned_by': None,
+                'clicked': False,
+                'created': created_utc + 3600,
+                'created_utc': created_utc,
+                'distinguished': None,
+                'domain': 'self.%s' % (subreddit_name,) if is_self else 'i.imgur.com',
+                'downs': 0,
+                'edited': False,
+                'from': None,
+                'from_id': None,
+                'from_kind': None,
+                'gilded': 0,
+                'hidden': False,
+                'hide_score': False,
+                'id': post_id,
+                'is_self': is_self,
+                'likes': None,
+                'link_flair_css_class': None,
+                'link_flair_text': None,
+                'media': None,
+                'media_embed': {},
+                'mod_reports': [],
+                'name': 't3_%s' % (post_id,),
+                'num_comments': self.comment_count(number, index),
+                'num_reports': None,
+                'over_18': rng.random() < 0.05,
+                'permalink': permalink,
+                'removal_reason': None,
+                'report_reasons': None,
+                'saved': False,
+                'score': ups,
+                'secure_media': None,
+                'secure_media_embed': {},
+                'selftext': selftext,
+                'selftext_html': self.html(selftext) if selftext else None,
+                'stickied': False,
+                'subreddit': subreddit_name,
+                'subreddit_id': 't5_%s' % (encode_id(number + 1),),
+                'suggested_sort': None,
+                'thumbnail': 'self' if is_self else 'default',
+                'title': title,
+                'ups': ups,
+                'upvote_ratio': round(rng.uniform(0.5, 1.0), 2),
+                'url': 'https://www.reddit.com%s' % (permalink,) if is_self else 'http://i.imgur.com/%s.gif' % (
+                    encode_id(rng.getrandbits(30)),),
+                'user_reports': [],
+                'visited': False,
+            },
+        }
+
+
+    def html(self, text):
+        """
+        Renders text as Reddit renders markdown, escaped.
+        """
+        return cgi.escape('<div class="md"><p>%s</p>\n</div>' % (text,), quote=False)
+
+
+    def comment_count(self, number, index):
+        """
+        Returns the number of comments of a post.
+        """
+        if not self.comments_per_post:
+            return 0
+
+        return min(self.comment_id_stride(),
+            int(seeded_random(self.seed, 'count', number, index).expovariate(1.0 / self.comments_per_post)))
+
+
+    def comments(self, number, index):
+        """
+        Generates the comments of a post.
+
+        Arguments:
+        number: The number of the post's subreddit.
+        index: The index of the post within its subreddit.
+
+        Returns:
+        A list of the `t1` listing children of the post's comments in the order they were made, each with its depth
+        in the tree as `depth`, and the `replies` of each left to be filled in.
+        """
+        if self.last_comments[0] == (number, index):
+            return self.last_comments[1]
+
+        rng = seeded_random(self.seed, 'comments', number, index)
+        post = self.post(number, index)['data']
+        count = post['num_comments']
+        base = COMMENT_BASE + (number * self.posts + index) * self.comment_id_stride()
+
+        result = []
+        # the comments which may still be replied to
+        open_comments = []
+        created_utc = post['created_utc']
+
+        for i in range(count):
+            created_utc += int(rng.expovariate(1.0 / 300)) + 1
+
+            parent = rng.choice(open_comments) if open_comments and rng.random() < 0.6 else None
+            depth = parent['depth'] + 1 if parent is not None else 0
+            body = self.text(rng, max(1, min(10000, int(rng.lognormvariate(math.log(self.body_length), 1.0)))))
+            ups = int(rng.paretovariate(1.5))
+            comment_id = encode_id(base + i)
+
+            comment = {
+                'approved_by': None,
+                'archived': False,
+                'author': 'user_%d' % (rng.randint(1, 100000),),
+                'author_flair_css_class': None,
+                'author_flair_text': None,
+                'banned_by': None,
+                'body': body,
+                'body_html': self.html(body),
+                'controversiality': 0,
+                'created': created_utc + 3600,
+                'created_utc': created_utc,
+                'distinguished': None,
+                'downs': 0,
+                'edited': created_utc + rng.randint(60, 86400) if rng.random() < self.edit_rate else False,
+                'gilded': 0,
+                'id': comment_id,
+                'likes': None,
+                'link_id': post['name'],
+                'mod_reports': [],
+                'name': 't1_%s' % (comment_id,),
+                'num_reports': None,
+                'parent_id': parent['name'] if parent is not None else post['name'],
+                'removal_reason': None,
+                'replies': '',
+                'report_reasons': None,
+                'saved': False,
+                'score': ups,
+                'score_hidden': False,
+                'subreddit': post['subreddit'],
+                'subreddit_id': post['subreddit_id'],
+                'ups': ups,
+                'user_reports': [],
+                'depth': depth,
+            }
+
+            result.append({'kind': 't1', 'data': comment})
+
+            if depth < self.depth:
+                open_comments.append(comment)
+
+        self.last_comments = ((number, index), result)
+
+        return result
+
+
+    def comment_id_stride(self):
+        """
+        Returns the number of comment ids set aside for each post, and so the most comments a post may have; a
+        hundred times the average is never reached but by chance.
+        """
+        return max(1000, self.comments_per_post * 100)
+
+
+    def listing(self, children, after=None):
+        """
+        Wraps children in a listing.
+        """
+        return {
+            'kind': 'Listing',
+            'data': {
+                'modhash': '',
+                'children': children,
+                'after': after,
+                'before': None,
+            },
+        }
+
+
+    def posts_page(self, subreddit_name, after=None):
+        """
+        Generates a page of a subreddit's newest posts.
+
+        Arguments:
+        subreddit_name: The name of the subreddit.
+        after: The fullname of the post the page follows, if any.
+
+        Returns:
+        The listing, or None if the subreddit or the post isn't a synthetic one.
+        """
+        if subreddit_name not in self.subreddit_names:
+            return None
+
+        number = self.subreddit_names.index(subreddit_name)
+        start = 0
+
+        if after is not None:
+            found = self.get_post_index(after)
+
+            if found is None or found[0] != number:
+                return None
+
+            start = found[1] + 1
+
+        children = [self.post(number, i) for i in range(start, min(self.posts, start + PAGE_SIZE))]
+
+        return self.listing(children, children[-1]['data']['name'] if start + PAGE_SIZE < self.posts else None)
+
+
+    def comments_page(self, post_id):
+        """
+        Generates the comment page of a post, the post's listing followed by that of its comment tree, newest first at
+        every level.
+
+        Arguments:
+        post_id: The base36 id of the post.
+
+        Returns:
+        The pair of listings, or None if the post isn't a synthetic one.
+        """
+        found = self.get_post_index(post_id)
+
+        if found is None:
+            return None
+
+        replies = {}
+
+        for child in self.comments(*found):
+            data = dict(child['data'])
+            del data['depth']
+
+            replies.setdefault(data['parent_id'], []).append({'kind': 't1', 'data': data})
+
+        def render(children):
+            for child in reversed(children):
+                nested = replies.get(child['data']['name'])
+                child['data']['replies'] = self.listing(list(render(nested))) if nested else ''
+                yield child
+
+        top = list(render(replies.get('t3_%s' % (encode_id(decode_id(post_id)),), [])))
+
+        return [self.listing([self.post(*found)]), self.listing(top)]
+
+
+    def info(self, fullnames):
+        """
+        Generates the posts of the given fullnames, as the info endpoint returns them.
+        """
+        children = []
+
+        for fullname in fullnames:
+            found = self.get_post_index(fullname)
+
+            if found is not None:
+                children.append(self.post(*found))
+
+        return self.listing(children)
+
+
+    def respond(self, url):
+        """
+        Generates the response to a request the SubredditSpider makes.
+
+        Arguments:
+        url: The URL of the request.
+
+        Returns:
+        The decoded JSON document of the response, or None if there is none.
+        """
+        parsed = urlparse.urlparse(url)
+        path = parsed.path.strip('/').split('/')
+        params = dict(urlparse.parse_qsl(parsed.query))
+
+        if path == ['api', 'info.json']:
+            return self.info(params.get('id', '').split(','))
+
+        if len(path) == 3 and path[0] == 'r' and path[2] == 'new.json':
+            return self.posts_page(path[1], params.get('after'))
+
+        if len(path) == 5 and path[0] == 'r' and path[2] == 'comments' and path[4] == 'new.json' and \
+                'comment' not in params and 'before' not in params:
+            return self.comments_page(path[3])
+
+        return None
+
+
+    def iter_responses(self, spider):
+        """
+        Yields every response a full crawl of the subreddits receives, tagged with the URL the spider requests it by.
+
+        Arguments:
+        spider: A SubredditSpider, whose request methods produce the URLs.
+
+        Returns:
+        A generator of pairs of a name for the response and its decoded JSON document, tagged with its URL as the
+        recordings in the fixtures directory are.
+        """
+        for number, subreddit_name in enumerate(self.subreddit_names):
+            after = None
+            page = 0
+
+            while True:
+                url = spider.get_posts(subreddit_name, after=after).url
+                document = self.posts_page(subreddit_name, after)
+
+                yield '%s-posts-%05d' % (subreddit_name, page), dict(document, __request_url=url)
+
+                for child in document['data']['children']:
+                    post_id = child['data']['id']
+                    url = spider.get_comments(subreddit_name, post_id).url
+
+                    yield '%s-comments-%s' % (subreddit_name, post_id), \
+                        [{'__request_url': url}] + self.comments_page(post_id)
+
+                after = document['data']['after']
+                page += 1
+
+                if after is None:
+                    break
+
+
+    def write_replay(self, directory, spider):
+        """
+        Writes every response a full crawl of the subreddits receives to a directory, as served by the
+        ReplayMiddleware.
+
+        Arguments:
+        directory: The directory to write to, created if it doesn't exist.
+        spider: A SubredditSpider, whose request methods produce the URLs.
+
+        Returns:
+        The number of responses written.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        count = 0
+
+        for name, document in self.iter_responses(spider):
+            with open(os.path.join(directory, '%s.json' % (name,)), 'wb') as f:
+                # sorting the keys puts the URL tag first, where the ReplayMiddleware looks for it; dumps rather than
+                # dump, which only encodes with the C encoder all at once
+                f.write(json.dumps(document, sort_keys=True))
+
+            count += 1
+
+            if count % 1000 == 0:
+                logger.info("Wrote %d responses.", count)
+
+        return count
+
+
+def add_arguments(parser):
+    """
+    Adds the arguments describing synthetic subreddits to a parser.
+    """
+    group = parser.add_argument_group('synthetic subreddits')
+    group.add_argument('--seed', type=int, default=0,
+        help="The seed the synthetic data is derived from.")
+    group.add_argument('--posts', type=int, default=1000,
+        help="The number of posts of each synthetic subreddit.")
+    group.add_argument('--comments-per-post', type=int, default=50,
+        help="The average number of comments of a synthetic post.")
+    group.add_argument('--depth', type=int, default=8,
+        help="The maximum depth of a synthetic comment tree.")
+    group.add_argument('--body-length', type=int, default=120,
+        help="The median length of a synthetic comment in characters.")
+    group.add_argument('--edit-rate', type=float, default=0.05,
+        help="The fraction of synthetic comments which have been edited.")
+
+
+def from_arguments(subreddit_names, args):
+    """
+    Creates a SyntheticReddit from arguments added by `add_arguments`.
+    """
+    return SyntheticReddit(subreddit_names, posts=args.posts, comments_per_post=args.comments_per_post,
+        depth=args.depth, body_length=args.body_length, edit_rate=args.edit_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-synthetic',
+        description="Writes the responses of a crawl of synthetic subreddits to a directory, for the crawler to "
+                    "replay with --replay.")
+    parser.add_argument('-o', '--output', required=True,
+        help="The directory to write the responses to.")
+    parser.add_argument('subreddit', nargs='+',
+        help="The names of the synthetic subreddits.")
+
+    add_arguments(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    count = from_arguments(args.subreddit, args).write_replay(args.output, SubredditSpider(args.subreddit))
+
+    logger.info("Wrote %d responses to %s.", count, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,90 @@
 #!/usr/bin/env python2.7
 # -*- coding: utf-8 -*-
 
+import BaseHTTPServer
+import gzip
+import json
 import mock
 import os
+import Queue
+import shutil
 import sqlite3
+import StringIO
 import tempfile
+import threading
+import time
 import unittest
+import urllib2
+
+from subredditscraper.benchmarks import (
+    FIXTURES,
+    compare_results,
+    fixture_path,
+    measure_end_to_end,
+    measure_store,
+    percentile,
+    scale_document,
+    synthetic_children,
+)
+
+from subredditscraper.cli import read_subreddit_file
+
+from subredditscraper.compression import (
+    CODEC_NUMBERS,
+    DICTIONARY_TABLE,
+    HEADER,
+    TRAINING_SAMPLES,
+    Compressor,
+    Decompressor,
+    ZlibCodec,
+    ZstdCodec,
+    get_codec,
+    zstandard,
+)
+
+from subredditscraper.database import (
+    READ_PROFILES,
+    apply_profile,
+    connect,
+    connect_reader,
+    register_functions,
+)
+
+from subredditscraper.decoders import DECODERS, get_decoder
+
+from subredditscraper.exceptions import (
+    IncompatibleSchemaException,
+    IncompleteThreadException,
+    InvalidIdException,
+    UnknownCodecException,
+    UnknownDecoderException,
+    UnknownFormatException,
+    UnknownProfileException,
+)
 
-from subredditscraper.exceptions import InvalidIdException
+from subredditscraper.exporters import export_table, get_writer, load_columns, pyarrow
+
+from subredditscraper.httpcache import CompressedCacheStorage, EndpointPolicy
+
+from subredditscraper.ids import encode_id, parent_id_serializer
+
+from subredditscraper.index import IdIndex, decode_id
+
+from email.utils import formatdate
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request, Response, TextResponse
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+
+from twisted.internet import defer, reactor, task
 
 from subredditscraper.items import (
+    Comment,
+    CommentRow,
+    CommentsFetched,
+    Link,
+    LinkRow,
     bool_serializer,
     edited_serializer,
     id_serializer,
@@ -18,10 +93,72 @@ from subredditscraper.items import (
     time_serializer,
 )
 
-from subredditscraper.pipelines import SQLiteItemPipeline
+from subredditscraper.middlewares import (
+    CacheMiddleware,
+    RateLimitMiddleware,
+    ReplayMiddleware,
+    SyntheticMiddleware,
+    TokenBucket,
+)
+
+from subredditscraper.ndjson import export_ndjson, list_partitions, partition_query
+
+from subredditscraper.pipelines import BULK_BATCH_SIZE, SQLiteItemPipeline
+
+from subredditscraper.query import find_comments, find_links, parse_time, query_comments, query_links
+
+from subredditscraper.schema import COMMENTS, LINKS, SCHEMA_VERSION
 
 from subredditscraper.spiders import SubredditSpider
 
+from subredditscraper.search import search
+
+from subredditscraper.synthetic import SyntheticReddit
+
+from subredditscraper.threads import THREAD_QUERY, get_thread, path_segment
+
+
+def fixture_response(name, url='https://www.reddit.com/r/woahdude/new.json?sort=new', subreddit_name='woahdude'):
+    """
+    Builds a response from a recorded response shipped with the package.
+    """
+    with open(fixture_path(name)) as f:
+        return TextResponse(url, body=f.read(), encoding='utf-8',
+            request=Request(url, meta={'subreddit_name': subreddit_name}))
+
+
+def yielded_rows(results, cls):
+    """
+    Returns the rows of the LinkRow or CommentRow items among the results of a spider callback, as dictionaries
+    keyed by column.
+    """
+    schema = LINKS if cls is LinkRow else COMMENTS
+
+    return [dict(zip(schema.columns, i['row'])) for i in results if isinstance(i, cls)]
+
+
+
+class RateLimitedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    A stand-in for Reddit answering every request with the next status and rate limit headers queued on its server.
+    """
+
+    def do_GET(self):
+        status, headers = self.server.responses.pop(0)
+
+        self.send_response(status)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write('{}')
+
+
+    def log_message(self, format, *args):
+        pass
+
 
 class SQLiteItemPipelineTestCase(unittest.TestCase):
     """
@@ -37,305 +174,2561 @@ class SQLiteItemPipelineTestCase(unittest.TestCase):
         self.connection.close()
 
 
+    def new_pipeline(self, **kwargs):
+        """
+        Creates a pipeline writing to an in-memory database with a memory stats collector.
+        """
+        result = SQLiteItemPipeline(':memory:', stats=MemoryStatsCollector(mock.Mock()), **kwargs)
+        result.open_spider(None)
+
+        return result
+
+
+    def new_link(self, id='abc123', **kwargs):
+        """
+        Creates a link item with sensible defaults.
+        """
+        fields = {'id': id, 'prefixed_id': 't3_%s' % (id,), 'created_utc': 1438625668.0, 'score': 1,
+            'num_comments': 0, 'title': u'A link', 'subreddit': u'woahdude', 'edited': False}
+        fields.update(kwargs)
+
+        return Link(**fields)
+
+
+    def new_comment(self, id='def456', **kwargs):
+        """
+        Creates a comment item with sensible defaults.
+        """
+        fields = {'id': id, 'prefixed_id': 't1_%s' % (id,), 'created_utc': 1438625700.0, 'score': 1,
+            'body': u'A comment', 'link_id': 't3_abc123', 'parent_id': 't3_abc123', 'subreddit': u'woahdude',
+            'edited': False}
+        fields.update(kwargs)
+
+        return Comment(**fields)
+
+
     def test_open_spider(self):
         """
         Tests that open spider creates database tables if necessary.
         """
-        self.fail('not implemented')
+        reference = self.new_pipeline()
+
+        self.assertTrue(reference.tables_exist(reference.connection))
+
+        self.assertEqual('wal', reference.stats.get_value('sqlite/profile'))
+        self.assertEqual('reader', reference.stats.get_value('sqlite/read_profile'))
+        # in-memory databases can't use a write-ahead log
+        self.assertEqual('memory', reference.stats.get_value('sqlite/journal_mode'))
 
+        self.assertEqual(0, len(reference.link_index))
+        self.assertEqual(0, reference.stats.get_value('sqlite/index/comments'))
 
-    def test_save_link(self):
+
+    def test_open_spider_loads_indexes(self):
         """
-        Tests that inserting a new link into the database works.
+        Tests that open spider loads the indexes of stored ids and shares them with the spider.
         """
-        self.fail('not implemented')
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file, batch_size=100)
+            reference.open_spider(None)
+            reference.process_item(self.new_link('a', num_comments=2), None)
+            reference.process_item(self.new_link('10', num_comments=7), None)
+            reference.process_item(self.new_comment('b'), None)
+            reference.process_item(CommentsFetched(link_id='10', num_comments=7), None)
+            reference.close_spider(None)
+
+            spider = SubredditSpider('woahdude')
 
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(spider)
 
-    def test_update_link(self):
+            self.assertEqual(reference.link_index, spider.link_index)
+            self.assertEqual(2, len(spider.link_index))
+            self.assertEqual(7, spider.link_index.get('t3_10'))
+            self.assertEqual(-1, spider.link_index.get('a'))
+            self.assertTrue('b' in spider.comment_index)
+
+            reference.process_item(self.new_comment('c'), None)
+            reference.process_item(self.new_link('a', num_comments=3), None)
+
+            self.assertTrue('c' in spider.comment_index)
+            self.assertEqual(-1, spider.link_index.get('a'))
+
+            reference.process_item(CommentsFetched(link_id='a', num_comments=3), None)
+
+            self.assertEqual(3, spider.link_index.get('a'))
+
+            reference.close_spider(spider)
+        finally:
+            os.remove(database_file)
+
+
+    def test_failed_comments_fetched_again(self):
         """
-        Tests that updating an existing link in the database works.
+        Tests that the comments of a post are only skipped once they've been fetched and stored, so that a post whose
+        comment request failed has its comments requested by the next crawl.
         """
-        self.fail('not implemented')
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        with open(fixture_path('list-comments.json')) as f:
+            page = f.read()
+
+        def crawl(parsed):
+            spider = SubredditSpider('woahdude')
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(spider)
+
+            results = list(spider.parse_posts(fixture_response('list-posts.json')))
+            requests = dict((i.url.split('/')[6], i) for i in results
+                if isinstance(i, Request) and '/comments/' in i.url)
+
+            for post_id in parsed:
+                results.extend(spider.parse_comments(TextResponse(requests[post_id].url, body=page, encoding='utf-8',
+                    request=requests[post_id])))
+
+            for item in results:
+                reference.process_item(item, spider)
+
+            reference.close_spider(spider)
+
+            return sorted(requests)
+
+        try:
+            # the request for the comments of the second post fails
+            first = crawl(['3fnayn'])
+            self.assertEqual(['3fn7gg', '3fn903', '3fn9ro', '3fn9z7', '3fnayn'], first)
 
+            with sqlite3.connect(database_file) as connection:
+                self.assertEqual(
+                    [('3fn9z7', None), ('3fnayn', 0)],
+                    [(encode_id(i[0]), i[1]) for i in connection.execute('select id, comments_fetched from links where '
+                        'id in (?, ?) order by id;', (decode_id('3fnayn'), decode_id('3fn9z7')))]
+                )
 
-    def test_link_exists(self):
+            self.assertEqual(['3fn7gg', '3fn903', '3fn9ro', '3fn9z7'], crawl(['3fn9z7']))
+            self.assertEqual(['3fn7gg', '3fn903', '3fn9ro'], crawl([]))
+        finally:
+            os.remove(database_file)
+
+
+    def test_refresh_keeps_comments_fetched(self):
         """
-        Tests that we can evaluate whether a link is present in the database.
+        Tests that refreshing posts updates their number of comments but not the number their comments were fetched
+        at, so that the next crawl of the listing still fetches the comments of posts which gained some.
         """
-        self.fail('not implemented')
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(None)
+
+            for post_id in ('3fn9z7', '3fn7gg'):
+                reference.process_item(self.new_link(post_id, num_comments=0), None)
+                reference.process_item(CommentsFetched(link_id=post_id, num_comments=0), None)
+
+            reference.close_spider(None)
+
+            # 3fn9z7 has gained a comment since
+            spider = SubredditSpider('woahdude', refresh=True)
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(spider)
+
+            for item in spider.parse_info(fixture_response('list-posts.json',
+                    'https://www.reddit.com/api/info.json?id=t3_3fn9z7')):
+                reference.process_item(item, spider)
 
+            reference.close_spider(spider)
 
-    def test_save_comment(self):
+            with sqlite3.connect(database_file) as connection:
+                self.assertEqual([(1, 0), (0, 0)], connection.execute('select num_comments, comments_fetched from '
+                    'links where id in (?, ?) order by id desc;', (decode_id('3fn9z7'), decode_id('3fn7gg')))
+                    .fetchall())
+
+            spider = SubredditSpider('woahdude')
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(spider)
+
+            requests = [i.url for i in spider.parse_posts(fixture_response('list-posts.json'))
+                if isinstance(i, Request)]
+
+            self.assertTrue(any('/comments/3fn9z7/' in i for i in requests))
+            self.assertFalse(any('/comments/3fn7gg/' in i for i in requests))
+
+            reference.close_spider(spider)
+        finally:
+            os.remove(database_file)
+
+
+    def test_upsert_links(self):
         """
-        Tests that inserting a comment into the database works.
+        Tests that links are inserted, updated only when changed, and counted accordingly.
         """
-        self.fail('not implemented')
+        reference = self.new_pipeline(batch_size=100)
+
+        reference.process_item(self.new_link('a'), None)
+        reference.process_item(self.new_link('b'), None)
+
+        self.assertEqual({'links': {'inserted': 2, 'updated': 0, 'unchanged': 0}}, reference.flush())
 
+        reference.process_item(self.new_link('a'), None)
+        reference.process_item(self.new_link('b', score=10, num_comments=3, edited=1438626000.0), None)
+        reference.process_item(self.new_link('c'), None)
 
-    def test_update_comment(self):
+        self.assertEqual({'links': {'inserted': 1, 'updated': 1, 'unchanged': 1}}, reference.flush())
+
+        rows = {i['id']: i for i in reference.connection.execute('select * from links_view;')}
+
+        self.assertEqual(['a', 'b', 'c'], sorted(rows.keys()))
+        self.assertEqual(10, rows['b']['score'])
+        self.assertEqual(3, rows['b']['num_comments'])
+        self.assertEqual(1438626000, rows['b']['edited'])
+
+        self.assertEqual(3, reference.stats.get_value('sqlite/links/inserted'))
+        self.assertEqual(1, reference.stats.get_value('sqlite/links/updated'))
+        self.assertEqual(1, reference.stats.get_value('sqlite/links/unchanged'))
+
+
+    def test_upsert_unchanged_rows_untouched(self):
         """
-        Tests that updating a comment in the database works.
+        Tests that upserting an unchanged row doesn't write to the database at all.
         """
-        self.fail('not implemented')
+        reference = self.new_pipeline(batch_size=100)
+
+        reference.process_item(self.new_link('a'), None)
+        reference.flush()
+
+        changes = reference.connection.total_changes
+
+        reference.process_item(self.new_link('a'), None)
+        reference.flush()
 
+        # only the staging table has been written to, never the links table
+        self.assertEqual(0, reference.connection.execute('select count(*) from links where score != 1;').fetchone()[0])
+        self.assertEqual(changes + 2, reference.connection.total_changes)
 
-    def test_comment_exists(self):
+
+    def test_upsert_comments(self):
         """
-        Tests that we can evaluate whether a comment is present in the database.
+        Tests that comments are inserted, updated only when changed, and counted accordingly.
         """
-        self.fail('not implemented')
+        reference = self.new_pipeline(batch_size=100)
 
+        reference.process_item(self.new_comment('a'), None)
+        reference.process_item(self.new_comment('b'), None)
 
-    def test_close_spider(self):
+        self.assertEqual({'comments': {'inserted': 2, 'updated': 0, 'unchanged': 0}}, reference.flush())
+
+        reference.process_item(self.new_comment('a', body=u'An edited comment', edited=1438626000.0), None)
+        reference.process_item(self.new_comment('b'), None)
+
+        self.assertEqual({'comments': {'inserted': 0, 'updated': 1, 'unchanged': 1}}, reference.flush())
+
+        comment = reference.connection.execute('select * from comments where id = ?;', (decode_id('a'),)).fetchone()
+
+        self.assertEqual(u'An edited comment', comment['body'])
+        self.assertEqual(1438626000, comment['edited'])
+
+
+    def test_upsert_duplicates_within_batch(self):
         """
-        Tests thath close spider does nothing really.
+        Tests that an item buffered twice within a batch is written once, with its latest values.
         """
-        pass
+        reference = self.new_pipeline(batch_size=100)
 
+        reference.process_item(self.new_link('a', score=1), None)
+        reference.process_item(self.new_link('a', score=2), None)
 
-    def test_process_item(self):
+        self.assertEqual({'links': {'inserted': 1, 'updated': 0, 'unchanged': 0}}, reference.flush())
+        self.assertEqual(2, reference.connection.execute('select score from links;').fetchone()[0])
+
+
+    def test_comment_paths(self):
         """
-        Tests that process item successfully stores link and comment items.
+        Tests that comments stored before their parents are moved under them once they arrive, and that threads are
+        read in tree order.
         """
-        self.fail('not implemented')
+        reference = self.new_pipeline(batch_size=100)
 
+        reference.process_item(self.new_comment('c', parent_id='t1_b'), None)
+        reference.process_item(self.new_comment('d', parent_id='t1_c'), None)
+        reference.flush()
 
-    @mock.patch('subredditscraper.pipelines.sqlite3')
-    def test_new_connection(self, mock_sqlite3):
+        self.assertEqual([(path_segment(decode_id('b')) + path_segment(decode_id('c')), 0)], [tuple(i) for i in
+            reference.connection.execute('select path, rooted from comments where id = ?;', (decode_id('c'),))])
+        self.assertEqual(set([path_segment(decode_id('b'))]), reference.paths.orphans)
+
+        reference.process_item(self.new_comment('a'), None)
+        reference.process_item(self.new_comment('e'), None)
+        reference.process_item(self.new_comment('b', parent_id='t1_a'), None)
+        reference.flush()
+
+        self.assertEqual(2, reference.stats.get_value('sqlite/comments/adopted'))
+        self.assertEqual(0, reference.stats.get_value('sqlite/comments/orphans'))
+
+        self.assertEqual([('t1_a', 0, 1), ('t1_b', 1, 1), ('t1_c', 2, 1), ('t1_d', 3, 1), ('t1_e', 0, 1)],
+            [(i['prefixed_id'], i['depth'], i['rooted']) for i in get_thread(reference.connection, 't3_abc123')])
+
+        # a thread with a comment without a path can't be read in tree order
+        with reference.connection:
+            reference.connection.execute('update comments set path = null where id = ?;', (decode_id('c'),))
+
+        self.assertRaises(IncompleteThreadException, get_thread, reference.connection, 't3_abc123')
+
+
+    def test_search(self):
         """
-        Tests that new connections are created properly.
+        Tests that links and comments are searchable as soon as they're flushed, compressed or not, ranked and
+        paginated, and that edits are reindexed.
         """
-        reference = SQLiteItemPipeline(':memory:')
+        reference = self.new_pipeline(batch_size=100, compression='zlib')
+        body = u'This gif loops forever and the colors are something else entirely, ' * 3
 
-        mock_connection = mock.Mock()
-        mock_connection.row_factory = mock.Mock(name='dummy_row_factory')
+        reference.process_item(self.new_link('abc123', title=u'A looping gif', selftext=u'Trippy colors'), None)
+        reference.process_item(self.new_comment('a', body=body), None)
+        reference.process_item(self.new_comment('b', body=u'Loop it again'), None)
+        reference.process_item(self.new_comment('c', body=u'Nothing to see'), None)
+        reference.flush()
 
-        mock_sqlite3.connect.return_value = mock_connection
+        self.assertTrue(isinstance(reference.connection.execute('select body from comments where id = ?;',
+            (decode_id('a'),)).fetchone()[0], buffer))
 
-        c = reference.new_connection()
+        results = list(search(reference.connection, 'loop'))
 
-        self.assertEqual(mock_connection, c)
+        self.assertEqual(['t1_a', 't1_b', 't3_abc123'], sorted(i['id'] for i in results))
+        self.assertEqual(sorted(i['rank'] for i in results), [i['rank'] for i in results])
+        self.assertEqual(u'[Loop] it again', [i['snippet'] for i in results if i['id'] == 't1_b'][0])
+        self.assertEqual(u'A looping gif', [i['title'] for i in results if i['id'] == 't3_abc123'][0])
 
-        # make sure that we instantiated the connection with the right connection string
-        mock_sqlite3.connect.assert_called_with(':memory:')
+        self.assertEqual(['t1_a', 't1_b'], sorted(i['id'] for i in search(reference.connection, 'loop', ('t1',))))
+        self.assertEqual([i['id'] for i in results[1:]], [i['id'] for i in search(reference.connection, 'loop',
+            limit=2, offset=1)])
 
-        self.assertEqual(mock_sqlite3.Row, c.row_factory)
+        reference.process_item(self.new_comment('b', body=u'Never mind', edited=1438626000.0), None)
+        reference.process_item(self.new_comment('c', body=u'Nothing to see', score=10), None)
+        reference.flush()
 
+        self.assertEqual(['t1_a'], [i['id'] for i in search(reference.connection, 'loop', ('t1',))])
+        self.assertEqual(['t1_b'], [i['id'] for i in search(reference.connection, 'mind')])
+        self.assertEqual(['t1_c'], [i['id'] for i in search(reference.connection, 'nothing')])
 
-    def test_get_table_names(self):
+        self.assertRaises(sqlite3.OperationalError, lambda: list(search(reference.connection, 'loop AND')))
+
+
+    def test_search_plain_connection(self):
         """
-        Tests that the get table names function returns a list of table names present in the database.
+        Tests that an archive can be written from a connection without the package's SQL functions, compressed or
+        not, the full-text index following the writes of an uncompressed one and the pipeline's own writes either way.
         """
-        reference = SQLiteItemPipeline(':memory:')
+        for compression in (None, 'zlib'):
+            handle, database_file = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
 
-        self.assertEquals([], reference.get_table_names(self.connection))
+            try:
+                reference = SQLiteItemPipeline(database_file, batch_size=100, compression=compression)
+                reference.open_spider(None)
+                reference.process_item(self.new_comment('a', body=u'A looping gif ' * 10), None)
+                reference.process_item(self.new_comment('b', body=u'Loop it again'), None)
+                reference.close_spider(None)
 
-        with self.connection:
-            self.connection.execute('create table llamas (id integer primary key);')
+                connection = sqlite3.connect(database_file)
 
-        self.assertEquals(['llamas'], reference.get_table_names(self.connection))
+                try:
+                    with connection:
+                        connection.execute("update comments set body = 'Never mind' where id = ?;", (decode_id('b'),))
+                        connection.execute('delete from comments where id = ?;', (decode_id('a'),))
+                finally:
+                    connection.close()
 
+                reference = SQLiteItemPipeline(database_file, batch_size=100, compression=compression)
+                reference.open_spider(None)
+                reference.process_item(self.new_comment('c', body=u'Looping once more ' * 10), None)
+                reference.flush()
 
-    def test_create_tables(self):
+                found = sorted(i['id'] for i in search(reference.connection, 'loop'))
+                reference.close_spider(None)
+
+                # the writes of the plain connection aren't indexed in a compressed archive until it's rebuilt
+                self.assertEqual(['t1_c'] if compression is None else ['t1_b', 't1_c'], found)
+            finally:
+                os.remove(database_file)
+
+
+    def test_compression(self):
         """
-        Tests that creation of the database tables works as expected.
+        Tests that compressed columns are stored compressed with a dictionary trained on the first of them, presented
+        decompressed by the views, and left alone when unchanged.
         """
-        reference = SQLiteItemPipeline(':memory:')
+        reference = self.new_pipeline(batch_size=100000, compression='zlib')
+        words = ['woah', 'dude', 'trippy', 'gif', 'music', 'mind', 'blown', 'colors', 'loop', 'source']
 
-        with self.connection:
-            # no tables to start with
-            self.assertEqual(0, len([i[0] for i in self.connection.execute('select name from sqlite_master where type="table";')]))
+        for i in range(1, TRAINING_SAMPLES // 2 + 1):
+            body = u' '.join(words[(i * j) % len(words)] for j in range(20 + i % 7))
 
-        # create the tables nao
-        reference.create_tables(self.connection)
+            reference.process_item(self.new_comment(encode_id(i), body=body, body_html=u'<p>%s</p>' % (body,)), None)
 
-        with self.connection:
-            tables = [i['name'] for i in self.connection.execute('select name from sqlite_master where type="table";')]
+        reference.process_item(self.new_comment('short', body=u'Short.'), None)
+        reference.flush()
 
-        # determine that tables have been created
-        self.assertTrue('links' in tables)
-        self.assertTrue('comments' in tables)
+        self.assertEqual(1, reference.stats.get_value('sqlite/compression/dictionary'))
+        self.assertTrue(reference.stats.get_value('sqlite/compression/bytes_out') * 3 <
+            reference.stats.get_value('sqlite/compression/bytes_in'))
 
-        # determine that links columns exist
-        with self.connection:
-            links_columns = {i['name']: i['type'] for i in self.connection.execute('pragma table_info(links);')}
+        types = dict((i[0], i[1]) for i in reference.connection.execute('select typeof(body), count(*) from comments '
+            'group by typeof(body);'))
 
-        # TODO test the types of each column for accuracy
-        self.assertIn('id', links_columns.keys())
-        self.assertIn('created', links_columns.keys())
-        self.assertIn('created_utc', links_columns.keys())
-        self.assertIn('ups', links_columns.keys())
-        self.assertIn('downs', links_columns.keys())
-        self.assertIn('likes', links_columns.keys())
-        self.assertIn('prefixed_id', links_columns.keys())
-        self.assertIn('author', links_columns.keys())
-        self.assertIn('author_flair_css_class', links_columns.keys())
-        self.assertIn('author_flair_text', links_columns.keys())
-        self.assertIn('clicked', links_columns.keys())
-        self.assertIn('domain', links_columns.keys())
-        self.assertIn('hidden', links_columns.keys())
-        self.assertIn('is_self', links_columns.keys())
-        self.assertIn('link_flair_css_class', links_columns.keys())
-        self.assertIn('link_flair_text', links_columns.keys())
-        self.assertIn('media', links_columns.keys())
-        self.assertIn('media_embed', links_columns.keys())
-        self.assertIn('num_comments', links_columns.keys())
-        self.assertIn('over_18', links_columns.keys())
-        self.assertIn('permalink', links_columns.keys())
-        self.assertIn('saved', links_columns.keys())
-        self.assertIn('score', links_columns.keys())
-        self.assertIn('selftext', links_columns.keys())
-        self.assertIn('selftext_html', links_columns.keys())
-        self.assertIn('subreddit', links_columns.keys())
-        self.assertIn('subreddit_id', links_columns.keys())
-        self.assertIn('thumbnail', links_columns.keys())
-        self.assertIn('title', links_columns.keys())
-        self.assertIn('url', links_columns.keys())
-        self.assertIn('edited', links_columns.keys())
-        self.assertIn('distinguished', links_columns.keys())
-        self.assertIn('stickied', links_columns.keys())
+        self.assertEqual({'blob': TRAINING_SAMPLES // 2, 'text': 1}, types)
 
-        # determine that comments columns exist
-        with self.connection:
-            comments_columns = {i['name']: i['type'] for i in self.connection.execute('pragma table_info(comments);')}
+        rows = dict((i['id'], i) for i in reference.connection.execute('select * from comments_view;'))
 
-        # TODO test the types of each column for accuracy
-        self.assertIn('id', comments_columns.keys())
-        self.assertIn('created', comments_columns.keys())
-        self.assertIn('created_utc', comments_columns.keys())
-        self.assertIn('ups', comments_columns.keys())
-        self.assertIn('downs', comments_columns.keys())
-        self.assertIn('likes', comments_columns.keys())
-        self.assertIn('prefixed_id', comments_columns.keys())
-        self.assertIn('approved_by', comments_columns.keys())
-        self.assertIn('author', comments_columns.keys())
-        self.assertIn('author_flair_css_class', comments_columns.keys())
-        self.assertIn('author_flair_text', comments_columns.keys())
-        self.assertIn('banned_by', comments_columns.keys())
-        self.assertIn('body', comments_columns.keys())
-        self.assertIn('body_html', comments_columns.keys())
-        self.assertIn('edited', comments_columns.keys())
-        self.assertIn('gilded', comments_columns.keys())
-        self.assertIn('link_author', comments_columns.keys())
-        self.assertIn('link_id', comments_columns.keys())
-        self.assertIn('link_title', comments_columns.keys())
-        self.assertIn('link_url', comments_columns.keys())
-        self.assertIn('num_reports', comments_columns.keys())
-        self.assertIn('parent_id', comments_columns.keys())
-        self.assertIn('saved', comments_columns.keys())
-        self.assertIn('score', comments_columns.keys())
-        self.assertIn('score_hidden', comments_columns.keys())
-        self.assertIn('subreddit', comments_columns.keys())
-        self.assertIn('subreddit_id', comments_columns.keys())
-        self.assertIn('distinguished', comments_columns.keys())
+        self.assertEqual(u'Short.', rows['short']['body'])
+        self.assertEqual(u' '.join(words[(11 * j) % len(words)] for j in range(24)), rows['b']['body'])
+        self.assertEqual(u'<p>%s</p>' % (rows['b']['body'],), rows['b']['body_html'])
 
+        reference.process_item(self.new_comment('b', body=rows['b']['body'], body_html=rows['b']['body_html']), None)
 
-    def test_tables_exist(self):
+        self.assertEqual({'comments': {'inserted': 0, 'updated': 0, 'unchanged': 1}}, reference.flush())
+
+
+    def test_media_deduplicated(self):
         """
-        Determines if the table presence logic works.
+        Tests that media blobs are canonicalized and stored once, with the links referring to them by key, and that
+        the blobs known to be stored already aren't inserted again.
         """
-        reference = SQLiteItemPipeline(':memory:')
+        reference = self.new_pipeline(batch_size=100)
+        media = {'type': 'imgur.com', 'oembed': {'width': 600, 'height': 337}}
 
-        self.assertFalse(reference.tables_exist(self.connection))
+        reference.process_item(self.new_link('a', media=media, media_embed={}), None)
+        reference.process_item(self.new_link('b', media=dict(reversed(media.items())), media_embed={}), None)
+        reference.process_item(self.new_link('c'), None)
+        reference.flush()
 
-        with self.connection:
-            self.connection.execute('create table links (id integer primary key);')
+        self.assertEqual(2, reference.connection.execute('select count(*) from media;').fetchone()[0])
+        self.assertEqual(1, reference.connection.execute('select count(distinct media) from links;').fetchone()[0])
+        self.assertEqual(4, reference.stats.get_value('sqlite/media/references'))
+        self.assertEqual(2, reference.stats.get_value('sqlite/media/inserted'))
 
-        self.assertFalse(reference.tables_exist(self.connection))
+        rows = dict((i['id'], i) for i in reference.connection.execute('select * from links_view;'))
 
-        with self.connection:
-            self.connection.execute('create table comments (id integer primary key);')
+        self.assertEqual(u'{"oembed":{"height":337,"width":600},"type":"imgur.com"}', rows['a']['media'])
+        self.assertEqual(rows['a']['media'], rows['b']['media'])
+        self.assertEqual(u'{}', rows['b']['media_embed'])
+        self.assertEqual(None, rows['c']['media'])
+
+        reference.process_item(self.new_link('d', media=media), None)
+        reference.flush()
+
+        self.assertEqual(1, reference.stats.get_value('sqlite/media/cache_hits'))
+
+        reference.close_spider(None)
+
+        self.assertEqual(2.5, reference.stats.get_value('sqlite/media/dedup_ratio'))
+
+
+    def test_media_dedup_ratio_recrawl(self):
+        """
+        Tests that a crawl which inserts no new media blobs reports the ratio of the references to the blobs stored.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            media = {'type': 'imgur.com'}
+
+            for i in range(2):
+                reference = SQLiteItemPipeline(database_file, stats=MemoryStatsCollector(mock.Mock()))
+                reference.open_spider(None)
+
+                for id in ('a', 'b', 'c'):
+                    reference.process_item(self.new_link(id, media=media, media_embed={}), None)
+
+                reference.close_spider(None)
+
+            self.assertEqual(0, reference.stats.get_value('sqlite/media/inserted'))
+            self.assertEqual(3.0, reference.stats.get_value('sqlite/media/dedup_ratio'))
+        finally:
+            os.remove(database_file)
+
+
+    def test_close_spider(self):
+        """
+        Tests that close spider flushes buffered rows and closes the connection.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file, batch_size=100)
+            reference.open_spider(None)
+            reference.process_item(self.new_link(), None)
+            reference.close_spider(None)
+
+            self.assertEqual(None, reference.connection)
+
+            connection = sqlite3.connect(database_file)
+            self.assertEqual(1, connection.execute('select count(*) from links;').fetchone()[0])
+            connection.close()
+        finally:
+            os.remove(database_file)
+
+
+    def test_process_item(self):
+        """
+        Tests that process item successfully stores link and comment items.
+        """
+        reference = self.new_pipeline(batch_size=1)
+
+        reference.process_item(self.new_link(), None)
+        reference.process_item(self.new_comment(), None)
+
+        link = reference.connection.execute('select * from links;').fetchone()
+        self.assertEqual(decode_id('abc123'), link['id'])
+        self.assertEqual(1438625668, link['created_utc'])
+        self.assertEqual(None, link['edited'])
+
+        comment = reference.connection.execute('select * from comments;').fetchone()
+        self.assertEqual(decode_id('def456'), comment['id'])
+        self.assertEqual(decode_id('abc123'), comment['link_id'])
+        self.assertEqual(None, comment['parent_id'])
+        self.assertEqual(u'A comment', comment['body'])
+
+        # the views present the ids as Reddit does
+        link = reference.connection.execute('select * from links_view;').fetchone()
+        self.assertEqual('abc123', link['id'])
+        self.assertEqual('t3_abc123', link['prefixed_id'])
+
+        reference.process_item(self.new_comment('def457', parent_id='t1_def456'), None)
+
+        comments = reference.connection.execute('select * from comments_view order by id;').fetchall()
+        self.assertEqual(['def456', 'def457'], [i['id'] for i in comments])
+        self.assertEqual(['t1_def456', 't1_def457'], [i['prefixed_id'] for i in comments])
+        self.assertEqual(['abc123', 'abc123'], [i['link_id'] for i in comments])
+        self.assertEqual(['t3_abc123', 't1_def456'], [i['parent_id'] for i in comments])
+
+
+    def test_process_item_rows(self):
+        """
+        Tests that process item stores the rows the spider converts children into as it does the items they'd build.
+        """
+        reference = self.new_pipeline(batch_size=100)
+        other = self.new_pipeline(batch_size=100)
+
+        reference.process_item(LinkRow(row=LINKS.serialize(self.new_link())), None)
+        reference.process_item(CommentRow(row=COMMENTS.serialize(self.new_comment())), None)
+        reference.flush()
+
+        other.process_item(self.new_link(), None)
+        other.process_item(self.new_comment(), None)
+        other.flush()
+
+        for table in ('links_view', 'comments_view'):
+            self.assertEqual([tuple(i) for i in other.connection.execute('select * from %s;' % (table,))],
+                [tuple(i) for i in reference.connection.execute('select * from %s;' % (table,))])
+
+        self.assertTrue(decode_id('abc123') in reference.link_index)
+        self.assertTrue(decode_id('def456') in reference.comment_index)
+
+
+    def test_views_plain_connection(self):
+        """
+        Tests that the ids in the views can be read from a connection without the package's SQL functions.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file, batch_size=100)
+            reference.open_spider(None)
+            reference.process_item(self.new_link('zzzzzzzzzzzz'), None)
+            reference.process_item(self.new_comment('0', link_id='t3_zzzzzzzzzzzz'), None)
+            reference.process_item(self.new_comment('10', link_id='t3_zzzzzzzzzzzz', parent_id='t1_0'), None)
+            reference.close_spider(None)
+
+            connection = sqlite3.connect(database_file)
+
+            try:
+                self.assertEqual([('zzzzzzzzzzzz', 't3_zzzzzzzzzzzz')],
+                    connection.execute('select id, prefixed_id from links_view;').fetchall())
+                self.assertEqual([('0', 't1_0', 'zzzzzzzzzzzz', 't3_zzzzzzzzzzzz'),
+                    ('10', 't1_10', 'zzzzzzzzzzzz', 't1_0')], connection.execute('select id, prefixed_id, link_id, '
+                    'parent_id from comments_view order by prefixed_id;').fetchall())
+            finally:
+                connection.close()
+
+            # once the archive is compressed, its views need the package's connection to decompress its text
+            reference = SQLiteItemPipeline(database_file, compression='zlib')
+            reference.open_spider(None)
+            reference.close_spider(None)
+
+            connection = sqlite3.connect(database_file)
+
+            try:
+                self.assertRaises(sqlite3.OperationalError, connection.execute, 'select id from links_view;')
+            finally:
+                connection.close()
+
+            connection = connect_reader(database_file)
+
+            try:
+                self.assertEqual([('zzzzzzzzzzzz',)],
+                    [tuple(i) for i in connection.execute('select id from links_view;')])
+            finally:
+                connection.close()
+        finally:
+            os.remove(database_file)
+
+
+    def test_process_item_batches(self):
+        """
+        Tests that process item buffers rows until the batch size is reached.
+        """
+        reference = self.new_pipeline(batch_size=3, flush_interval=3600)
+
+        reference.process_item(self.new_link('a'), None)
+        reference.process_item(self.new_comment('b'), None)
+
+        self.assertEqual(0, reference.connection.execute('select count(*) from links;').fetchone()[0])
+        self.assertEqual(0, reference.connection.execute('select count(*) from comments;').fetchone()[0])
+
+        reference.process_item(self.new_comment('c'), None)
+
+        self.assertEqual(1, reference.connection.execute('select count(*) from links;').fetchone()[0])
+        self.assertEqual(2, reference.connection.execute('select count(*) from comments;').fetchone()[0])
+
+        self.assertEqual(1, reference.stats.get_value('sqlite/commits'))
+        self.assertEqual(3, reference.stats.get_value('sqlite/rows'))
+        self.assertEqual(3.0, reference.stats.get_value('sqlite/rows_per_commit'))
+
+
+    @mock.patch('subredditscraper.pipelines.time')
+    def test_process_item_flush_interval(self, mock_time):
+        """
+        Tests that process item flushes buffered rows once the flush interval has passed.
+        """
+        mock_time.time.return_value = 1000.0
+
+        reference = self.new_pipeline(batch_size=100, flush_interval=5)
+        reference.process_item(self.new_link('a'), None)
+
+        self.assertEqual(0, reference.connection.execute('select count(*) from links;').fetchone()[0])
+
+        mock_time.time.return_value = 1005.0
+        reference.process_item(self.new_link('b'), None)
+
+        self.assertEqual(2, reference.connection.execute('select count(*) from links;').fetchone()[0])
+
+
+    @mock.patch('subredditscraper.pipelines.time')
+    def test_flush_loop(self, mock_time):
+        """
+        Tests that buffered rows are flushed once the flush interval has passed even if no further items arrive, and
+        that the looping call checking for them stops with the spider.
+        """
+        mock_time.time.return_value = 1000.0
+        clock = task.Clock()
+
+        reference = self.new_pipeline(batch_size=100, flush_interval=5, clock=clock)
+        reference.process_item(self.new_link('a'), None)
+
+        mock_time.time.return_value = 1004.0
+        clock.advance(4)
+
+        self.assertEqual(0, reference.connection.execute('select count(*) from links;').fetchone()[0])
+
+        mock_time.time.return_value = 1005.0
+        clock.advance(1)
+
+        self.assertEqual(1, reference.connection.execute('select count(*) from links;').fetchone()[0])
+
+        reference.close_spider(None)
+
+        self.assertEqual([], clock.getDelayedCalls())
+
+
+    def test_flush_failed(self):
+        """
+        Tests that rows stay buffered when the transaction flushing them fails, and are stored by the next flush.
+        """
+        reference = self.new_pipeline(batch_size=100)
+        reference.process_item(self.new_link('a', num_comments=1), None)
+        reference.process_item(self.new_comment('b', link_id='t3_a', parent_id='t1_c'), None)
+        reference.process_item(CommentsFetched(link_id='a', num_comments=1), None)
+
+        with mock.patch.object(reference, 'upsert', side_effect=sqlite3.OperationalError('database is locked')):
+            self.assertRaises(sqlite3.OperationalError, reference.flush)
+
+        self.assertEqual(0, reference.connection.execute('select count(*) from links;').fetchone()[0])
+        self.assertEqual([decode_id('a')], reference.links.keys())
+        self.assertEqual([decode_id('b')], reference.comments.keys())
+        self.assertEqual(1, len(reference.fetched))
+        # the orphan recorded by the rolled back transaction is forgotten
+        self.assertEqual(set(), reference.paths.orphans)
+
+        reference.flush()
+
+        self.assertEqual(1, reference.connection.execute('select comments_fetched from links;').fetchone()[0])
+        self.assertEqual(1, reference.connection.execute('select count(*) from comments;').fetchone()[0])
+        self.assertEqual(1, len(reference.paths.orphans))
+        self.assertFalse(reference.links or reference.comments or reference.fetched)
+
+
+    def test_writer_thread(self):
+        """
+        Tests that the writer thread stores queued rows and flushes them when stopped.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file, batch_size=2, flush_interval=3600, writer_thread=True,
+                queue_size=10, stats=MemoryStatsCollector(mock.Mock()))
+            reference.open_spider(None)
+
+            link = self.new_link('a')
+            results = []
+
+            reference.process_item(link, None).addCallback(results.append)
+            reference.process_item(self.new_comment('b'), None).addCallback(results.append)
+            reference.process_item(self.new_comment('c'), None).addCallback(results.append)
+
+            self.assertEqual(link, results[0])
+            self.assertEqual(3, len(results))
+
+            reference.stop_writer()
+
+            self.assertEqual(None, reference.writer)
+            self.assertTrue(1 <= reference.stats.get_value('sqlite/queue_max_depth') <= 3)
+            self.assertEqual(3, reference.stats.get_value('sqlite/rows'))
+
+            connection = sqlite3.connect(database_file)
+            self.assertEqual(1, connection.execute('select count(*) from links;').fetchone()[0])
+            self.assertEqual(2, connection.execute('select count(*) from comments;').fetchone()[0])
+            connection.close()
+        finally:
+            os.remove(database_file)
+
+
+    @mock.patch('subredditscraper.pipelines.ThreadPool')
+    @mock.patch('subredditscraper.pipelines.threads')
+    def test_writer_thread_queue_full(self, mock_threads, mock_pool):
+        """
+        Tests that a full queue defers the put to a put thread of the pipeline's own instead of blocking the reactor
+        thread or taking one of the reactor's, and that rows keep going through it, in order, while any wait on it.
+        """
+        reference = SQLiteItemPipeline(':memory:', writer_thread=True, queue_size=1)
+        reference.queue = mock.Mock()
+        reference.queue.put_nowait.side_effect = Queue.Full
+
+        puts = [defer.Deferred(), defer.Deferred()]
+        mock_threads.deferToThreadPool.side_effect = puts
+
+        first, second, results = self.new_link('a'), self.new_link('b'), []
+
+        reference.process_item(first, None).addCallback(results.append)
+
+        # there's room again, but the first row hasn't been put yet
+        reference.queue.put_nowait.side_effect = None
+        reference.process_item(second, None).addCallback(results.append)
+
+        mock_pool.assert_called_once_with(1, 1, 'sqlite-put')
+        self.assertEqual([mock.call(reactor, mock_pool.return_value, reference.queue.put, ('links', mock.ANY))] * 2,
+            mock_threads.deferToThreadPool.call_args_list)
+        self.assertFalse(reference.queue.put_nowait.call_count > 1)
+        self.assertEqual(1, reference.queue_max_depth)
+
+        for put in puts:
+            put.callback(None)
+
+        self.assertEqual([first, second], results)
+        self.assertEqual(0, reference.pending_puts)
+
+        reference.process_item(self.new_link('c'), None)
+
+        self.assertEqual(2, reference.queue.put_nowait.call_count)
+
+
+    @mock.patch('subredditscraper.pipelines.logger')
+    def test_writer_thread_error(self, mock_logger):
+        """
+        Tests that a failing writer thread fails subsequent items rather than blocking, and reraises when stopped.
+        """
+        reference = SQLiteItemPipeline(':memory:', batch_size=1, writer_thread=True)
+        reference.open_spider(None)
+
+        with mock.patch.object(reference, 'flush', side_effect=sqlite3.OperationalError('disk I/O error')):
+            reference.process_item(self.new_link('a'), None)
+
+            # wait for the writer to pick up the row and fail
+            for i in range(100):
+                if reference.writer_error is not None:
+                    break
+                time.sleep(0.01)
+
+            failures = []
+            reference.process_item(self.new_link('b'), None).addErrback(failures.append)
+
+            self.assertEqual(1, len(failures))
+            self.assertRaises(sqlite3.OperationalError, reference.stop_writer)
+
+
+    @mock.patch('subredditscraper.pipelines.sqlite3')
+    def test_new_connection(self, mock_sqlite3):
+        """
+        Tests that new connections are created properly.
+        """
+        reference = SQLiteItemPipeline(':memory:')
+
+        mock_connection = mock.Mock()
+        mock_connection.row_factory = mock.Mock(name='dummy_row_factory')
+
+        mock_sqlite3.connect.return_value = mock_connection
+
+        c = reference.new_connection()
+
+        self.assertEqual(mock_connection, c)
+
+        # make sure that we instantiated the connection with the right connection string
+        mock_sqlite3.connect.assert_called_with(':memory:')
+
+        self.assertEqual(mock_sqlite3.Row, c.row_factory)
+
+        # make sure that the connection profile has been applied
+        mock_connection.execute.assert_any_call('pragma journal_mode = wal;')
+        mock_connection.execute.assert_any_call('pragma synchronous = normal;')
+
+
+    def test_replace_tables(self):
+        """
+        Tests that empty tables created before the schema was versioned are replaced when the pipeline opens, and that
+        tables holding rows are refused.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            connection = sqlite3.connect(database_file)
+
+            with connection:
+                for schema in (LINKS, COMMENTS):
+                    connection.execute('create table %s (id text primary key, prefixed_id text, %s);' % (
+                        schema.table, ', '.join(schema.columns[1:])))
+
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(None)
+
+            self.assertEqual(SCHEMA_VERSION, reference.get_schema_version(reference.connection))
+            self.assertEqual('integer', [i[2].lower() for i in reference.connection.execute(
+                'pragma table_info(links);')][0])
+
+            reference.close_spider(None)
+
+            register_functions(connection)
+
+            with connection:
+                connection.execute('pragma user_version = 0;')
+                connection.execute("insert into links (id, title) values (1, 'A link');")
+
+            connection.close()
+
+            self.assertRaises(IncompatibleSchemaException, SQLiteItemPipeline(database_file).open_spider, None)
+        finally:
+            os.remove(database_file)
+
+
+    def test_bulk_load(self):
+        """
+        Tests that a bulk load writes without indexes or paths under the bulk profile, and builds them all and applies
+        the pipeline's profile once it's finished, or once the database is opened again if it never finished.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file, batch_size=2, bulk_load=True,
+                stats=MemoryStatsCollector(mock.Mock()))
+            reference.open_spider(None)
+
+            self.assertEqual(BULK_BATCH_SIZE, reference.batch_size)
+            self.assertEqual('memory', reference.connection.execute('pragma journal_mode;').fetchone()[0])
+
+            reference.process_item(self.new_comment('b', parent_id='t1_a', body=u'A reply'), None)
+            reference.process_item(self.new_comment('a', body=u'A comment'), None)
+            reference.process_item(self.new_link('abc123', title=u'A link'), None)
+            reference.flush()
+
+            connection = reference.connection
+            indexes = lambda: set(i[0] for i in connection.execute("select name from sqlite_master where type = "
+                "'index' and sql is not null and tbl_name in ('links', 'comments');"))
+
+            self.assertEqual(set(), indexes())
+            self.assertTrue(reference.bulk_load_pending(connection))
+            self.assertEqual([None, None], [i[0] for i in connection.execute('select path from comments;')])
+            self.assertRaises(IncompleteThreadException, get_thread, connection, 'abc123')
+
+            reference.close_spider(None)
+
+            connection = reference.new_connection()
+
+            self.assertEqual('wal', connection.execute('pragma journal_mode;').fetchone()[0])
+            self.assertEqual(set(i[0] for i in LINKS.indexes + COMMENTS.indexes), indexes())
+            self.assertFalse(reference.bulk_load_pending(connection))
+            self.assertEqual([('t1_a', 0), ('t1_b', 1)], [(i['prefixed_id'], i['depth']) for i in
+                get_thread(connection, 'abc123')])
+            self.assertEqual(['t1_b'], [i['id'] for i in search(connection, 'reply')])
+            self.assertTrue('sqlite_stat1' in reference.get_table_names(connection))
+            self.assertTrue(reference.stats.get_value('sqlite/bulk_load/finish_seconds') >= 0)
+
+            connection.close()
+
+            # a bulk load which never finished is finished when the database is opened again
+            reference = SQLiteItemPipeline(database_file, bulk_load=True)
+            reference.open_spider(None)
+            reference.process_item(self.new_comment('c', parent_id='t1_b', body=u'Another reply'), None)
+            reference.flush()
+            reference.connection.close()
+
+            reference = SQLiteItemPipeline(database_file)
+            reference.open_spider(None)
+            connection = reference.connection
+
+            self.assertEqual(set(i[0] for i in LINKS.indexes + COMMENTS.indexes), indexes())
+            self.assertEqual([('t1_a', 0), ('t1_b', 1), ('t1_c', 2)], [(i['prefixed_id'], i['depth']) for i in
+                get_thread(connection, 'abc123')])
+            self.assertEqual(['t1_b', 't1_c'], sorted(i['id'] for i in search(connection, 'reply')))
+
+            reference.close_spider(None)
+        finally:
+            os.remove(database_file)
+
+
+    def test_bulk_load_writer_thread(self):
+        """
+        Tests that a bulk load in writer thread mode is finished by the writer thread once it's stopped.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            reference = SQLiteItemPipeline(database_file, bulk_load=True, writer_thread=True)
+            reference.open_spider(None)
+
+            reference.process_item(self.new_comment('b', parent_id='t1_a', body=u'A reply'), None)
+            reference.process_item(self.new_comment('a', body=u'A comment'), None)
+            reference.process_item(self.new_link('abc123', title=u'A link'), None)
+
+            reference.stop_writer()
+
+            connection = reference.new_connection()
+
+            self.assertFalse(reference.bulk_load_pending(connection))
+            self.assertEqual('wal', connection.execute('pragma journal_mode;').fetchone()[0])
+            self.assertEqual(set(i[0] for i in LINKS.indexes + COMMENTS.indexes), set(i[0] for i in connection.execute(
+                "select name from sqlite_master where type = 'index' and sql is not null;")))
+            self.assertEqual([('t1_a', 0), ('t1_b', 1)], [(i['prefixed_id'], i['depth']) for i in
+                get_thread(connection, 'abc123')])
+
+            connection.close()
+        finally:
+            os.remove(database_file)
+
+
+    def test_update_indexes(self):
+        """
+        Tests that the indexes the schema declares are created if missing, that those created from it which it no
+        longer declares are dropped, and that those added by hand are left alone.
+        """
+        reference = self.new_pipeline()
+        connection = reference.connection
+
+        with connection:
+            connection.execute('drop index comments_author;')
+            # as though created from an earlier schema
+            connection.execute('create index links_stale on links (title);')
+            connection.execute("insert into schema_indexes (name, tbl_name) values ('links_stale', 'links');")
+            connection.execute('create index links_domain on links (domain);')
+
+        reference.update_indexes(connection)
+
+        names = set(i[0] for i in connection.execute("select name from sqlite_master where type = 'index' and sql is "
+            "not null and tbl_name in ('links', 'comments');"))
+        declared = set(i[0] for i in LINKS.indexes + COMMENTS.indexes)
+
+        self.assertEqual(declared | set(['links_domain']), names)
+        self.assertEqual(declared, set(i[0] for i in connection.execute('select name from schema_indexes;')))
+
+        # a database created before the indexes were recorded doesn't have any dropped
+        with connection:
+            connection.execute('drop table schema_indexes;')
+
+        reference.update_indexes(connection)
+
+        self.assertEqual(declared, set(i[0] for i in connection.execute('select name from schema_indexes;')))
+        self.assertTrue(connection.execute("select 1 from sqlite_master where name = 'links_domain';").fetchone())
+
+
+    def test_get_table_names(self):
+        """
+        Tests that the get table names function returns a list of table names present in the database.
+        """
+        reference = SQLiteItemPipeline(':memory:')
+
+        self.assertEquals([], reference.get_table_names(self.connection))
+
+        with self.connection:
+            self.connection.execute('create table llamas (id integer primary key);')
+
+        self.assertEquals(['llamas'], reference.get_table_names(self.connection))
+
+
+    def test_create_tables(self):
+        """
+        Tests that creation of the database tables works as expected.
+        """
+        reference = SQLiteItemPipeline(':memory:')
+
+        with self.connection:
+            # no tables to start with
+            self.assertEqual(0, len([i[0] for i in self.connection.execute('select name from sqlite_master where type="table";')]))
+
+        # create the tables nao
+        reference.create_tables(self.connection)
+
+        with self.connection:
+            tables = [i['name'] for i in self.connection.execute('select name from sqlite_master where type="table";')]
+
+        # determine that tables have been created
+        self.assertTrue('links' in tables)
+        self.assertTrue('comments' in tables)
+
+        # determine that links columns exist
+        with self.connection:
+            links_columns = {i['name']: i['type'] for i in self.connection.execute('pragma table_info(links);')}
+
+        # TODO test the types of each column for accuracy
+        self.assertIn('id', links_columns.keys())
+        self.assertIn('created', links_columns.keys())
+        self.assertIn('created_utc', links_columns.keys())
+        self.assertIn('ups', links_columns.keys())
+        self.assertIn('downs', links_columns.keys())
+        self.assertIn('likes', links_columns.keys())
+        self.assertNotIn('prefixed_id', links_columns.keys())
+        self.assertIn('author', links_columns.keys())
+        self.assertIn('author_flair_css_class', links_columns.keys())
+        self.assertIn('author_flair_text', links_columns.keys())
+        self.assertIn('clicked', links_columns.keys())
+        self.assertIn('domain', links_columns.keys())
+        self.assertIn('hidden', links_columns.keys())
+        self.assertIn('is_self', links_columns.keys())
+        self.assertIn('link_flair_css_class', links_columns.keys())
+        self.assertIn('link_flair_text', links_columns.keys())
+        self.assertIn('media', links_columns.keys())
+        self.assertIn('media_embed', links_columns.keys())
+        self.assertIn('num_comments', links_columns.keys())
+        self.assertIn('over_18', links_columns.keys())
+        self.assertIn('permalink', links_columns.keys())
+        self.assertIn('saved', links_columns.keys())
+        self.assertIn('score', links_columns.keys())
+        self.assertIn('selftext', links_columns.keys())
+        self.assertIn('selftext_html', links_columns.keys())
+        self.assertIn('subreddit', links_columns.keys())
+        self.assertIn('subreddit_id', links_columns.keys())
+        self.assertIn('thumbnail', links_columns.keys())
+        self.assertIn('title', links_columns.keys())
+        self.assertIn('url', links_columns.keys())
+        self.assertIn('edited', links_columns.keys())
+        self.assertIn('distinguished', links_columns.keys())
+        self.assertIn('stickied', links_columns.keys())
+
+        # determine that comments columns exist
+        with self.connection:
+            comments_columns = {i['name']: i['type'] for i in self.connection.execute('pragma table_info(comments);')}
+
+        # TODO test the types of each column for accuracy
+        self.assertIn('id', comments_columns.keys())
+        self.assertIn('created', comments_columns.keys())
+        self.assertIn('created_utc', comments_columns.keys())
+        self.assertIn('ups', comments_columns.keys())
+        self.assertIn('downs', comments_columns.keys())
+        self.assertIn('likes', comments_columns.keys())
+        self.assertNotIn('prefixed_id', comments_columns.keys())
+        self.assertIn('approved_by', comments_columns.keys())
+        self.assertIn('author', comments_columns.keys())
+        self.assertIn('author_flair_css_class', comments_columns.keys())
+        self.assertIn('author_flair_text', comments_columns.keys())
+        self.assertIn('banned_by', comments_columns.keys())
+        self.assertIn('body', comments_columns.keys())
+        self.assertIn('body_html', comments_columns.keys())
+        self.assertIn('edited', comments_columns.keys())
+        self.assertIn('gilded', comments_columns.keys())
+        self.assertIn('link_author', comments_columns.keys())
+        self.assertIn('link_id', comments_columns.keys())
+        self.assertIn('link_title', comments_columns.keys())
+        self.assertIn('link_url', comments_columns.keys())
+        self.assertIn('num_reports', comments_columns.keys())
+        self.assertIn('parent_id', comments_columns.keys())
+        self.assertIn('saved', comments_columns.keys())
+        self.assertIn('score', comments_columns.keys())
+        self.assertIn('score_hidden', comments_columns.keys())
+        self.assertIn('subreddit', comments_columns.keys())
+        self.assertIn('subreddit_id', comments_columns.keys())
+        self.assertIn('distinguished', comments_columns.keys())
+
+
+    def test_tables_exist(self):
+        """
+        Determines if the table presence logic works.
+        """
+        reference = SQLiteItemPipeline(':memory:')
+
+        self.assertFalse(reference.tables_exist(self.connection))
+
+        with self.connection:
+            self.connection.execute('create table links (id integer primary key);')
+
+        self.assertFalse(reference.tables_exist(self.connection))
+
+        with self.connection:
+            self.connection.execute('create table comments (id integer primary key);')
+
+        self.assertTrue(reference.tables_exist(self.connection))
+
+        with self.connection:
+            self.connection.execute('drop table links;')
+
+        self.assertFalse(reference.tables_exist(self.connection))
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    """
+    Test cases for the benchmarks.
+    """
+
+    def test_fixture_path(self):
+        """
+        Tests that the recorded responses are read from the package, so that they're found wherever it's installed.
+        """
+        for name, prefix in FIXTURES:
+            path = fixture_path(name)
+
+            self.assertEqual(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', name),
+                os.path.abspath(path))
+            self.assertTrue(os.path.isfile(path))
+
+
+    def test_scale_document(self):
+        """
+        Tests that recorded responses are scaled up by repeating their children.
+        """
+        for name, prefix in FIXTURES:
+            with open(fixture_path(name), 'rb') as f:
+                body = f.read()
+
+            scaled = scale_document(body, prefix, len(body) * 10)
+            children = list(get_decoder('json').iter_items(body, prefix))
+
+            self.assertTrue(len(scaled) > len(body) * 2)
+            self.assertEqual(len(children) * 10, len(list(get_decoder('json').iter_items(scaled, prefix))))
+
+
+    def test_synthetic_children(self):
+        """
+        Tests that synthetic children are copies of the recorded ones, each with an id of its own.
+        """
+        children = synthetic_children(100, 't1')
+
+        self.assertEqual(100, len(set(i['data']['id'] for i in children)))
+        self.assertEqual(['t1_%s' % (i['data']['id'],) for i in children], [i['data']['name'] for i in children])
+        self.assertTrue(all(i['data']['body'] for i in children))
+
+
+    def test_percentile(self):
+        """
+        Tests that percentiles are taken by the nearest rank.
+        """
+        values = range(100, 0, -1)
+
+        self.assertEqual(50, percentile(values, 0.5))
+        self.assertEqual(99, percentile(values, 0.99))
+        self.assertEqual(100, percentile(values, 1.0))
+        self.assertEqual(7, percentile([7], 0.99))
+        self.assertEqual(None, percentile([], 0.5))
+
+
+    def test_measure(self):
+        """
+        Tests that the store and end to end benchmarks measure every item.
+        """
+        for result in (measure_store(50, 200), measure_end_to_end(200, 50)):
+            self.assertTrue(result['items'] >= 200)
+            self.assertTrue(result['items_per_second'] > 0)
+            self.assertTrue(result['p50_us'] <= result['p99_us'])
+
+
+    def test_compare_results(self):
+        """
+        Tests that results are compared with those of the same cases of an earlier run.
+        """
+        baseline = {'results': [
+            {'benchmark': 'store', 'case': 'batch size 1', 'items_per_second': 100.0},
+            {'benchmark': 'store', 'case': 'batch size 50', 'items_per_second': 200.0},
+        ]}
+
+        self.assertEqual([('store', 'batch size 50', 200.0, 300.0, 1.5)], compare_results(baseline, [
+            {'benchmark': 'store', 'case': 'batch size 50', 'items_per_second': 300.0},
+            {'benchmark': 'store', 'case': 'batch size 500', 'items_per_second': 400.0},
+        ]))
+
+
+class CliTestCase(unittest.TestCase):
+    """
+    Test cases for the command line interface.
+    """
+
+    def test_read_subreddit_file(self):
+        """
+        Tests that subreddit files are read one name per line, skipping blanks and comments.
+        """
+        handle, path = tempfile.mkstemp(suffix='.txt')
+        os.write(handle, '# quiet subs\nwoahdude\n\n  /r/pics  \n')
+        os.close(handle)
+
+        try:
+            self.assertEqual(['woahdude', 'pics'], read_subreddit_file(path))
+        finally:
+            os.remove(path)
+
+
+class CompressionTestCase(unittest.TestCase):
+    """
+    Test cases for the compression of text columns.
+    """
+
+    def setUp(self):
+        self.connection = connect(':memory:')
+        self.connection.execute(DICTIONARY_TABLE)
+
+        self.samples = ['%d people in the water and %d of them were trippy' % (i, i * 7) for i in range(500)]
+
+
+    def tearDown(self):
+        self.connection.close()
+
+
+    def test_zlib_codec(self):
+        """
+        Tests that values compressed by the zlib codec decompress to themselves, and that a dictionary trained on
+        similar values compresses them further.
+        """
+        value = 'the %s' % (' and '.join(self.samples[100:103]),)
+        plain = ZlibCodec()
+        trained = ZlibCodec(ZlibCodec.train(self.samples))
+
+        self.assertEqual(value, plain.decompress(plain.compress(value)))
+        self.assertEqual(value, trained.decompress(trained.compress(value)))
+        self.assertTrue(len(trained.compress(value)) < len(plain.compress(value)))
+        # compressing is deterministic, and compressing one value doesn't affect the next
+        self.assertEqual(trained.compress(value), trained.compress(value))
+
+
+    def test_compressor(self):
+        """
+        Tests that only long text values are compressed, into blobs the `decompress()` function decompresses, and
+        that a dictionary is trained and stored once enough values have been sampled.
+        """
+        reference = Compressor('zlib', training_samples=len(self.samples))
+        reference.load(self.connection)
+
+        self.assertEqual(0, reference.dictionary_id)
+
+        rows = reference.compress_rows(self.connection, [(1, s * 3, 'short', None) for s in self.samples], (1, 2, 3))
+
+        self.assertEqual(1, reference.dictionary_id)
+        self.assertEqual(1, self.connection.execute('select count(*) from compression_dictionaries;').fetchone()[0])
+        self.assertTrue(isinstance(rows[0][1], buffer))
+        self.assertEqual((1, 'short', None), (rows[0][0], rows[0][2], rows[0][3]))
+        self.assertEqual((CODEC_NUMBERS['zlib'], 1), HEADER.unpack_from(str(rows[0][1])))
+
+        self.assertEqual([self.samples[0] * 3, 'short', None, 1], list(self.connection.execute('select '
+            'decompress(?), decompress(?), decompress(?), decompress(?);', (rows[0][1], 'short', None, 1)).fetchone()))
+
+        # a later compressor loads the stored dictionary
+        later = Compressor('zlib')
+        later.load(self.connection)
+
+        self.assertEqual(1, later.dictionary_id)
+        self.assertEqual(str(rows[0][1]), str(later.compress(self.samples[0] * 3)))
+
+
+    def test_missing_dictionary(self):
+        """
+        Tests that a value compressed with a dictionary which isn't stored can't be decompressed.
+        """
+        value = HEADER.pack(CODEC_NUMBERS['zlib'], 7) + ZlibCodec('dictionary').compress('a dictionary')
+
+        self.assertRaises(UnknownCodecException, Decompressor(self.connection), buffer(value))
+
+
+    def test_get_codec(self):
+        """
+        Tests that codecs are only created by name, and zstd only if the zstandard package is installed.
+        """
+        self.assertTrue(isinstance(get_codec('zlib'), ZlibCodec))
+        self.assertRaises(UnknownCodecException, get_codec, 'lzma')
+
+        if zstandard is None:
+            self.assertRaises(UnknownCodecException, get_codec, 'zstd')
+        else:
+            codec = get_codec('zstd', ZstdCodec.train(self.samples * 10))
+
+            self.assertEqual(self.samples[0], codec.decompress(codec.compress(self.samples[0])))
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Test cases for database connection profiles.
+    """
+
+    def setUp(self):
+        handle, self.database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.database_file + suffix):
+                os.remove(self.database_file + suffix)
+
+
+    def test_apply_profile(self):
+        """
+        Tests that applying a profile sets its pragmas and that unknown profiles are refused.
+        """
+        connection = sqlite3.connect(self.database_file)
+
+        apply_profile(connection, 'wal')
+
+        self.assertEqual('wal', connection.execute('pragma journal_mode;').fetchone()[0])
+        # normal
+        self.assertEqual(1, connection.execute('pragma synchronous;').fetchone()[0])
+        self.assertEqual(-65536, connection.execute('pragma cache_size;').fetchone()[0])
+        self.assertEqual(5000, connection.execute('pragma busy_timeout;').fetchone()[0])
+
+        apply_profile(connection, 'safe')
+
+        self.assertEqual('delete', connection.execute('pragma journal_mode;').fetchone()[0])
+        # full
+        self.assertEqual(2, connection.execute('pragma synchronous;').fetchone()[0])
+
+        self.assertRaises(UnknownProfileException, apply_profile, connection, 'llamas')
+
+        connection.close()
+
+
+    def test_connect_reader(self):
+        """
+        Tests that readers can't write, and can read a WAL database while a write transaction is open.
+        """
+        writer = connect(self.database_file, 'wal')
+
+        with writer:
+            writer.execute('create table links (id text primary key);')
+            writer.execute('insert into links values (?);', ('a',))
+
+        reader = connect_reader(self.database_file)
+
+        self.assertRaises(sqlite3.OperationalError, reader.execute, 'insert into links values (?);', ('b',))
+        reader.rollback()
+
+        # leave a write transaction open
+        writer.execute('insert into links values (?);', ('c',))
+
+        self.assertEqual(['a'], [i['id'] for i in reader.execute('select id from links;')])
+
+        writer.commit()
+
+        self.assertEqual(['a', 'c'], [i['id'] for i in reader.execute('select id from links order by id;')])
+
+        reader.close()
+        writer.close()
+
+
+    def test_connect_reader_journal_mode(self):
+        """
+        Tests that a reader with a profile switching the journal mode leaves the archive in WAL mode, and isn't blocked
+        by an open write transaction, and that only profiles leaving the journal mode alone are offered for readers.
+        """
+        writer = connect(self.database_file, 'wal')
+
+        with writer:
+            writer.execute('create table links (id text primary key);')
+
+        writer.execute("insert into links values ('a');")
+
+        for profile in ('safe', 'bulk'):
+            reader = connect_reader(self.database_file, profile)
+            self.assertEqual(0, reader.execute('select count(*) from links;').fetchone()[0])
+            reader.close()
+
+        writer.commit()
+
+        self.assertEqual('wal', writer.execute('pragma journal_mode;').fetchone()[0])
+        self.assertEqual(('reader',), READ_PROFILES)
+
+        writer.close()
+
+
+class DecodersTestCase(unittest.TestCase):
+    """
+    Test cases for the JSON decoders.
+    """
+
+    def test_decoders_agree(self):
+        """
+        Tests that every available decoder yields the same children and values next to them for each recorded response.
+        """
+        for name, prefix in FIXTURES:
+            with open(fixture_path(name), 'rb') as f:
+                body = f.read()
+
+            expected_found = {}
+            expected = list(get_decoder('json').iter_items(body, prefix, expected_found))
+
+            for decoder in sorted(DECODERS.keys()):
+                try:
+                    reference = get_decoder(decoder)
+                except UnknownDecoderException:
+                    # ijson isn't installed
+                    continue
+
+                found = {}
+
+                self.assertEqual(expected, list(reference.iter_items(body, prefix, found)))
+                self.assertEqual(expected_found, found)
+
+
+    def test_stream(self):
+        """
+        Tests that the streaming decoder finds the arrays at a prefix, yields their items lazily and skips the rest.
+        """
+        reference = get_decoder('stream')
+
+        body = '{"a": {"b": [1, 2.5, {"c": []}], "d": null, "e": {"b": [9]}}, "b": [8], "f": [{"b": [3]}, {"g": 1}]}'
+
+        found = {}
+        self.assertEqual([1, 2.5, {'c': []}], list(reference.iter_items(body, 'a.b', found)))
+        self.assertEqual({'d': None}, found)
+        self.assertEqual([3], list(reference.iter_items(body, 'f.item.b')))
+        self.assertEqual([], list(reference.iter_items(body, 'a.d')))
+        self.assertEqual([], list(reference.iter_items('[]', 'item.b')))
+        self.assertEqual([u'\u2603'], list(reference.iter_items(u'{"a": ["\u2603"]}'.encode('utf-8'), 'a')))
+
+        items = reference.iter_items('{"a": [1, 2 3]}', 'a')
+        self.assertEqual(1, next(items))
+        self.assertRaises(ValueError, list, items)
+
+
+    def test_get_decoder(self):
+        """
+        Tests that unknown decoders, or those whose dependencies aren't installed, are refused.
+        """
+        self.assertRaises(UnknownDecoderException, get_decoder, 'llamas')
+
+        with mock.patch('subredditscraper.decoders.ijson', None):
+            self.assertRaises(UnknownDecoderException, get_decoder, 'ijson')
+
+
+class ExportersTestCase(unittest.TestCase):
+    """
+    Test cases for exporting the archive.
+    """
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+
+        self.pipeline = SQLiteItemPipeline(':memory:', compression='zlib')
+        self.pipeline.open_spider(None)
+
+        for i in range(1, 6):
+            self.pipeline.process_item(Comment(id=encode_id(i), link_id='t3_abc123', parent_id='t3_abc123',
+                created_utc=1438560000 + i * 3600, score=i if i != 3 else None, author=u'user_%d' % (i,),
+                body=u'Comment \u00e9 %d ' % (i,) * 20), None)
+
+        self.pipeline.process_item(Link(id='abc123', created_utc=1438560000, title=u'A link', media={'type': 'gif'}),
+            None)
+        self.pipeline.flush()
+
+
+    def tearDown(self):
+        self.pipeline.close_spider(None)
+        shutil.rmtree(self.output)
+
+
+    def test_export_columns(self):
+        """
+        Tests that tables are exported a chunk at a time into arrays per column, with the text decompressed, and that
+        columns and rows are filtered as asked.
+        """
+        result = export_table(self.pipeline.connection, COMMENTS, self.output, columns=['score', 'body', 'nope'],
+            since=1438560000 + 7200, until=1438560000 + 5 * 3600, chunk_size=2)
+
+        self.assertEqual(('comments', 3), (result['table'], result['rows']))
+        self.assertTrue(result['bytes'] > 0)
+
+        columns = load_columns(os.path.join(self.output, 'comments'))
+
+        self.assertEqual(['body', 'id', 'score'], sorted(columns.keys()))
+        self.assertEqual([2, 3, 4], columns['id'])
+        self.assertEqual([2, None, 4], columns['score'])
+        self.assertEqual(u'Comment \u00e9 3 ' * 20, columns['body'][1])
+
+        export_table(self.pipeline.connection, LINKS, self.output)
+        columns = load_columns(os.path.join(self.output, 'links'))
+
+        self.assertEqual(list(LINKS.columns), sorted(columns.keys(), key=LINKS.columns.index))
+        self.assertEqual([u'A link'], columns['title'])
+        self.assertEqual([u'{"type":"gif"}'], columns['media'])
+
+
+    def test_unknown_format(self):
+        """
+        Tests that unknown formats, and those whose dependencies aren't installed, are refused.
+        """
+        self.assertRaises(UnknownFormatException, get_writer, 'csv', self.output, ['id'], ['int64'])
+
+        if pyarrow is None:
+            self.assertRaises(UnknownFormatException, get_writer, 'parquet', self.output, ['id'], ['int64'])
+
+
+class HttpCacheTestCase(unittest.TestCase):
+    """
+    Test cases for the response cache.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = Settings({
+            'HTTPCACHE_ENABLED': True,
+            'HTTPCACHE_DIR': self.directory,
+            'HTTPCACHE_POLICY': 'subredditscraper.httpcache.EndpointPolicy',
+            'HTTPCACHE_STORAGE': 'subredditscraper.httpcache.CompressedCacheStorage',
+            'HTTPCACHE_LISTING_TTL': 300,
+            'HTTPCACHE_THREAD_TTL': 3600,
+            'HTTPCACHE_ARCHIVED_TTL': 0,
+        })
+        self.spider = SubredditSpider(['woahdude'])
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def response(self, request, age=0, body='{"kind": "Listing"}', **headers):
+        """
+        Creates a response to a request, sent a number of seconds ago.
+        """
+        headers['Date'] = formatdate(time.time() - age, usegmt=True)
+        headers.setdefault('Content-Type', 'application/json; charset=UTF-8')
+
+        return TextResponse(request.url, headers=headers, body=body, request=request)
+
+
+    def test_policy_ttl(self):
+        """
+        Tests that responses stay fresh for as long as their endpoint's TTL, whatever Reddit's cache headers say.
+        """
+        reference = EndpointPolicy(self.settings)
+
+        listing = self.spider.get_posts('woahdude')
+        thread = self.spider.get_comments('woahdude', '3f6fp6')
+        archived = self.spider.get_comments('woahdude', '3f6fp6', archived=True)
+        more = self.spider.get_more_comments('woahdude', archived.meta['thread'], ['ctmlaqo'])
+
+        for request, age, fresh in ((listing, 200, True), (listing, 400, False), (thread, 400, True),
+                (thread, 4000, False), (archived, 86400 * 100, True), (more, 86400 * 100, True)):
+            response = self.response(request, age, **{'Cache-Control': 'private, max-age=0, must-revalidate'})
+
+            self.assertTrue(reference.should_cache_response(response, request))
+            self.assertEqual(fresh, reference.is_cached_response_fresh(response, request))
+
+        self.assertFalse(reference.should_cache_response(Response(listing.url, status=429), listing))
+
+
+    def test_policy_revalidates(self):
+        """
+        Tests that a stale response is revalidated by a conditional request when it has a validator.
+        """
+        reference = EndpointPolicy(self.settings)
+        request = self.spider.get_posts('woahdude')
+
+        self.assertFalse(reference.is_cached_response_fresh(self.response(request, 400), request))
+        self.assertFalse('If-Modified-Since' in request.headers)
+
+        response = self.response(request, 400, **{'Last-Modified': 'Mon, 03 Aug 2015 06:23:21 GMT'})
+
+        self.assertFalse(reference.is_cached_response_fresh(response, request))
+        self.assertEqual('Mon, 03 Aug 2015 06:23:21 GMT', request.headers['If-Modified-Since'])
+        self.assertTrue(reference.is_cached_response_valid(response, Response(request.url, status=304), request))
+
+
+    def test_storage(self):
+        """
+        Tests that responses are stored compressed, keyed by canonical URL, and kept as they were sent if they were
+        sent compressed.
+        """
+        with open(fixture_path('list-posts.json'), 'rb') as f:
+            body = f.read()
+
+        reference = CompressedCacheStorage(self.settings)
+        reference.open_spider(self.spider)
+
+        request = Request('https://www.reddit.com/r/woahdude/new.json?sort=new&limit=5')
+
+        self.assertEqual(None, reference.retrieve_response(self.spider, request))
+
+        reference.store_response(self.spider, request, self.response(request, body=body, **{'X-Moose': 'majestic'}))
+
+        result = reference.retrieve_response(self.spider,
+            Request('https://www.reddit.com/r/woahdude/new.json?limit=5&sort=new'))
+
+        self.assertTrue(isinstance(result, TextResponse))
+        self.assertEqual(body, result.body)
+        self.assertEqual(200, result.status)
+        self.assertEqual('majestic', result.headers['X-Moose'])
+        self.assertTrue(reference.size < len(body) / 4)
+
+        # sent gzipped, so stored as it was for the HttpCompressionMiddleware to decode
+        buf = StringIO.StringIO()
+
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(body)
+
+        request = Request('https://www.reddit.com/r/woahdude/new.json?sort=new')
+
+        reference.store_response(self.spider, request, Response(request.url, body=buf.getvalue(),
+            headers={'Content-Encoding': 'gzip'}))
+
+        self.assertEqual(buf.getvalue(), reference.retrieve_response(self.spider, request).body)
+
+
+    def test_storage_evicts(self):
+        """
+        Tests that the least recently used responses are evicted once the cache is over its budget, and that the order
+        in which they were used carries over to the next crawl.
+        """
+        reference = CompressedCacheStorage(self.settings)
+        reference.open_spider(self.spider)
+
+        requests = [Request('https://www.reddit.com/r/woahdude/new.json?after=t3_%d' % (i,)) for i in range(4)]
+        now = time.time()
+
+        for i, request in enumerate(requests):
+            reference.store_response(self.spider, request, self.response(request, body=os.urandom(1000)))
+            # modification times only have a resolution of a second on some filesystems
+            os.utime(reference.get_path(self.spider, request), (now - 100 + i, now - 100 + i))
+
+        reference.retrieve_response(self.spider, requests[0])
+
+        # just under budget on reopening, evicting the least recently used
+        budget = reference.size - 1
+
+        settings = self.settings.copy()
+        settings.set('HTTPCACHE_MAX_BYTES', budget)
+
+        reference = CompressedCacheStorage(settings)
+        reference.open_spider(self.spider)
+
+        self.assertEqual([True, False, True, True], [reference.retrieve_response(self.spider, i) is not None
+            for i in requests])
+        self.assertTrue(reference.size <= budget)
+
+
+    def test_middleware_bytes_saved(self):
+        """
+        Tests that the bytes of responses served from the cache and revalidated are counted.
+        """
+        stats = MemoryStatsCollector(mock.Mock())
+
+        reference = CacheMiddleware(self.settings, stats)
+        reference.spider_opened(self.spider)
+
+        request = self.spider.get_posts('woahdude')
+
+        self.assertEqual(None, reference.process_request(request, self.spider))
+
+        response = self.response(request, body='{"kind": "Listing", "data": {}}',
+            **{'Last-Modified': 'Mon, 03 Aug 2015 06:23:21 GMT'})
+
+        self.assertTrue(reference.process_response(request, response, self.spider) is response)
+
+        result = reference.process_request(self.spider.get_posts('woahdude'), self.spider)
+
+        self.assertEqual(response.body, result.body)
+        self.assertEqual(len(response.body), stats.get_value('httpcache/bytes_saved'))
+
+        # cached responses are passed through by the rate limit middleware
+        crawler = mock.Mock()
+        crawler.stats = stats
+
+        self.assertTrue(RateLimitMiddleware(crawler).process_response(request, result, self.spider) is result)
+        self.assertEqual(None, stats.get_value('ratelimit/remaining'))
+
+        # once stale, revalidated with a 304
+        with mock.patch('scrapy.extensions.httpcache.time', return_value=time.time() + 400):
+            request = self.spider.get_posts('woahdude')
+
+            self.assertEqual(None, reference.process_request(request, self.spider))
+
+        self.assertEqual('Mon, 03 Aug 2015 06:23:21 GMT', request.headers['If-Modified-Since'])
+
+        result = reference.process_response(request, Response(request.url, status=304), self.spider)
+
+        self.assertEqual(response.body, result.body)
+        self.assertEqual(2 * len(response.body), stats.get_value('httpcache/bytes_saved'))
+        self.assertEqual(1, stats.get_value('httpcache/revalidate'))
+
+
+    def test_middleware_revalidated_fresh(self):
+        """
+        Tests that a response revalidated by a 304 is stored again with the 304's headers, and so is fresh for another
+        TTL rather than revalidated on every request from then on.
+        """
+        reference = CacheMiddleware(self.settings, MemoryStatsCollector(mock.Mock()))
+        reference.spider_opened(self.spider)
+
+        now = time.time()
+        request = self.spider.get_posts('woahdude')
+        reference.process_request(request, self.spider)
+
+        response = self.response(request, **{'Last-Modified': 'Mon, 03 Aug 2015 06:23:21 GMT', 'Age': '10'})
+        reference.process_response(request, response, self.spider)
+
+        with mock.patch('scrapy.extensions.httpcache.time', return_value=now + 400):
+            request = self.spider.get_posts('woahdude')
+
+            self.assertEqual(None, reference.process_request(request, self.spider))
+
+            result = reference.process_response(request, Response(request.url, status=304,
+                headers={'Date': formatdate(now + 400, usegmt=True)}), self.spider)
+
+        self.assertEqual(response.body, result.body)
+        self.assertEqual(formatdate(now + 400, usegmt=True), result.headers['Date'])
+        self.assertFalse('Age' in result.headers)
+
+        # 200 seconds after the 304, but 600 after the response was first downloaded
+        with mock.patch('scrapy.extensions.httpcache.time', return_value=now + 600):
+            result = reference.process_request(self.spider.get_posts('woahdude'), self.spider)
+
+        self.assertEqual(response.body, result.body)
+        self.assertEqual('Mon, 03 Aug 2015 06:23:21 GMT', result.headers['Last-Modified'])
+
+
+class IdsTestCase(unittest.TestCase):
+    """
+    Test cases for the id codec.
+    """
+
+    def test_encode_id(self):
+        """
+        Tests that ids are encoded into their base36 form, and decode back into the same integer.
+        """
+        self.assertEqual('0', encode_id(0))
+        self.assertEqual('3fn7gg', encode_id(decode_id('3fn7gg')))
+        self.assertEqual('t3_3fn7gg', encode_id(decode_id('t3_3fn7gg'), 't3_'))
+        self.assertEqual(None, encode_id(None))
+        self.assertRaises(ValueError, encode_id, -1)
+
+        # far more comments than Reddit will ever have still fit into 64 bits
+        self.assertEqual('zzzzzzzzzzzz', encode_id(decode_id('t1_zzzzzzzzzzzz')))
+        self.assertTrue(decode_id('zzzzzzzzzzzz') < 2 ** 63)
+
+        for i in (1, 35, 36, 1295, 1296, 2 ** 40):
+            self.assertEqual(i, decode_id(encode_id(i)))
+            self.assertEqual(i, int(encode_id(i), 36))
+
+
+    def test_decode_id_invalid(self):
+        """
+        Tests that malformed ids are rejected rather than decoded into some other number.
+        """
+        self.assertEqual(decode_id('3fn7gg'), decode_id(u't3_3fn7gg'))
+        self.assertEqual(5, decode_id(5))
+
+        for id in ('', 't3_', 'zz_abc', '3FN7GG', ' 3fn7gg', '3fn7gg\n', '3fn-7gg', 't9_3fn7gg', None):
+            self.assertRaises(InvalidIdException, decode_id, id)
+
+
+    def test_parent_id_serializer(self):
+        """
+        Tests that the parents of comments are serialized into the id of the parent comment, if any.
+        """
+        self.assertEqual(decode_id('ctmlaqo'), parent_id_serializer('t1_ctmlaqo'))
+        self.assertEqual(None, parent_id_serializer('t3_3f6fp6'))
+        self.assertEqual(None, parent_id_serializer(None))
+
+
+class IdIndexTestCase(unittest.TestCase):
+    """
+    Test cases for the in-memory index of stored ids.
+    """
+
+    def test_decode_id(self):
+        """
+        Tests that ids are decoded from base36 with or without their prefix.
+        """
+        self.assertEqual(int('3fn7gg', 36), decode_id('3fn7gg'))
+        self.assertEqual(int('3fn7gg', 36), decode_id('t3_3fn7gg'))
+        self.assertEqual(int('ctmlaqo', 36), decode_id(u't1_ctmlaqo'))
+        self.assertRaises(InvalidIdException, decode_id, '!-$.')
+
+
+    def test_load(self):
+        """
+        Tests that an index can be loaded from ordered and unordered rows.
+        """
+        ordered = IdIndex.load([('z',), ('10',), ('3fn7gg',)])
+
+        self.assertEqual(3, len(ordered))
+        self.assertTrue('t3_3fn7gg' in ordered)
+        self.assertTrue('10' in ordered)
+        self.assertFalse('11' in ordered)
+
+        unordered = IdIndex.load([('3fn7gg', 4), ('z', 2), ('10', 3), ('z', 5)], values=True)
+
+        self.assertEqual(3, len(unordered))
+        self.assertEqual(sorted(unordered.ids), list(unordered.ids))
+        self.assertEqual(4, unordered.get('3fn7gg'))
+        self.assertEqual(5, unordered.get('z'))
+        self.assertEqual(None, unordered.get('y'))
+
+
+    def test_add(self):
+        """
+        Tests that added ids are found before and after compaction.
+        """
+        reference = IdIndex.load([('a', 1), ('c', 3)], values=True, overflow_limit=3)
+
+        reference.add('b', 2)
+        reference.add('c', 30)
+
+        self.assertEqual(2, reference.get('b'))
+        self.assertEqual(30, reference.get('c'))
+        self.assertEqual(3, len(reference))
+
+        reference.add('t3_d')
+
+        # compacted
+        self.assertEqual({}, reference.overflow)
+        self.assertEqual([decode_id(i) for i in 'abcd'], list(reference.ids))
+        self.assertEqual([1, 2, 30, 0], list(reference.values))
+        self.assertEqual(0, reference.get('d'))
+        self.assertTrue('d' in reference)
+
+
+    def test_memory_usage(self):
+        """
+        Tests that a million ids take 8 MB, and 12 MB with values.
+        """
+        ids = IdIndex()
+        ids.ids.extend(xrange(0, 3000000, 3))
+
+        self.assertEqual(1000000, len(ids))
+        self.assertTrue(ids.memory_usage() <= 8 * 1000000)
+        self.assertTrue(ids.get('t1_%s' % (encode_id(2999997),)))
+
+        values = IdIndex(values=True)
+        values.ids.extend(xrange(1000000))
+        values.values.extend(xrange(1000000))
+
+        self.assertTrue(values.memory_usage() <= 12 * 1000000)
+
+
+class ItemsTestCase(unittest.TestCase):
+    """
+    Test cases for global items.
+    """
+
+    def test_bool_serializer(self):
+        """
+        Tests that the boolean serializer serializes a value to True, False, or None.
+        """
+        self.assertEqual(None, bool_serializer(None))
+        self.assertEqual(True, bool_serializer(True))
+        self.assertEqual(False, bool_serializer(False))
+
+    def test_edited_serializer(self):
+        """
+        Tests that the float or none serializer serializes a value to a float or None.
+        """
+        # test boolean value
+        self.assertEqual(None, edited_serializer(False))
+        self.assertEqual(1, edited_serializer(True))
+        # test string value
+        self.assertEqual(None, edited_serializer('nope'))
+        # convert long to float
+        self.assertEqual(3, edited_serializer(3L))
+        # convert float to float
+        self.assertEqual(3, edited_serializer(3.0))
+        # convert int to float
+        self.assertEqual(3, edited_serializer(3))
+        # rounding
+        self.assertEqual(4, edited_serializer(3.9))
+        self.assertEqual(4, edited_serializer(4.2))
+
+
+    def test_id_serializer(self):
+        """
+        Tests that the id serializer removes the prefix from a base-36 id.
+        """
+        # test for cases which should work
+        self.assertEqual('abc123', id_serializer('t1_abc123'))
+        self.assertEqual('abc123', id_serializer('abc123'))
+        self.assertEqual(u'abc123', id_serializer(u't1_abc123'))
+
+        # test for cases which should not work
+        self.assertEqual(None, id_serializer('LOL_NOT_MATCHING'))
+        self.assertEqual(None, id_serializer(1))
+        self.assertEqual(None, id_serializer(None))
+
+    def test_link_id_serializer(self):
+        """
+        Tests that the link id serializer works as planned.
+        """
+        # cases which should work
+        self.assertEqual(u't3_abc123', link_id_serializer(u'abc123'))
+        self.assertEqual(u't3_abc123', link_id_serializer(u't3_abc123'))
+        self.assertEqual('t3_abc123', link_id_serializer('abc123'))
+
+        # cases which should not work
+        self.assertEqual(None, link_id_serializer('LOL_NOT_MATCHING'))
+        self.assertEqual(None, link_id_serializer(1))
+        self.assertEqual(None, link_id_serializer(None))
+
+    def test_comment_id_serializer(self):
+        """
+        Tests that the comment id serializer works as planned.
+        """
+        # cases which should work
+        self.assertEqual(u't1_abc123', comment_id_serializer(u'abc123'))
+        self.assertEqual(u't1_abc123', comment_id_serializer(u't1_abc123'))
+        self.assertEqual('t1_abc123', comment_id_serializer('t1_abc123'))
+
+        # cases which should not work
+        self.assertEqual(None, comment_id_serializer('LOL_NOT_MATCHING'))
+        self.assertEqual(None, comment_id_serializer(1))
+        self.assertEqual(None, comment_id_serializer(None))
+
+    def test_time_serializer(self):
+        """
+        Tests that the time serializer converts a time into the right format.
+        """
+        self.assertEqual(100, time_serializer(100.0))
+        self.assertEqual(100, time_serializer(100.10245))
+        self.assertEqual(101, time_serializer(100.5))
+
+
+class NdjsonTestCase(unittest.TestCase):
+    """
+    Test cases for exporting the archive into NDJSON files.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database_file = os.path.join(self.directory, 'test.db')
+
+        pipeline = SQLiteItemPipeline(self.database_file, compression='zlib')
+        pipeline.open_spider(None)
+
+        # six comments in July and August 2015, and one without a time
+        for i in range(1, 8):
+            pipeline.process_item(Comment(id=encode_id(i), link_id='t3_abc123', parent_id='t3_abc123',
+                created_utc=1438560000 + (i - 4) * 86400 * 10 if i < 7 else None, score=i, author=u'user_%d' % (i,),
+                body=u'Comment \u00e9 %d ' % (i,) * 20, score_hidden=i % 2 == 0), None)
+
+        pipeline.process_item(Link(id='abc123', created_utc=1438560000, title=u'A link', over_18=True), None)
+        pipeline.close_spider(None)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def read_export(self, output, table):
+        """
+        Reads the objects of every file exported from a table, in the order of their names.
+        """
+        result = []
+
+        for name in sorted(os.listdir(os.path.join(output, table))):
+            if name.endswith('.ndjson.gz'):
+                result.extend(json.loads(i) for i in gzip.open(os.path.join(output, table, name)))
+
+        return result
+
+
+    def test_export_ndjson(self):
+        """
+        Tests that tables are exported into a gzipped file per month, and per size, of JSON objects with the fields
+        of their items, the text decompressed.
+        """
+        output = os.path.join(self.directory, 'export')
+
+        with mock.patch('subredditscraper.ndjson.BUFFER_SIZE', 1):
+            results = export_ndjson(self.database_file, output, by_month=True, max_bytes=1, chunk_size=2)
+
+        self.assertEqual(['links-2015-08', 'comments-2015-07', 'comments-2015-08', 'comments-undated'],
+            [i['partition'] for i in results])
+        self.assertEqual([1, 3, 3, 1], [i['rows'] for i in results])
+        self.assertEqual([1, 3, 3, 1], [i['files'] for i in results])
+
+        self.assertEqual(['comments-2015-07-0000.ndjson.gz', 'comments-2015-07-0001.ndjson.gz',
+            'comments-2015-07-0002.ndjson.gz', 'comments-2015-07.json'], sorted(os.listdir(os.path.join(output,
+            'comments')))[:4])
+
+        comments = self.read_export(output, 'comments')
+
+        self.assertEqual(['1', '2', '3', '4', '5', '6', '7'], [i['id'] for i in comments])
+        self.assertEqual(sorted(Comment.fields.keys()), sorted(comments[0].keys()))
+        self.assertEqual(u'Comment \u00e9 2 ' * 20, comments[1]['body'])
+        self.assertEqual((u't1_2', u't3_abc123', True, True), (comments[1]['prefixed_id'], comments[1]['parent_id'],
+            comments[1]['score_hidden'], comments[1]['rooted']))
+        self.assertEqual(None, comments[6]['created_utc'])
+
+        links = self.read_export(output, 'links')
+
+        self.assertEqual([(u'abc123', u't3_abc123', u'A link', True)], [(i['id'], i['prefixed_id'], i['title'],
+            i['over_18']) for i in links])
+
+        with open(os.path.join(output, 'comments', 'comments-2015-08.json')) as f:
+            manifest = json.load(f)
+
+        self.assertTrue(manifest['complete'])
+        self.assertEqual([1, 1, 1], [i['rows'] for i in manifest['files']])
+        self.assertEqual([1440288000, 6], manifest['files'][-1]['last'])
+
+
+    def test_export_resumes(self):
+        """
+        Tests that an interrupted export resumes after the last complete file of each partition, skipping complete
+        partitions, and that exporting partitions in parallel writes the same files.
+        """
+        output = os.path.join(self.directory, 'export')
+
+        with mock.patch('subredditscraper.ndjson.BUFFER_SIZE', 1):
+            export_ndjson(self.database_file, output, by_month=True, max_bytes=1)
+
+        expected = self.read_export(output, 'comments')
+        manifest_path = os.path.join(output, 'comments', 'comments-2015-07.json')
+
+        # as if interrupted while writing the second file
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        for i in manifest['files'][1:]:
+            os.remove(os.path.join(output, 'comments', i['name']))
+
+        manifest.update(complete=False, files=manifest['files'][:1])
+
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+        with open(os.path.join(output, 'comments', 'comments-2015-07-0001.ndjson.gz.part'), 'w') as f:
+            f.write('truncated')
+
+        with mock.patch('subredditscraper.ndjson.BUFFER_SIZE', 1):
+            results = export_ndjson(self.database_file, output, tables=('comments',), by_month=True, max_bytes=1,
+                resume=True)
+
+        self.assertEqual([2, 0, 0], [i['rows'] for i in results])
+        self.assertEqual(expected, self.read_export(output, 'comments'))
+        self.assertFalse([i for i in os.listdir(os.path.join(output, 'comments')) if i.endswith('.part')])
+
+        self.assertRaises(ValueError, export_ndjson, self.database_file, output, by_month=True, compression='none',
+            resume=True)
+
+        parallel = os.path.join(self.directory, 'parallel')
+
+        with mock.patch('subredditscraper.ndjson.BUFFER_SIZE', 1):
+            results = export_ndjson(self.database_file, parallel, by_month=True, max_bytes=1, jobs=2)
+
+        self.assertEqual(8, sum(i['rows'] for i in results))
+        self.assertEqual(expected, self.read_export(parallel, 'comments'))
+
+
+    def test_partitions_use_indexes(self):
+        """
+        Tests that months are read in the order of the index on their time, without sorting them, from where an
+        export resumes.
+        """
+        connection = connect_reader(self.database_file)
+
+        try:
+            partitions = list_partitions(connection, COMMENTS, by_month=True, since=parse_time('2015-07-20'))
+
+            self.assertEqual(['comments-2015-07', 'comments-2015-08'], [i['name'] for i in partitions])
+            self.assertEqual([parse_time('2015-07-20'), parse_time('2015-08-01')], partitions[0]['parameters'])
+
+            plan = ' '.join(i[3] for i in connection.execute('explain query plan %s' % (partition_query(COMMENTS,
+                partitions[1], [1440288000, 6])[0],), partitions[1]['parameters'] + [1440288000, 6]))
+
+            self.assertIn('comments_created', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+        finally:
+            connection.close()
+
+
+class QueryTestCase(unittest.TestCase):
+    """
+    Test cases for querying links and comments.
+    """
+
+    def setUp(self):
+        self.connection = connect(':memory:')
+
+        SQLiteItemPipeline(':memory:').create_tables(self.connection)
+
+
+    def tearDown(self):
+        self.connection.close()
+
+
+    def test_parse_time(self):
+        """
+        Tests that times are parsed from seconds since the epoch and from UTC dates.
+        """
+        self.assertEqual(1438625668, parse_time('1438625668'))
+        self.assertEqual(1438560000, parse_time('2015-08-03'))
+        self.assertEqual(1438626600, parse_time('2015-08-03T18:30:00'))
+        self.assertRaises(ValueError, parse_time, 'yesterday')
+
+
+    def test_access_patterns_use_indexes(self):
+        """
+        Tests that each access pattern is served by its index rather than a scan of the table.
+        """
+        patterns = (
+            ('links_subreddit', query_links(subreddit='WoahDude')),
+            ('links_author', query_links(author='someone')),
+            ('links_created', query_links(since=1438560000, until=1438646400)),
+            ('links_score', query_links(min_score=100, order='top')),
+            ('comments_author', query_comments(author='someone')),
+            ('comments_thread', query_comments(link_id='t3_abc123', order='thread')),
+            ('comments_thread', query_comments(parent_id='t3_abc123')),
+            ('comments_parent', query_comments(parent_id='t1_def456')),
+            ('comments_created', query_comments(since=1438560000, order='old')),
+            ('comments_score', query_comments(min_score=100, order='top')),
+        )
+
+        for index, (statement, parameters) in patterns:
+            plan = [i[-1] for i in self.connection.execute('explain query plan %s' % (statement,), parameters)]
+
+            self.assertTrue(any(' INDEX %s ' % (index,) in i for i in plan), (index, plan))
+            self.assertFalse(any(i.startswith('SCAN links') or i.startswith('SCAN comments') for i in plan),
+                (index, plan))
+
+
+    def test_find(self):
+        """
+        Tests that links and comments are filtered and ordered as asked.
+        """
+        with self.connection:
+            self.connection.executemany('insert into links (id, subreddit, author, created_utc, score, title) '
+                'values (?, ?, ?, ?, ?, ?);', [(1, 'woahdude', 'a', 100, 5, 'One'), (2, 'WoahDude', 'b', 200, 50,
+                'Two'), (3, 'pics', 'a', 300, 10, 'Three')])
+            self.connection.executemany('insert into comments (id, link_id, parent_id, author, created_utc, score, '
+                'path) values (?, ?, ?, ?, ?, ?, ?);', [(10, 1, None, 'a', 110, 1, '0000000a'), (11, 1, 10, 'b', 120,
+                3, '0000000a0000000b'), (12, 1, None, 'b', 130, 2, '0000000c'), (13, 2, None, 'a', 210, 9,
+                '0000000d')])
+
+        ids = lambda rows: [i['prefixed_id'] for i in rows]
+
+        self.assertEqual(['t3_2', 't3_1'], ids(find_links(self.connection, subreddit='woahdude')))
+        self.assertEqual(['t3_1', 't3_3'], ids(find_links(self.connection, author='a', order='old')))
+        self.assertEqual(['t3_2'], ids(find_links(self.connection, since=150, until=300)))
+        self.assertEqual(['t3_2', 't3_3'], ids(find_links(self.connection, min_score=10, order='top')))
+        self.assertEqual(['t3_3'], ids(find_links(self.connection, limit=1)))
+
+        self.assertEqual(['t1_d', 't1_a'], ids(find_comments(self.connection, author='a')))
+        self.assertEqual(['t1_a', 't1_b', 't1_c'], ids(find_comments(self.connection, link_id='1', order='thread')))
+        self.assertEqual(['t1_c', 't1_a'], ids(find_comments(self.connection, parent_id='t3_1')))
+        self.assertEqual(['t1_b'], ids(find_comments(self.connection, parent_id='t1_a')))
+        self.assertEqual(['t1_d', 't1_b'], ids(find_comments(self.connection, min_score=3, order='top')))
+
+
+class RateLimitMiddlewareTestCase(unittest.TestCase):
+    """
+    Test cases for the rate limit middleware, run against a local server sending synthetic rate limit headers.
+    """
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RateLimitedHandler)
+        self.server.responses = []
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.slot = mock.Mock(delay=2.0, lastseen=time.time())
+
+        self.crawler = mock.Mock()
+        self.crawler.engine.downloader.slots = {'reddit': self.slot}
+        self.crawler.stats = MemoryStatsCollector(mock.Mock())
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def fetch(self, reference, status=200, **headers):
+        """
+        Fetches a response with the given status and headers from the local server and passes it through a middleware.
+        """
+        self.server.responses.append((status, headers))
+
+        url = 'http://127.0.0.1:%d/r/woahdude/new.json' % (self.server.server_port,)
+
+        try:
+            f = urllib2.urlopen(url)
+        except urllib2.HTTPError as e:
+            f = e
+
+        response = Response(url, status=f.getcode(), headers=dict(f.info().items()), body=f.read())
+        request = Request(url, meta={'download_slot': 'reddit'})
+
+        # the slot started this request just now
+        self.slot.lastseen = time.time()
+
+        return reference.process_response(request, response, None)
+
+
+    def test_spreads_allowance(self):
+        """
+        Tests that the remaining allowance, less the reserve, is spread evenly over the rest of the period.
+        """
+        reference = RateLimitMiddleware(self.crawler, reserve=10, burst=1)
+
+        self.fetch(reference, **{'X-Ratelimit-Used': '390', 'X-Ratelimit-Remaining': '210',
+            'X-Ratelimit-Reset': '400'})
+
+        # 200 requests over 400 seconds
+        self.assertAlmostEqual(2.0, self.slot.delay, places=1)
+        self.assertEqual(210, self.crawler.stats.get_value('ratelimit/remaining'))
+        self.assertEqual(390, self.crawler.stats.get_value('ratelimit/used'))
+
+        self.fetch(reference, **{'X-Ratelimit-Used': '0', 'X-Ratelimit-Remaining': '600',
+            'X-Ratelimit-Reset': '59'})
+
+        # a new period with nearly ten requests a second to spare
+        self.assertTrue(self.slot.delay < 0.2)
+
+
+    def test_bursts(self):
+        """
+        Tests that requests are made back to back while the bucket holds tokens.
+        """
+        reference = RateLimitMiddleware(self.crawler, reserve=0, burst=5)
+
+        headers = {'X-Ratelimit-Remaining': '600', 'X-Ratelimit-Reset': '600'}
+
+        # the first response only sets the rate; the bucket starts out holding a single token
+        self.fetch(reference, **headers)
+
+        reference.bucket.tokens = 5
+
+        for i in range(4):
+            self.fetch(reference, **headers)
+            self.assertAlmostEqual(0.0, self.slot.delay, places=1)
+
+        self.fetch(reference, **headers)
+        self.assertAlmostEqual(1.0, self.slot.delay, places=1)
+
+
+    def test_pauses_when_exhausted(self):
+        """
+        Tests that the middleware waits for the period to reset once the allowance is used up.
+        """
+        reference = RateLimitMiddleware(self.crawler, reserve=5)
+
+        self.fetch(reference, **{'X-Ratelimit-Used': '596', 'X-Ratelimit-Remaining': '4', 'X-Ratelimit-Reset': '30'})
+
+        self.assertAlmostEqual(30.0, self.slot.delay, places=0)
+        self.assertEqual(1, self.crawler.stats.get_value('ratelimit/paused'))
+
+
+    @mock.patch('subredditscraper.middlewares.logger')
+    def test_retries_throttled(self, mock_logger):
+        """
+        Tests that throttled requests are retried once the period resets, with or without rate limit headers.
+        """
+        reference = RateLimitMiddleware(self.crawler, max_delay=120)
+
+        result = self.fetch(reference, 429, **{'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '45'})
+
+        self.assertTrue(isinstance(result, Request))
+        self.assertTrue(result.dont_filter)
+        self.assertAlmostEqual(45.0, self.slot.delay, places=0)
+
+        result = self.fetch(reference, 429, **{'Retry-After': '90'})
+
+        self.assertTrue(isinstance(result, Request))
+        self.assertAlmostEqual(90.0, self.slot.delay, places=0)
+        self.assertEqual(2, self.crawler.stats.get_value('ratelimit/throttled'))
+
+
+    def test_without_headers(self):
+        """
+        Tests that responses without rate limit headers leave the slot's delay alone.
+        """
+        reference = RateLimitMiddleware(self.crawler)
+
+        result = self.fetch(reference)
+
+        self.assertTrue(isinstance(result, Response))
+        self.assertEqual(2.0, self.slot.delay)
+
+
+class ReplayMiddlewareTestCase(unittest.TestCase):
+    """
+    Test cases for the replay middleware, run against the recorded responses shipped with the package.
+    """
+
+    def setUp(self):
+        self.crawler = mock.Mock()
+        self.crawler.stats = MemoryStatsCollector(mock.Mock())
+
+
+    def test_from_crawler(self):
+        """
+        Tests that the middleware is only enabled with a replay directory.
+        """
+        self.crawler.settings = Settings()
+
+        self.assertRaises(NotConfigured, ReplayMiddleware.from_crawler, self.crawler)
+
+        self.crawler.settings = Settings({'REPLAY_DIR': fixture_path('')})
+
+        self.assertEqual(6, len(ReplayMiddleware.from_crawler(self.crawler).recordings))
+
+
+    def test_serves_capture(self):
+        """
+        Tests that a recording with a raw capture is served with the status, headers and body of the capture, whatever
+        the order of the request's query parameters.
+        """
+        reference = ReplayMiddleware(self.crawler, fixture_path(''))
+
+        response = reference.process_request(Request('https://www.reddit.com/r/woahdude/new.json?limit=5&sort=new',
+            meta={'subreddit_name': 'woahdude'}), None)
+
+        self.assertTrue(isinstance(response, TextResponse))
+        self.assertEqual(200, response.status)
+        self.assertEqual(['replay'], response.flags)
+        self.assertEqual('majestic', response.headers['X-Moose'])
+        self.assertFalse('Transfer-Encoding' in response.headers)
+        self.assertFalse('__request_url' in json.loads(response.body))
+
+        # the spider parses it as it would a response from Reddit
+        items = yielded_rows(SubredditSpider(['woahdude']).parse_posts(response), LinkRow)
+
+        self.assertEqual(5, len(items))
+        self.assertEqual(1, self.crawler.stats.get_value('replay/hits'))
+
+
+    def test_serves_tagged_body(self):
+        """
+        Tests that a recording without a raw capture is served with its tag removed, be it an object or an array.
+        """
+        directory = tempfile.mkdtemp()
+
+        try:
+            for name in ('list-comments.json', 'single-comment.json'):
+                shutil.copy(fixture_path(name), directory)
+
+            reference = ReplayMiddleware(self.crawler, directory)
+
+            response = reference.process_request(Request('https://www.reddit.com/r/woahdude/comments/3f6fp6/new.json'
+                '?sort=new&showmore=false&limit=5&depth=1'), None)
+
+            self.assertEqual(200, response.status)
+            self.assertEqual(['Listing', 'Listing'], [i['kind'] for i in json.loads(response.body)])
+
+            response = reference.process_request(Request('https://www.reddit.com/r/woahdude/comments/3f6fp6/new.json'
+                '?depth=1&comment=cto4lbd&sort=new&showmore=false'), None)
+
+            self.assertFalse('__request_url' in json.loads(response.body))
+            self.assertEqual(2, self.crawler.stats.get_value('replay/hits'))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_serves_without_ignored_params(self):
+        """
+        Tests that a request without a recording of its exact URL is served the recording matching it once the
+        parameters which only shape a page are left out, as the spider doesn't ask for the recorded page sizes.
+        """
+        reference = ReplayMiddleware(self.crawler, fixture_path(''))
+        spider = SubredditSpider(['woahdude'])
+
+        request = spider.get_posts('woahdude')
+        response = reference.process_request(request, spider)
+
+        self.assertEqual(200, response.status)
+        self.assertEqual(5, len(yielded_rows(spider.parse_posts(response), LinkRow)))
+
+        request = spider.get_comments('woahdude', '3f6fp6')
+        response = reference.process_request(request, spider)
+
+        self.assertEqual(5, len(yielded_rows(spider.parse_comments(response), CommentRow)))
+
+        # the ordering parameters still have to match
+        response = reference.process_request(Request('https://www.reddit.com/r/woahdude/new.json?sort=top'), None)
+
+        self.assertEqual(404, response.status)
+        self.assertEqual(2, self.crawler.stats.get_value('replay/hits'))
+
+
+    def test_replay_crawl(self):
+        """
+        Tests that a crawl of a subreddit replayed from the recordings shipped with the package, as run by
+        `--replay src/subredditscraper/fixtures woahdude`, stores the recorded posts, following every request the
+        spider makes until none are left.
+        """
+        handle, database_file = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        try:
+            spider = SubredditSpider(['woahdude'])
+            pipeline = SQLiteItemPipeline(database_file)
+            pipeline.open_spider(spider)
+
+            reference = ReplayMiddleware(self.crawler, fixture_path(''))
+            requests = list(spider.start_requests())
+
+            while requests:
+                request = requests.pop(0)
+                response = reference.process_request(request, spider)
+
+                # left to the HttpErrorMiddleware to drop in a crawl
+                if response.status != 200:
+                    continue
+
+                for result in request.callback(response):
+                    if isinstance(result, Request):
+                        requests.append(result)
+                    else:
+                        pipeline.process_item(result, spider)
+
+            pipeline.close_spider(spider)
+
+            with sqlite3.connect(database_file) as connection:
+                self.assertEqual(['3fn7gg', '3fn903', '3fn9ro', '3fn9z7', '3fnayn'],
+                    [encode_id(i[0]) for i in connection.execute('select id from links order by id;')])
+
+            # the comments of the posts and the next page of the listing weren't recorded
+            self.assertEqual(1, self.crawler.stats.get_value('replay/hits'))
+            self.assertEqual(6, self.crawler.stats.get_value('replay/missed'))
+        finally:
+            os.remove(database_file)
 
-        self.assertTrue(reference.tables_exist(self.connection))
 
-        with self.connection:
-            self.connection.execute('drop table links;')
+    def test_missing_recording(self):
+        """
+        Tests that a request without a recording gets a 404 rather than reaching the network.
+        """
+        reference = ReplayMiddleware(self.crawler, fixture_path(''))
 
-        self.assertFalse(reference.tables_exist(self.connection))
+        response = reference.process_request(Request('https://www.reddit.com/r/pics/new.json?sort=new'), None)
 
+        self.assertEqual(404, response.status)
+        self.assertEqual(1, self.crawler.stats.get_value('replay/missed'))
 
-class ItemsTestCase(unittest.TestCase):
+
+class SchemaTestCase(unittest.TestCase):
     """
-    Test cases for global items.
+    Test cases for the schema generated from the items.
     """
 
-    def test_bool_serializer(self):
+    def test_columns(self):
         """
-        Tests that the boolean serializer serializes a value to True, False, or None.
+        Tests that every field is a column, the id first, typed by its serializer.
         """
-        self.assertEqual(None, bool_serializer(None))
-        self.assertEqual(True, bool_serializer(True))
-        self.assertEqual(False, bool_serializer(False))
+        self.assertEqual(('id',) + tuple(sorted(i for i in Link.fields if i not in ('id', 'prefixed_id'))),
+            LINKS.columns)
+        self.assertEqual(set(Comment.fields) - set(['prefixed_id']), set(COMMENTS.columns))
 
-    def test_edited_serializer(self):
-        """
-        Tests that the float or none serializer serializes a value to a float or None.
-        """
-        # test boolean value
-        self.assertEqual(None, edited_serializer(False))
-        self.assertEqual(1, edited_serializer(True))
-        # test string value
-        self.assertEqual(None, edited_serializer('nope'))
-        # convert long to float
-        self.assertEqual(3, edited_serializer(3L))
-        # convert float to float
-        self.assertEqual(3, edited_serializer(3.0))
-        # convert int to float
-        self.assertEqual(3, edited_serializer(3))
-        # rounding
-        self.assertEqual(4, edited_serializer(3.9))
-        self.assertEqual(4, edited_serializer(4.2))
+        types = dict(zip(LINKS.columns, LINKS.types))
 
+        self.assertEqual('integer', types['created_utc'])
+        self.assertEqual('integer', types['edited'])
+        self.assertEqual('integer', types['stickied'])
+        self.assertEqual('text', types['title'])
+        self.assertEqual('text', types['selftext'])
+        # the key of the media blob
+        self.assertEqual('integer', types['media'])
+        self.assertEqual('integer', dict(zip(COMMENTS.columns, COMMENTS.types))['parent_id'])
 
-    def test_id_serializer(self):
+
+    def test_create_statement(self):
         """
-        Tests that the id serializer removes the prefix from a base-36 id.
+        Tests that the generated create statement creates the table with every column, and that the version of the
+        schema is recorded.
         """
-        # test for cases which should work
-        self.assertEqual('abc123', id_serializer('t1_abc123'))
-        self.assertEqual('abc123', id_serializer('abc123'))
-        self.assertEqual(u'abc123', id_serializer(u't1_abc123'))
+        connection = sqlite3.connect(':memory:')
 
-        # test for cases which should not work
-        self.assertEqual(None, id_serializer('LOL_NOT_MATCHING'))
-        self.assertEqual(None, id_serializer(1))
-        self.assertEqual(None, id_serializer(None))
+        SQLiteItemPipeline(':memory:').create_tables(connection)
 
-    def test_link_id_serializer(self):
-        """
-        Tests that the link id serializer works as planned.
-        """
-        # cases which should work
-        self.assertEqual(u't3_abc123', link_id_serializer(u'abc123'))
-        self.assertEqual(u't3_abc123', link_id_serializer(u't3_abc123'))
-        self.assertEqual('t3_abc123', link_id_serializer('abc123'))
+        columns = [(i[1], i[2].lower(), i[5]) for i in connection.execute('pragma table_info(comments);')]
 
-        # cases which should not work
-        self.assertEqual(None, link_id_serializer('LOL_NOT_MATCHING'))
-        self.assertEqual(None, link_id_serializer(1))
-        self.assertEqual(None, link_id_serializer(None))
+        self.assertEqual(zip(COMMENTS.columns, COMMENTS.types, [1] + [0] * (len(COMMENTS.columns) - 1)), columns)
+        self.assertEqual(SCHEMA_VERSION, connection.execute('pragma user_version;').fetchone()[0])
 
-    def test_comment_id_serializer(self):
+
+    def test_thread_index(self):
         """
-        Tests that the comment id serializer works as planned.
+        Tests that a thread is read with a single range scan of the thread index, without sorting.
         """
-        # cases which should work
-        self.assertEqual(u't1_abc123', comment_id_serializer(u'abc123'))
-        self.assertEqual(u't1_abc123', comment_id_serializer(u't1_abc123'))
-        self.assertEqual('t1_abc123', comment_id_serializer('t1_abc123'))
+        connection = connect(':memory:')
 
-        # cases which should not work
-        self.assertEqual(None, comment_id_serializer('LOL_NOT_MATCHING'))
-        self.assertEqual(None, comment_id_serializer(1))
-        self.assertEqual(None, comment_id_serializer(None))
+        SQLiteItemPipeline(':memory:').create_tables(connection)
 
-    def test_time_serializer(self):
+        plan = ' '.join(i[-1] for i in connection.execute('explain query plan %s' % (THREAD_QUERY,), (1,)))
+
+        self.assertTrue('USING INDEX comments_thread (link_id=?)' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+
+    def test_convert(self):
         """
-        Tests that the time serializer converts a time into the right format.
+        Tests that converting raw children and the compiled serializer give the same rows as building and serializing
+        items field by field.
         """
-        self.assertEqual(100, time_serializer(100.0))
-        self.assertEqual(100, time_serializer(100.10245))
-        self.assertEqual(101, time_serializer(100.5))
+        spider = SubredditSpider('woahdude')
+
+        for name, cls, schema in (('list-posts.json', Link, LINKS), ('list-comments.json', Comment, COMMENTS)):
+            with open(fixture_path(name)) as f:
+                document = json.load(f)
+
+            listing = document if isinstance(document, dict) else document[-1]
+
+            for child in listing['data']['children']:
+                item = spider.build_item(cls, child['data'])
+
+                expected = tuple(item.fields[i]['serializer'](item[i]) if item.get(i) is not None and
+                    'serializer' in item.fields[i] else item.get(i) for i in schema.columns)
+
+                self.assertEqual(expected, schema.convert(child['data']))
+                self.assertEqual(expected, schema.serialize(item))
+
+        row = dict(zip(LINKS.columns, LINKS.convert({'id': 'abc', 'name': 't3_abc', 'edited': 1438625668.4,
+            'created_utc': '1438625668', 'hidden': None, 'stickied': 1, 'comments_fetched': 5})))
+
+        # computed columns are left for the pipeline to fill in
+        self.assertEqual((decode_id('abc'), 1438625668, 1438625668, None, True, None),
+            tuple(row[i] for i in ('id', 'edited', 'created_utc', 'hidden', 'stickied', 'comments_fetched')))
 
 
 class SubredditSpiderTestCase(unittest.TestCase):
@@ -488,3 +2881,479 @@ class SubredditSpiderTestCase(unittest.TestCase):
         # test parsing
         self.assertEqual(ref.get_comment_id('t1_abc123'), 't1_abc123')
         self.assertEqual(ref.get_comment_id('abc123'), 't1_abc123')
+
+
+    def test_get_posts(self):
+        """
+        Test that get_posts builds listing requests with stable URLs.
+        """
+        ref = SubredditSpider('woahdude')
+
+        self.assertEqual('https://www.reddit.com/r/woahdude/new.json?sort=new', ref.get_posts('woahdude').url)
+        self.assertEqual('https://www.reddit.com/r/woahdude/new.json?after=t3_3fn7gg&sort=new',
+            ref.get_posts('woahdude', after='3fn7gg').url)
+        self.assertEqual('https://www.reddit.com/r/woahdude/new.json?before=t3_3fn7gg&sort=new',
+            ref.get_posts('woahdude', before='t3_3fn7gg').url)
+        self.assertEqual(ref.parse_posts, ref.get_posts('woahdude').callback)
+        self.assertEqual('woahdude', ref.get_posts('woahdude').meta['subreddit_name'])
+
+
+    def test_start_requests_interleaves_subreddits(self):
+        """
+        Test that requests of many subreddits are scheduled in turn.
+        """
+        ref = SubredditSpider(['woahdude', 'pics'])
+
+        requests = list(ref.start_requests())
+
+        self.assertEqual(['https://www.reddit.com/r/woahdude/new.json?sort=new',
+            'https://www.reddit.com/r/pics/new.json?sort=new'], [i.url for i in requests])
+        self.assertEqual([-1, -1], [i.priority for i in requests])
+
+        # a busy subreddit's next requests queue up behind the first requests of quiet ones
+        self.assertEqual(-2, ref.get_posts('woahdude', after='a').priority)
+        self.assertEqual(-3, ref.get_comments('woahdude', 'b').priority)
+        self.assertEqual(-2, ref.get_comments('pics', 'c').priority)
+
+
+    def test_parse_posts(self):
+        """
+        Test that parse_posts yields links, comment requests and the next page of the listing.
+        """
+        ref = SubredditSpider('woahdude')
+
+        results = list(ref.parse_posts(fixture_response('list-posts.json')))
+
+        links = yielded_rows(results, LinkRow)
+        requests = [i.url for i in results if isinstance(i, Request)]
+
+        self.assertEqual(['3fnayn', '3fn9z7', '3fn9ro', '3fn903', '3fn7gg'], [encode_id(i['id']) for i in links])
+        self.assertEqual(u'woahdude', links[0]['subreddit'])
+        self.assertIn('https://www.reddit.com/r/woahdude/comments/3fnayn/new.json?limit=500&sort=new', requests)
+        self.assertEqual('https://www.reddit.com/r/woahdude/new.json?after=t3_3fn7gg&sort=new', requests[-1])
+
+
+    def test_parse_posts_incremental(self):
+        """
+        Test that parse_posts stops paging once it reaches posts older than the cutoff.
+        """
+        ref = SubredditSpider('woahdude', incremental=True)
+        ref.cutoffs['woahdude'] = 1438625000
+
+        results = list(ref.parse_posts(fixture_response('list-posts.json')))
+
+        self.assertEqual(['3fnayn', '3fn9z7', '3fn9ro'], [encode_id(i['id']) for i in yielded_rows(results, LinkRow)])
+        self.assertFalse(any('after=' in i.url for i in results if isinstance(i, Request)))
+
+
+    def test_get_high_water_mark(self):
+        """
+        Test that the newest stored post of the subreddit is found, and that missing tables are tolerated.
+        """
+        ref = SubredditSpider('woahdude', incremental=True, overlap=3600)
+        connection = sqlite3.connect(':memory:')
+        # for the triggers of the full-text indexes
+        register_functions(connection)
+
+        self.assertEqual(None, ref.get_high_water_mark(connection, 'woahdude'))
+
+        SQLiteItemPipeline(':memory:').create_tables(connection)
+
+        self.assertEqual(None, ref.get_high_water_mark(connection, 'woahdude'))
+
+        with connection:
+            connection.executemany('insert into links (id, subreddit, created_utc) values (?, ?, ?);', [
+                (10, 'WoahDude', 100), (11, 'woahdude', 300), (12, 'woahdude', 200), (13, 'pics', 400)])
+
+        self.assertEqual((11, 300), ref.get_high_water_mark(connection, 'woahdude'))
+        self.assertEqual((13, 400), ref.get_high_water_mark(connection, 'pics'))
+
+
+    def test_start_requests_incremental(self):
+        """
+        Test that start_requests reads the cutoff from the database in incremental mode.
+        """
+        ref = SubredditSpider('woahdude', incremental=True, overlap=3600)
+        ref.settings = mock.Mock()
+
+        with mock.patch.object(ref, 'get_high_water_mark', return_value=(11, 10000)):
+            with mock.patch('subredditscraper.spiders.connect_reader') as mock_connect_reader:
+                requests = list(ref.start_requests())
+
+        self.assertEqual({'woahdude': 6400}, ref.cutoffs)
+        self.assertEqual(1, len(requests))
+        mock_connect_reader.return_value.close.assert_called_with()
+
+
+    def test_start_requests_refresh(self):
+        """
+        Test that refresh mode fetches the stored posts of each subreddit by their ids, 100 at a time and in turn.
+        """
+        ref = SubredditSpider(['woahdude', 'pics', 'empty'], refresh=True)
+        ref.settings = mock.Mock()
+
+        connection = sqlite3.connect(':memory:')
+        register_functions(connection)
+        SQLiteItemPipeline(':memory:').create_tables(connection)
+
+        with connection:
+            connection.executemany('insert into links (id, subreddit, created_utc) values (?, ?, ?);',
+                [(i, 'woahdude', i) for i in range(1000, 1250)] + [(decode_id('zz'), 'pics', 0)])
+
+        with mock.patch('subredditscraper.spiders.connect_reader', return_value=connection):
+            requests = list(ref.start_requests())
+
+        self.assertEqual(['woahdude', 'pics', 'woahdude', 'woahdude'], [i.meta['subreddit_name'] for i in requests])
+        self.assertEqual('https://www.reddit.com/api/info.json?id=t3_zz', requests[1].url)
+        self.assertEqual(['t3_' + encode_id(i) for i in range(1249, 1149, -1)],
+            requests[0].url.split('?id=')[1].split('%2C'))
+        self.assertEqual(50, requests[3].url.count('t3_'))
+        self.assertEqual(ref.parse_info, requests[0].callback)
+
+
+    def test_parse_info(self):
+        """
+        Test that parse_info yields a link for every post fetched by id.
+        """
+        ref = SubredditSpider('woahdude', refresh=True)
+
+        results = list(ref.parse_info(fixture_response('list-posts.json',
+            'https://www.reddit.com/api/info.json?id=t3_3fnayn')))
+
+        self.assertEqual(['3fnayn', '3fn9z7', '3fn9ro', '3fn903', '3fn7gg'], [encode_id(i['id']) for i in
+            yielded_rows(results, LinkRow)])
+        self.assertEqual(len(results), len(yielded_rows(results, LinkRow)))
+
+
+    def test_parse_comments(self):
+        """
+        Test that parse_comments yields every comment in the tree, followed by the marker that they've been fetched.
+        """
+        ref = SubredditSpider('woahdude')
+
+        results = list(ref.parse_comments(fixture_response('list-comments.json',
+            'https://www.reddit.com/r/woahdude/comments/3f6fp6/new.json?sort=new')))
+        marker = results.pop()
+
+        comments = yielded_rows(results, CommentRow)
+
+        self.assertEqual(['ctolrk6', 'ctmpily', 'ctmp692', 'ctmn4x3', 'ctmlaqo'], [encode_id(i['id']) for i in
+            comments])
+        self.assertEqual(len(results), len(comments))
+        self.assertTrue(isinstance(marker, CommentsFetched))
+        self.assertEqual({'link_id': '3f6fp6', 'num_comments': 600}, dict(marker))
+        self.assertEqual(decode_id('3f6fp6'), comments[0]['link_id'])
+        self.assertEqual(None, comments[0]['parent_id'])
+
+
+    def test_expand_more_comments(self):
+        """
+        Test that 'more' stubs are expanded in batches of at most 100 ids, one morechildren request at a time, and that
+        stubs returned by morechildren requests are batched with the ids still pending.
+        """
+        ref = SubredditSpider('woahdude')
+        ref.crawler = mock.Mock(stats=MemoryStatsCollector(mock.Mock()))
+
+        def comment(id, replies=None):
+            return {'kind': 't1', 'data': {'id': id, 'name': 't1_' + id, 'link_id': 't3_3f6fp6', 'body': id,
+                'replies': {'kind': 'Listing', 'data': {'children': replies}} if replies else ''}}
+
+        def more(parent_id, ids):
+            return {'kind': 'more', 'data': {'id': ids[0] if ids else '_', 'name': 't1_' + (ids[0] if ids else '_'),
+                'parent_id': parent_id, 'count': len(ids), 'children': ids}}
+
+        ids = [encode_id(i) for i in range(1000, 1150)]
+
+        tree = [{'data': {'children': [{'kind': 't3', 'data': {'id': '3f6fp6'}}]}},
+            {'data': {'children': [comment('a', [comment('b'), more('t1_a', ids[:120])]), more('t3_3f6fp6', ids[120:]),
+                comment('c', [more('t1_c', [])])]}}]
+
+        url = 'https://www.reddit.com/r/woahdude/comments/3f6fp6/new.json?limit=500&sort=new'
+        response = TextResponse(url, body=json.dumps(tree), encoding='utf-8',
+            request=ref.get_comments('woahdude', '3f6fp6'))
+
+        results = list(ref.parse_comments(response))
+        requests = [i for i in results if isinstance(i, Request)]
+
+        self.assertEqual(['a', 'b', 'c'], [encode_id(i['id']) for i in yielded_rows(results, CommentRow)])
+        self.assertEqual(2, len(requests))
+
+        # continue this thread
+        continued = requests[0]
+        self.assertTrue('/comments/3f6fp6/new.json?comment=c&' in continued.url)
+
+        # the first batch of ids
+        self.assertTrue(requests[1].url.startswith('https://www.reddit.com/api/morechildren.json?'))
+        self.assertTrue('children=%s&' % ('%2C'.join(ids[:100]),) in requests[1].url)
+        self.assertTrue('link_id=t3_3f6fp6' in requests[1].url)
+
+        things = {'json': {'errors': [], 'data': {'things': [comment(i) for i in ids[:99]] +
+            [more('t1_' + ids[0], ['zz'])]}}}
+        response = TextResponse(requests[1].url, body=json.dumps(things), encoding='utf-8', request=requests[1])
+
+        results = list(ref.parse_more_comments(response))
+        requests = [i for i in results if isinstance(i, Request)]
+
+        self.assertEqual(99, len(yielded_rows(results, CommentRow)))
+        self.assertEqual(1, len(requests))
+        self.assertTrue('children=%s&' % ('%2C'.join(ids[100:] + ['zz']),) in requests[0].url)
+
+        # the thread is added to the stats once the last request has been parsed
+        self.assertEqual(None, ref.crawler.stats.get_value('threads/count'))
+
+        things = {'json': {'errors': [], 'data': {'things': [comment(i) for i in ids[100:]]}}}
+        results = list(ref.parse_more_comments(TextResponse(requests[0].url, body=json.dumps(things),
+            encoding='utf-8', request=requests[0])))
+        self.assertEqual([], [i for i in results if isinstance(i, Request)])
+
+        tree = [tree[0], {'data': {'children': [comment('c', [comment('d')])]}}]
+        results = list(ref.parse_comments(TextResponse(continued.url, body=json.dumps(tree), encoding='utf-8',
+            request=continued)))
+        self.assertEqual(['c', 'd'], [encode_id(i['id']) for i in yielded_rows(results, CommentRow)])
+        self.assertEqual(2, len(results))
+
+        self.assertEqual(1, ref.crawler.stats.get_value('threads/count'))
+        self.assertEqual(4, ref.crawler.stats.get_value('threads/max_requests'))
+        self.assertEqual((3 + 99 + 50 + 2) / 4.0, ref.crawler.stats.get_value('threads/expansion_ratio'))
+        self.assertEqual(2, ref.crawler.stats.get_value('subreddit/woahdude/more_requests'))
+        self.assertFalse([i for i in ref.crawler.stats.get_stats() if i.startswith('thread/')])
+
+
+    @mock.patch('subredditscraper.spiders.logger')
+    def test_record_thread(self, mock_logger):
+        """
+        Test that threads are added up in the stats rather than recorded one by one, and that only those taking more
+        than `outlier_requests` requests are logged.
+        """
+        ref = SubredditSpider('woahdude')
+        ref.crawler = mock.Mock(stats=MemoryStatsCollector(mock.Mock()))
+        ref.outlier_requests = 5
+
+        for post_id, requests, comments in (('a', 1, 10), ('b', 3, 200), ('c', 8, 400)):
+            thread = ref.new_thread(post_id)
+            thread.update(requests=requests, comments=comments)
+            ref.record_thread('woahdude', thread)
+
+        stats = ref.crawler.stats
+
+        self.assertEqual(3, stats.get_value('threads/count'))
+        self.assertEqual(12, stats.get_value('threads/requests'))
+        self.assertEqual(610, stats.get_value('threads/comments'))
+        self.assertEqual(8, stats.get_value('threads/max_requests'))
+        self.assertEqual(4.0, stats.get_value('threads/mean_requests'))
+        self.assertEqual(610 / 12.0, stats.get_value('threads/expansion_ratio'))
+
+        mock_logger.info.assert_called_once_with(mock.ANY, 'c', 'woahdude', 8, 400)
+
+
+    def test_parse_posts_skips_unchanged_comments(self):
+        """
+        Test that parse_posts doesn't request the comments of posts stored with the same number of comments.
+        """
+        ref = SubredditSpider('woahdude')
+        ref.link_index = IdIndex(values=True)
+
+        with open(fixture_path('list-posts.json')) as f:
+            children = json.load(f)['data']['children']
+
+        ref.link_index.add(children[0]['data']['id'], children[0]['data']['num_comments'])
+        ref.link_index.add(children[1]['data']['id'], children[1]['data']['num_comments'] + 1)
+
+        results = list(ref.parse_posts(fixture_response('list-posts.json')))
+        requests = [i.url for i in results if isinstance(i, Request)]
+
+        self.assertEqual(5, len(yielded_rows(results, LinkRow)))
+        self.assertFalse(any('/comments/%s/' % (children[0]['data']['id'],) in i for i in requests))
+        self.assertTrue(any('/comments/%s/' % (children[1]['data']['id'],) in i for i in requests))
+
+
+class SyntheticTestCase(unittest.TestCase):
+    """
+    Test cases for the synthetic subreddits and the middleware serving them.
+    """
+
+    def setUp(self):
+        self.reddit = SyntheticReddit(['woahdude', 'pics'], posts=30, comments_per_post=20, depth=3, seed=1)
+        self.spider = SubredditSpider(['woahdude', 'pics'])
+
+
+    def test_deterministic(self):
+        """
+        Tests that the same seed always generates the same data, and another seed other data.
+        """
+        page = self.reddit.posts_page('pics')
+        post_id = page['data']['children'][3]['data']['id']
+
+        same = SyntheticReddit(['woahdude', 'pics'], posts=30, comments_per_post=20, depth=3, seed=1)
+
+        self.assertEqual(json.dumps(page), json.dumps(same.posts_page('pics')))
+        self.assertEqual(json.dumps(self.reddit.comments_page(post_id)), json.dumps(same.comments_page(post_id)))
+
+        other = SyntheticReddit(['woahdude', 'pics'], posts=30, comments_per_post=20, depth=3, seed=2)
+
+        self.assertNotEqual(json.dumps(page), json.dumps(other.posts_page('pics')))
+
+
+    def test_posts_page(self):
+        """
+        Tests that a subreddit's posts are listed newest first, a page at a time, with unique ids.
+        """
+        first = self.reddit.posts_page('woahdude')
+        second = self.reddit.posts_page('woahdude', first['data']['after'])
+        children = first['data']['children'] + second['data']['children']
+
+        self.assertEqual(25, len(first['data']['children']))
+        self.assertEqual(5, len(second['data']['children']))
+        self.assertEqual(None, second['data']['after'])
+        self.assertEqual(30, len(set(i['data']['id'] for i in children)))
+        self.assertEqual(sorted([i['data']['created_utc'] for i in children], reverse=True),
+            [i['data']['created_utc'] for i in children])
+
+        # the other subreddit's posts have other ids, and can't be paged from
+        pics = self.reddit.posts_page('pics')['data']['children']
+
+        self.assertFalse(set(i['data']['id'] for i in pics) & set(i['data']['id'] for i in children))
+        self.assertEqual(None, self.reddit.posts_page('pics', first['data']['after']))
+        self.assertEqual(None, self.reddit.posts_page('aww'))
+
+
+    def test_comments_page(self):
+        """
+        Tests that a post has as many comments as it says, no deeper than the maximum depth.
+        """
+        for child in self.reddit.posts_page('woahdude')['data']['children'][:5]:
+            post, comments = self.reddit.comments_page(child['data']['id'])
+            found = []
+
+            def walk(listing, depth):
+                for i in listing['data']['children']:
+                    found.append(i['data']['id'])
+
+                    self.assertTrue(depth <= 3)
+
+                    if i['data']['replies']:
+                        walk(i['data']['replies'], depth + 1)
+
+            walk(comments, 0)
+
+            self.assertEqual(child['data'], post['data']['children'][0]['data'])
+            self.assertEqual(child['data']['num_comments'], len(set(found)))
+
+
+    def test_edit_rate(self):
+        """
+        Tests that about the given fraction of comments have been edited.
+        """
+        reddit = SyntheticReddit(['woahdude'], posts=20, comments_per_post=100, edit_rate=0.25)
+        comments = [i for index in range(20) for i in reddit.comments(0, index)]
+        edited = len([i for i in comments if i['data']['edited']])
+
+        self.assertTrue(0.2 < float(edited) / len(comments) < 0.3)
+        self.assertFalse(any(i['data']['edited'] for i in SyntheticReddit(['woahdude'], edit_rate=0).comments(0, 0)))
+
+
+    def test_write_replay(self):
+        """
+        Tests that written responses are served by the ReplayMiddleware for the spider to parse.
+        """
+        directory = tempfile.mkdtemp()
+
+        try:
+            count = self.reddit.write_replay(directory, self.spider)
+            crawler = mock.Mock()
+            crawler.stats = MemoryStatsCollector(mock.Mock())
+            reference = ReplayMiddleware(crawler, directory)
+
+            # two pages of posts and the comments of each post, for each subreddit
+            self.assertEqual(2 * (2 + 30), count)
+            self.assertEqual(count, len(reference.recordings))
+
+            request = self.spider.get_posts('pics')
+            results = list(self.spider.parse_posts(reference.process_request(request, self.spider)))
+
+            self.assertEqual(25, len(yielded_rows(results, LinkRow)))
+
+            request = [i for i in results if isinstance(i, Request) and '/comments/' in i.url][0]
+            results = list(self.spider.parse_comments(reference.process_request(request, self.spider)))
+            expected = self.reddit.get_post_index(request.url.split('/')[6])
+
+            self.assertEqual(self.reddit.comment_count(*expected), len(yielded_rows(results, CommentRow)))
+            self.assertFalse(crawler.stats.get_value('replay/missed'))
+        finally:
+            shutil.rmtree(directory)
+
+
+    def test_middleware(self):
+        """
+        Tests that the middleware serves the spider's requests, and 404s those the synthetic subreddits can't answer.
+        """
+        crawler = mock.Mock()
+        crawler.stats = MemoryStatsCollector(mock.Mock())
+        crawler.settings = Settings()
+
+        self.assertRaises(NotConfigured, SyntheticMiddleware.from_crawler, crawler)
+
+        crawler.settings = Settings({'SYNTHETIC_ENABLED': True, 'SYNTHETIC_POSTS': 30, 'SYNTHETIC_SEED': 1,
+            'SYNTHETIC_COMMENTS_PER_POST': 20, 'SYNTHETIC_DEPTH': 3})
+        reference = SyntheticMiddleware.from_crawler(crawler)
+
+        response = reference.process_request(self.spider.get_posts('woahdude'), self.spider)
+
+        self.assertTrue(isinstance(response, TextResponse))
+        self.assertEqual(['synthetic'], response.flags)
+        self.assertEqual(json.dumps(self.reddit.posts_page('woahdude')), response.body)
+        self.assertEqual(25, len(yielded_rows(self.spider.parse_posts(response), LinkRow)))
+
+        response = reference.process_request(Request('https://www.reddit.com/r/aww/new.json'), self.spider)
+
+        self.assertEqual(404, response.status)
+        self.assertEqual(1, crawler.stats.get_value('synthetic/responses'))
+        self.assertEqual(1, crawler.stats.get_value('synthetic/missed'))
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """
+    Test cases for the token bucket.
+    """
+
+    def test_consume(self):
+        """
+        Tests that tokens are consumed and refilled at the bucket's rate, up to its capacity.
+        """
+        reference = TokenBucket(2, 4, now=0)
+
+        self.assertEqual(0, reference.wait_time(0))
+
+        for i in range(4):
+            reference.consume(0)
+
+        self.assertEqual(0.5, reference.wait_time(0))
+        self.assertEqual(0, reference.wait_time(0.5))
+
+        # never more than the capacity
+        self.assertEqual(4, (reference.refill(100), reference.tokens)[1])
+
+        # debt is paid back before the next token
+        for i in range(6):
+            reference.consume(100)
+
+        self.assertEqual(1.5, reference.wait_time(100))
+
+
+    def test_pause(self):
+        """
+        Tests that a paused bucket gains no tokens until the pause ends, after which a single token is available.
+        """
+        reference = TokenBucket(1, 10, now=0)
+
+        for i in range(20):
+            reference.consume(0)
+
+        reference.pause(0, 30)
+
+        self.assertEqual(30, reference.wait_time(0))
+        self.assertEqual(0, reference.wait_time(30))
+
+        reference.consume(30)
+
+        self.assertEqual(1, reference.wait_time(30))
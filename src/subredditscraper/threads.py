@@ -0,0 +1,265 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sys
+
+from subredditscraper.database import connect_reader
+from subredditscraper.exceptions import IncompleteThreadException, InvalidIdException
+from subredditscraper.ids import decode_id, encode_id
+from subredditscraper.schema import COMMENTS
+
+
+"""
+The width of each comment's segment of a path, its base-36 id zero-padded, so that paths sort as their comments are
+displayed: every comment right after its parent, and replies to the same comment oldest first.
+"""
+SEGMENT_WIDTH = 8
+
+
+"""
+The query reading the comments of a link in tree order, with a single range scan of the index on the link id and path.
+"""
+THREAD_QUERY = ('select %s, length(path) / %d - 1 as depth from comments indexed by comments_thread where link_id = ? '
+    'order by path;' % (COMMENTS.view_columns(), SEGMENT_WIDTH))
+
+
+"""
+The query finding whether any comment of a link has no path, with a single seek of the index on the link id and path.
+"""
+MISSING_PATHS_QUERY = 'select 1 from comments indexed by comments_thread where link_id = ? and path is null limit 1;'
+
+
+def path_segment(id):
+    """
+    Returns the segment of a comment's path for its integer id.
+    """
+    return encode_id(id).rjust(SEGMENT_WIDTH, '0')
+
+
+def get_thread(connection, link_id):
+    """
+    Reads the comments of a link in tree order.
+
+    Arguments:
+    connection: SQLite connection to the database.
+    link_id: The id of the link, base-36 with or without its prefix, or an integer.
+
+    Returns:
+    A cursor of rows with the columns of the comments view, and the `depth` of each comment, top-level comments being
+    at depth 0. Comments whose parents are missing come in the order of their missing parent, and aren't `rooted`.
+
+    Raises:
+    IncompleteThreadException: If the paths of the link's comments haven't been built, as while a bulk load of the
+                               database hasn't finished.
+    """
+    link_id = decode_id(link_id)
+
+    # the thread index is dropped for a bulk load, and built along with the paths once it finishes
+    indexed = connection.execute("select 1 from sqlite_master where type = 'index' and name = 'comments_thread';")
+
+    if indexed.fetchone() is None or connection.execute(MISSING_PATHS_QUERY, (link_id,)).fetchone() is not None:
+        raise IncompleteThreadException("The paths of the comments haven't been built, as the last bulk load of the "
+            "database hasn't finished; crawl into it again to finish it.")
+
+    return connection.execute(THREAD_QUERY, (link_id,))
+
+
+class PathBuilder(object):
+    """
+    Builds the materialized paths of comments as they're stored: the segments of every comment from the top-level one
+    down to the comment itself. A comment is `rooted` if its path reaches up to a reply to the link.
+
+    Comments may arrive before their parents, when a thread is crawled in pages or a parent is deleted. Such a comment
+    is stored with a path starting at its missing parent instead, and isn't rooted; as every comment below it starts
+    with the same segment, once the parent arrives that segment is replaced by the parent's path throughout the
+    subtree with a single range update.
+    """
+
+    def __init__(self):
+        # the first segments of the paths of comments which aren't rooted, those of the parents still missing
+        self.orphans = set()
+
+
+    def load(self, connection):
+        """
+        Loads the parents still missing from the database.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        self.orphans = set(i[0] for i in connection.execute('select distinct substr(path, 1, %d) from comments '
+            'where rooted = 0;' % (SEGMENT_WIDTH,)))
+
+
+    def build_paths(self, connection, rows):
+        """
+        Fills in the path and rooted columns of comment rows, from the paths of their parents in the same batch or,
+        failing that, in the database.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        rows: A list of comment row tuples in the column order of `COMMENTS`.
+
+        Returns:
+        A list of the rows with their paths.
+        """
+        id_column, parent_column, path_column, rooted_column = (COMMENTS.columns.index(i) for i in ('id', 'parent_id',
+            'path', 'rooted'))
+
+        paths = self.resolve(dict((row[id_column], row[parent_column]) for row in rows),
+            lambda a: self.get_stored_path(connection, a))
+        result = []
+
+        for row in rows:
+            path, rooted = paths[row[id_column]]
+
+            if not rooted:
+                self.orphans.add(path[:SEGMENT_WIDTH])
+
+            row = list(row)
+            row[path_column], row[rooted_column] = path, rooted
+            result.append(tuple(row))
+
+        return result
+
+
+    def resolve(self, parents, get_path):
+        """
+        Resolves the paths of comments.
+
+        Arguments:
+        parents: A dictionary of the parent id of each comment by its id, None for top-level comments.
+        get_path: A function returning the path of a parent which isn't among the comments, and whether it's rooted.
+
+        Returns:
+        A dictionary of tuples of the path of each comment and whether it's rooted by its id.
+        """
+        result = {}
+
+        for comment_id in parents:
+            # walk up to the nearest ancestor whose path is known, then back down
+            chain = []
+            current = comment_id
+
+            while current not in result:
+                chain.append(current)
+                parent = parents[current]
+
+                if parent is None:
+                    path, rooted = '', True
+                    break
+
+                if parent not in parents:
+                    path, rooted = get_path(parent)
+                    break
+
+                current = parent
+            else:
+                path, rooted = result[current]
+
+            for i in reversed(chain):
+                path += path_segment(i)
+                result[i] = (path, rooted)
+
+        return result
+
+
+    def rebuild(self, connection):
+        """
+        Builds the paths of every stored comment, one thread at a time, as when a bulk load finishes. Call it inside
+        of a transaction.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        """
+        link_ids = [i[0] for i in connection.execute('select distinct link_id from comments;')]
+
+        for link_id in link_ids:
+            paths = self.resolve(dict(connection.execute('select id, parent_id from comments where link_id = ?;',
+                (link_id,)).fetchall()), lambda a: (path_segment(a), False))
+
+            connection.executemany('update comments set path = ?, rooted = ? where id = ?;', ((path, rooted, i)
+                for i, (path, rooted) in paths.iteritems()))
+
+        self.load(connection)
+
+
+    def get_stored_path(self, connection, parent_id):
+        """
+        Returns the path of a stored comment and whether it's rooted, or if it isn't stored, the path its replies start
+        with until it is.
+        """
+        row = connection.execute('select path, rooted from comments where id = ?;', (parent_id,)).fetchone()
+
+        if row is None or row[0] is None:
+            return path_segment(parent_id), False
+
+        return row[0], bool(row[1])
+
+
+    def adopt(self, connection, rows):
+        """
+        Moves the replies stored before their parents under the paths of those parents among rows just stored. Call it
+        inside of the transaction which stored the rows.
+
+        Arguments:
+        connection: SQLite connection to the database.
+        rows: A list of comment row tuples, with their paths.
+
+        Returns:
+        The number of comments moved.
+        """
+        id_column, link_column, path_column, rooted_column = (COMMENTS.columns.index(i) for i in ('id', 'link_id',
+            'path', 'rooted'))
+
+        result = 0
+
+        for row in rows:
+            segment = path_segment(row[id_column])
+
+            if segment not in self.orphans:
+                continue
+
+            self.orphans.discard(segment)
+
+            result += connection.execute('update comments indexed by comments_thread set path = ? || substr(path, ?), '
+                'rooted = ? where link_id = ? and path between ? and ? and rooted = 0;', (row[path_column],
+                SEGMENT_WIDTH + 1, row[rooted_column], row[link_column], segment, segment + '~')).rowcount
+
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='subreddit-scraper-thread',
+        description="Prints the comments of a post in an archive in tree order.")
+    parser.add_argument('-d', '--database-file', default="subreddits.db",
+        help="The database file to read the comments from.")
+    parser.add_argument('--json', action='store_true',
+        help="Print every comment as a JSON object on a line of its own, rather than indented by its depth.")
+    parser.add_argument('post_id',
+        help="The base-36 id of the post, with or without its t3_ prefix.")
+
+    args = parser.parse_args()
+
+    connection = connect_reader(args.database_file)
+
+    try:
+        try:
+            rows = get_thread(connection, args.post_id)
+        except (IncompleteThreadException, InvalidIdException) as e:
+            parser.error(str(e))
+
+        for row in rows:
+            if args.json:
+                line = json.dumps(dict(zip(row.keys(), row)), sort_keys=True)
+            else:
+                line = u'%s%s: %s' % (u'  ' * row['depth'], row['author'], (row['body'] or u'').replace(u'\n', u' '))
+
+            sys.stdout.write(line.encode('utf-8') + '\n')
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    main()